@@ -0,0 +1,216 @@
+"""
+End-to-end benchmark of the scripts against a local stand-in of www.cbr.ru.
+
+The stand-in server replays the saved documents of "benchmarks/fixtures" with a configurable latency,
+dates in the documents are replaced by the requested ones, so each request adds new rows.
+Each path runs in a fresh interpreter with its own scratch database and HTTP cache:
+    period   'period' mode of cbr_xml.py (XML_dynamic.asp by windows), latency of each request
+    schedule the scheduled job of cbr_xml.py (XML_daily.asp) for consecutive days, latency of each job
+    month    'period' mode of cbr_usd_eur.py (concurrent requests of the daily page), latency of each request
+    bot      queries of the telegram bot of cbr_xml.py (last rates, rates on dates, cross rates) from 4 threads
+and reports requests/s, rows/s, p50/p99 latency and peak RSS.
+Usage: python benchmarks/e2e_benchmark.py [--latency MS] [--years N] [--days N] [--queries N] [--paths period,...]
+"""
+import argparse
+import datetime
+import json
+import os
+import re
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlsplit
+
+
+project_dir = Path(__file__).resolve().parent.parent
+fixtures_dir = Path(__file__).resolve().parent / 'fixtures'
+paths = ('period', 'schedule', 'month', 'bot')
+record_regexp = re.compile(rb'<Record Date="(\d{2})\.(\d{2})\.(\d{4})".*?</Record>')
+
+
+def parse_date(date_str: str) -> datetime.date:
+    return datetime.datetime.strptime(date_str.replace('/', '.'), '%d.%m.%Y').date()
+
+
+def replay_dynamic(fixture: bytes, from_date: datetime.date, to_date: datetime.date) -> bytes:
+    """Returns XML_dynamic fixture with records moved to the requested period, records after its end are dropped."""
+    records = list(record_regexp.finditer(fixture))
+    if not records:
+        return fixture
+    first_date = datetime.date(*map(int, records[0].group(3, 2, 1)))
+    shift = from_date - first_date
+    body = [fixture[:records[0].start()]]
+    for record in records:
+        record_date = datetime.date(*map(int, record.group(3, 2, 1))) + shift
+        if record_date > to_date:
+            break
+        body.append(record.group(0)[:14] + f'{record_date:%d.%m.%Y}'.encode() + record.group(0)[24:])
+    body.append(b'</ValCurs>')
+    return b''.join(body)
+
+
+def create_server(latency: float) -> ThreadingHTTPServer:
+    """Returns stand-in server of the source replaying the fixtures, each response is delayed by "latency" seconds."""
+    daily_xml = (fixtures_dir / 'XML_daily.xml').read_bytes()
+    dynamic_xml = (fixtures_dir / 'XML_dynamic.xml').read_bytes()
+    daily_html = (fixtures_dir / 'daily.html').read_bytes()
+
+    class CbrHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'  # keep-alive for the connection pool of cbr_http
+        disable_nagle_algorithm = True  # headers and body are separate writes, don't wait for the delayed ACK
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            query = {key: values[0] for key, values in parse_qs(url.query).items()}
+            if url.path == '/scripts/XML_daily.asp':
+                body = daily_xml.replace(b'Date="19.02.2022"', f'Date="{parse_date(query["date_req"]):%d.%m.%Y}"'.encode())
+            elif url.path == '/scripts/XML_dynamic.asp':
+                body = replay_dynamic(dynamic_xml, parse_date(query['date_req1']), parse_date(query['date_req2']))
+            elif url.path == '/currency_base/daily/':
+                body = daily_html.replace('на 19.02.2022'.encode(),
+                                          f'на {parse_date(query["UniDbQuery.To"]):%d.%m.%Y}'.encode())
+            else:
+                self.send_error(404)
+                return
+            time.sleep(latency)
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return ThreadingHTTPServer(('127.0.0.1', 0), CbrHandler)
+
+
+def count_calls(module, name: str, latencies: list) -> None:
+    """Replaces function of the module by a wrapper appending latency of each call to the list."""
+    func = getattr(module, name)
+
+    def wrapper(*args, **kwargs):
+        start_time = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - start_time)
+    setattr(module, name, wrapper)
+
+
+def run_path(path: str, scratch_dir: str, input_args) -> dict:
+    """Runs the path in this process and returns its results, the cbr modules are imported here,
+    after the environment points them to the stand-in server and the scratch folder."""
+    sys.path.insert(0, str(project_dir))
+    import cbr_xml
+    import cbr_usd_eur
+    cbr_xml.path_to_database = os.path.join(scratch_dir, 'cbr_ru.db')
+    cbr_usd_eur.path_to_database = os.path.join(scratch_dir, 'usd_eur.db')
+    cbr_usd_eur.path_to_calendar = os.path.join(scratch_dir, 'publication_calendar.json')
+    requests = list()
+    latencies = list()
+    last_date = datetime.date(2021, 12, 31)
+
+    def count_rates_rows() -> int:
+        return cbr_xml.get_session().query(cbr_xml.Rate).count()
+
+    start_time = time.perf_counter()
+    if path in ('period', 'bot'):
+        count_calls(cbr_xml, 'fetch', requests)
+        first_date = datetime.date(last_date.year - input_args.years + 1, 1, 1)
+        cbr_xml.process_mode_period(f'{first_date:%d/%m/%Y}-{last_date:%d/%m/%Y}')
+        if path == 'period':
+            latencies = requests
+            rows_number = count_rates_rows()
+        else:
+            import cbr_analytics
+            cbr_analytics.path_to_database = cbr_xml.path_to_database
+            stored_dates = [rate_date for rate_date, in cbr_xml.get_session().query(cbr_xml.Rate.request_date)]
+            cbr_xml.release_session()
+            queries = [(i % 3, stored_dates[i * 7919 % len(stored_dates)]) for i in range(input_args.queries)]
+
+            def bot_query(query: tuple) -> None:
+                query_type, query_date = query
+                query_start = time.perf_counter()
+                if query_type == 0:
+                    cbr_xml.rates_cache.last_rate('USD')
+                elif query_type == 1:
+                    cbr_xml.rates_cache.rate_on_date('EUR', f'{query_date:%d.%m.%Y}')
+                else:
+                    cbr_analytics.get_cross_rate('EUR', 'USD', query_date)
+                latencies.append(time.perf_counter() - query_start)
+
+            start_time = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                list(executor.map(bot_query, queries))
+            requests = list()
+            rows_number = 0
+    elif path == 'schedule':
+        count_calls(cbr_xml, 'fetch', requests)
+        count_calls(cbr_xml, 'get_rates_and_add_to_db', latencies)
+        for day in range(input_args.days):
+            cbr_xml.get_rates_and_add_to_db(f'{last_date - datetime.timedelta(days=day):%d/%m/%Y}')
+        rows_number = count_rates_rows()
+    else:  # path == 'month'
+        count_calls(cbr_usd_eur, 'fetch', requests)
+        latencies = requests
+        for month in range(1, 13):
+            cbr_usd_eur.scrapy_month(month, last_date.year, workers=10, requests_per_sec=0)
+        rows_number = sum(cbr_usd_eur.get_session().query(currency_name).count()
+                          for currency_name in (cbr_usd_eur.USD, cbr_usd_eur.EUR))
+    elapsed_time = time.perf_counter() - start_time
+    latencies = sorted(latencies)
+    return {'path': path, 'elapsed': elapsed_time, 'requests': len(requests), 'rows': rows_number,
+            'operations': len(latencies),
+            'p50': statistics.median(latencies) if latencies else None,
+            'p99': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] if latencies else None,
+            'peak_rss_mib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+
+
+def format_result(result: dict) -> str:
+    elapsed_time = result['elapsed']
+    latency = (f'p50 {result["p50"] * 1000:.2f} ms, p99 {result["p99"] * 1000:.2f} ms'
+               if result['p50'] is not None else 'no operations')
+    return (f'{result["path"]:9} {elapsed_time:7.2f} s, {result["requests"]} requests '
+            f'({result["requests"] / elapsed_time:.1f} req/s), {result["rows"]} rows '
+            f'({result["rows"] / elapsed_time:.0f} rows/s), {result["operations"]} operations '
+            f'({result["operations"] / elapsed_time:.0f} op/s), {latency}, peak RSS {result["peak_rss_mib"]:.1f} MiB')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end benchmark with a local stand-in of www.cbr.ru')
+    parser.add_argument('--latency', type=float, default=20, help='Latency of each response of the server in ms')
+    parser.add_argument('--years', type=int, default=10, help='Number of years requested by "period" and "bot"')
+    parser.add_argument('--days', type=int, default=60, help='Number of days requested by "schedule"')
+    parser.add_argument('--queries', type=int, default=5000, help='Number of queries of "bot"')
+    parser.add_argument('--paths', type=str, default=','.join(paths), help='Paths to run, e.g. "period,bot"')
+    parser.add_argument('--run-path', type=str, default=None, help=argparse.SUPPRESS)  # used for the child process
+    input_args = parser.parse_args()
+
+    if input_args.run_path:
+        print(json.dumps(run_path(input_args.run_path, os.environ['CBR_BENCHMARK_DIR'], input_args)))
+        return
+
+    server = create_server(input_args.latency / 1000)
+    threading.Thread(target=server.serve_forever, name='cbr-stand-in', daemon=True).start()
+    for path in input_args.paths.split(','):
+        with tempfile.TemporaryDirectory(prefix=f'cbr_benchmark_{path}_') as scratch_dir:
+            env = {**os.environ, 'PYTHONWARNINGS': 'ignore', 'CBR_BENCHMARK_DIR': scratch_dir,
+                   'CBR_BASE_URL': f'http://127.0.0.1:{server.server_port}',
+                   'CBR_CACHE_DIR': os.path.join(scratch_dir, 'http_cache')}
+            completed = subprocess.run([sys.executable, __file__, *sys.argv[1:], '--run-path', path], env=env,
+                                       capture_output=True, text=True)
+            if completed.returncode != 0:
+                sys.exit(f'Error! Path {path} failed:\n{completed.stdout}{completed.stderr}')
+            print(format_result(json.loads(completed.stdout.splitlines()[-1])))
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""
+Parsing benchmark of the documents of the source: lxml parsers of "cbr_parsers.py"
+against the former BeautifulSoup parsing, on the saved documents in "benchmarks/fixtures".
+
+Checks that both parsers return the same rates and reports time per document.
+Usage: python benchmarks/parsing_benchmark.py [--runs N] [--number N]
+"""
+import argparse
+import re
+import statistics
+import sys
+import timeit
+import warnings
+from pathlib import Path
+
+
+project_dir = Path(__file__).resolve().parent.parent
+fixtures_dir = Path(__file__).resolve().parent / 'fixtures'
+sys.path.insert(0, str(project_dir))
+warnings.filterwarnings('ignore', message='It looks like you')  # bs4 warns about XML parsed by the HTML parser
+
+from cbr_parsers import parse_daily_html, parse_daily_xml, parse_dynamic_xml  # noqa: E402
+
+
+def bs_daily_xml(body: bytes) -> list:
+    """BeautifulSoup parsing of XML_daily as it was done by "get_daily_xml" of "cbr_xml.py"."""
+    from bs4 import BeautifulSoup
+    daily_rates = list()
+    for valute in BeautifulSoup(body, 'lxml').find_all('valute'):
+        currency_rate = float(valute.find('value').get_text().replace(',', '.'))
+        daily_rates.append((valute.find('charcode').get_text().strip(), int(valute.find('nominal').get_text()),
+                            float(f'{currency_rate:.2f}')))
+    return daily_rates
+
+
+def bs_dynamic_xml(body: bytes) -> list:
+    """BeautifulSoup parsing of XML_dynamic as it was done by "scrapy_period" of "cbr_xml.py"."""
+    from bs4 import BeautifulSoup
+    period_rates = list()
+    for rate_info in BeautifulSoup(body, 'lxml').find_all('record'):
+        currency_rate = float(f"{float(rate_info.find('value').get_text().replace(',', '.')):.2f}")
+        period_rates.append((rate_info.get('date'), currency_rate, int(rate_info.find('nominal').get_text())))
+    return period_rates
+
+
+def bs_daily_html(body: bytes, currency_names: tuple = ('USD', 'EUR')) -> tuple:
+    """BeautifulSoup parsing of the daily page as it was done by "get_rates" of "cbr_usd_eur.py"."""
+    from bs4 import BeautifulSoup
+    bs_obj = BeautifulSoup(body, 'lxml')
+    rates = dict()
+    for currency_name in currency_names:
+        currency_rate = bs_obj.find('td', string={currency_name}).parent.find_all('td')[4].get_text().replace(',', '.')
+        rates[currency_name] = float(format(float(currency_rate), '.2f'))
+    site_date = re.search(r'(?P<only_date>\d{2}.\d{2}.\d{4})', bs_obj.find('h2', class_='h3').get_text())
+    return rates, site_date.group('only_date')
+
+
+def lxml_daily_xml(body: bytes) -> list:
+    return [(rate_info.char_code, rate_info.nominal, rate_info.currency_rate) for rate_info in parse_daily_xml(body)]
+
+
+def lxml_dynamic_xml(body: bytes) -> list:
+    return [(f'{rate_info.request_date:%d.%m.%Y}', rate_info.currency_rate, rate_info.nominal)
+            for rate_info in parse_dynamic_xml(body)]
+
+
+def lxml_daily_html(body: bytes, currency_names: tuple = ('USD', 'EUR')) -> tuple:
+    site_date, daily_rates = parse_daily_html(body)
+    page_rates = {rate_info.char_code: rate_info.currency_rate for rate_info in daily_rates}
+    return {currency_name: page_rates[currency_name] for currency_name in currency_names}, site_date
+
+
+# document -> (fixture file, BeautifulSoup parser, lxml parser)
+documents = {
+    'XML_daily': ('XML_daily.xml', bs_daily_xml, lxml_daily_xml),
+    'XML_dynamic': ('XML_dynamic.xml', bs_dynamic_xml, lxml_dynamic_xml),
+    'daily_html': ('daily.html', bs_daily_html, lxml_daily_html),
+}
+
+
+def measure(parser, body: bytes, runs: int, number: int) -> list:
+    """Returns list of mean times in seconds of one parsing, "number" parsings in each of "runs" runs."""
+    return [time_sum / number for time_sum in timeit.repeat(lambda: parser(body), repeat=runs, number=number)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Parsing benchmark of BeautifulSoup and lxml parsers')
+    parser.add_argument('--runs', type=int, default=5, help='Number of runs for each document')
+    parser.add_argument('--number', type=int, default=50, help='Number of parsings in each run')
+    input_args = parser.parse_args()
+
+    for document, (file_name, bs_parser, lxml_parser) in documents.items():
+        body = (fixtures_dir / file_name).read_bytes()
+        if bs_parser(body) != lxml_parser(body):
+            sys.exit(f'Error! Parsers return different results for {file_name}')
+        bs_times = measure(bs_parser, body, input_args.runs, input_args.number)
+        lxml_times = measure(lxml_parser, body, input_args.runs, input_args.number)
+        print(f'{document} ({len(body) / 1024:.1f} KiB): '
+              f'BeautifulSoup median {statistics.median(bs_times) * 1000:.3f} ms, '
+              f'lxml median {statistics.median(lxml_times) * 1000:.3f} ms, '
+              f'speedup x{statistics.median(bs_times) / statistics.median(lxml_times):.1f}')
+
+
+if __name__ == '__main__':
+    main()
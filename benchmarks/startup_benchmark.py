@@ -0,0 +1,62 @@
+"""
+Cold start benchmark of the scripts for cron-style invocations.
+
+Runs every script in a fresh interpreter with "python -X importtime" and reports
+wall time of "--help" (import of the script and argument parsing) and the heaviest imports.
+Usage: python benchmarks/startup_benchmark.py [--runs N] [--top N]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+
+project_dir = Path(__file__).resolve().parent.parent
+scripts = ('cbr_xml.py', 'cbr_usd_eur.py')
+
+
+def parse_importtime(stderr: str) -> list:
+    """Returns list of (cumulative microseconds, module name) from the "-X importtime" output."""
+    imports = list()
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, module_name = line[len('import time:'):].split('|')
+        imports.append((int(cumulative), module_name.rstrip()))
+    return imports
+
+
+def measure_script(script: str, runs: int) -> tuple:
+    """Returns list of wall times in seconds of "script --help" and imports of the last run."""
+    wall_times = list()
+    imports = list()
+    for _ in range(runs):
+        start_time = time.perf_counter()
+        completed = subprocess.run([sys.executable, '-X', 'importtime', script, '--help'], cwd=project_dir,
+                                   capture_output=True, text=True, env={**os.environ, 'PYTHONWARNINGS': 'ignore'})
+        wall_times.append(time.perf_counter() - start_time)
+        imports = parse_importtime(completed.stderr)
+    return wall_times, imports
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cold start benchmark of cbr_xml.py and cbr_usd_eur.py')
+    parser.add_argument('--runs', type=int, default=5, help='Number of runs of each script')
+    parser.add_argument('--top', type=int, default=10, help='Number of the heaviest top-level imports to show')
+    input_args = parser.parse_args()
+
+    for script in scripts:
+        wall_times, imports = measure_script(script, input_args.runs)
+        top_level = [(cumulative, name.strip()) for cumulative, name in imports if not name.startswith('  ')]
+        print(f'{script}: median {statistics.median(wall_times) * 1000:.1f} ms, '
+              f'min {min(wall_times) * 1000:.1f} ms over {len(wall_times)} runs, '
+              f'imports {sum(cumulative for cumulative, _ in top_level) / 1000:.1f} ms')
+        for cumulative, name in sorted(top_level, reverse=True)[:input_args.top]:
+            print(f'    {cumulative / 1000:8.1f} ms  {name}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,277 @@
+"""
+Time-series analytics and cross rates of the rates stored by "cbr_xml.py" in the table "rates".
+History of a currency is loaded into contiguous NumPy arrays: dates as int32 days since 1970-01-01
+and rates per one unit of the currency (rate / nominal) as float64, ordered by date.
+Loaded histories are cached until the rows of the currency change in the database.
+Rolling functions return arrays of the same length as the history, positions without a full window are NaN.
+Cross rates of all currencies on a date are precomputed once into a matrix, so any pair is looked up in O(1)
+from memory, the matrices are cleared by the ingest of "cbr_xml.py" after each commit.
+"""
+import datetime
+import os
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from sqlalchemy import text
+
+from cbr_db import create_sqlite_engine
+
+
+script_dir = Path(__file__).resolve().parent  # path to the folder with 'cbr_analytics.py'
+path_to_database = os.path.join(script_dir, 'rates_db', 'cbr_ru.db')  # the database of 'cbr_xml.py'
+_db_engine = None
+_db_lock = threading.Lock()
+epoch = datetime.date(1970, 1, 1)
+history_sql = text('SELECT request_date, currency_rate, nominal FROM rates '
+                   'WHERE char_code = :char_code AND currency_rate IS NOT NULL ORDER BY request_date')
+# cheap check of new data, the rows of the currency are found by the primary key index
+version_sql = text('SELECT count(*), max(request_date), max(scraping_datetime) FROM rates WHERE char_code = :char_code')
+# rates of all currencies on the last date of rating not later than the given one
+rates_on_date_sql = text('SELECT char_code, currency_rate, nominal, request_date FROM rates '
+                         'WHERE currency_rate IS NOT NULL '
+                         'AND request_date = (SELECT max(request_date) FROM rates WHERE request_date <= :input_date) '
+                         'ORDER BY char_code')
+
+
+def get_db_engine() -> 'sqlalchemy.engine.Engine':
+    """Returns engine of the database of 'cbr_xml.py', created on first use."""
+    global _db_engine
+    with _db_lock:
+        if _db_engine is None:
+            _db_engine = create_sqlite_engine(path_to_database)
+        return _db_engine
+
+
+def to_days(input_date: datetime.date or str) -> int:
+    """Returns number of days since 1970-01-01 for the date or ISO date string."""
+    if isinstance(input_date, str):
+        input_date = datetime.date.fromisoformat(input_date)
+    return input_date.toordinal() - epoch.toordinal()
+
+
+def from_days(days: int) -> datetime.date:
+    """Returns date for number of days since 1970-01-01."""
+    return datetime.date.fromordinal(epoch.toordinal() + int(days))
+
+
+class HistoryCache:
+    """
+    Cache of the loaded histories {char code: (version, days, rates)}.
+    "version" is (number of rows, last date, last time of scraping) of the currency,
+    the history is loaded again when it differs, i.e. when new rates are added or existing ones are updated.
+    """
+    def __init__(self):
+        self.histories = dict()
+        self.lock = threading.Lock()
+
+    def get(self, char_code: str) -> tuple:
+        """Returns (days, rates) arrays of the currency, read from the database if there is new data."""
+        with get_db_engine().connect() as connection:
+            version = tuple(connection.execute(version_sql, {'char_code': char_code}).one())
+            with self.lock:
+                cached = self.histories.get(char_code)
+            if cached is not None and cached[0] == version:
+                return cached[1], cached[2]
+            rows = connection.execute(history_sql, {'char_code': char_code}).fetchall()
+        # ISO dates are converted by NumPy at once, datetime64[D] counts days since 1970-01-01
+        days = np.array([request_date for request_date, _, _ in rows], dtype='datetime64[D]').astype(np.int32)
+        rates = np.fromiter((currency_rate / (nominal or 1) for _, currency_rate, nominal in rows),
+                            dtype=np.float64, count=len(rows))
+        days.flags.writeable = False  # arrays are shared by all callers
+        rates.flags.writeable = False
+        with self.lock:
+            self.histories[char_code] = (version, days, rates)
+        return days, rates
+
+    def invalidate(self) -> None:
+        with self.lock:
+            self.histories.clear()
+
+
+history_cache = HistoryCache()
+
+
+def load_history(char_code: str) -> tuple:
+    """Returns (days, rates) of the currency: int32 days since 1970-01-01 and float64 rates per one unit."""
+    return history_cache.get(char_code)
+
+
+def select_range(days: np.ndarray, rates: np.ndarray, from_date: datetime.date, to_date: datetime.date) -> tuple:
+    """Returns (days, rates) views for the dates from "from_date" to "to_date" inclusive, found by binary search."""
+    start = np.searchsorted(days, to_days(from_date), side='left')
+    end = np.searchsorted(days, to_days(to_date), side='right')
+    return days[start:end], rates[start:end]
+
+
+def rolling_windows(rates: np.ndarray, window: int) -> np.ndarray:
+    """Returns 2D view of the rates, row i is the window ending at position i + window - 1."""
+    if window < 1:
+        raise ValueError('Window must be positive')
+    return sliding_window_view(rates, window)
+
+
+def pad_front(values: np.ndarray, length: int) -> np.ndarray:
+    """Returns values aligned to the end of an array of the given length, the front is filled with NaN."""
+    result = np.full(length, np.nan)
+    if len(values):
+        result[length - len(values):] = values
+    return result
+
+
+def moving_average(rates: np.ndarray, window: int) -> np.ndarray:
+    """Returns simple moving average over "window" rates, computed by cumulative sums."""
+    if window < 1:
+        raise ValueError('Window must be positive')
+    if len(rates) < window:
+        return np.full(len(rates), np.nan)
+    cumulative = np.cumsum(np.concatenate(([0.0], rates)))
+    return pad_front((cumulative[window:] - cumulative[:-window]) / window, len(rates))
+
+
+def rolling_min(rates: np.ndarray, window: int) -> np.ndarray:
+    """Returns minimum over "window" rates."""
+    if len(rates) < window:
+        return np.full(len(rates), np.nan)
+    return pad_front(rolling_windows(rates, window).min(axis=1), len(rates))
+
+
+def rolling_max(rates: np.ndarray, window: int) -> np.ndarray:
+    """Returns maximum over "window" rates."""
+    if len(rates) < window:
+        return np.full(len(rates), np.nan)
+    return pad_front(rolling_windows(rates, window).max(axis=1), len(rates))
+
+
+def log_returns(rates: np.ndarray) -> np.ndarray:
+    """Returns logarithmic changes between consecutive rates, one element shorter than the rates."""
+    return np.diff(np.log(rates))
+
+
+def rolling_volatility(rates: np.ndarray, window: int, annualize: int or None = None) -> np.ndarray:
+    """Returns standard deviation of log returns over "window" returns (sample, ddof=1),
+    multiplied by sqrt("annualize") if it is given, e.g. 250 days of publication per year."""
+    if window < 2:
+        raise ValueError('Window of volatility must be at least 2')
+    returns = log_returns(rates)
+    if len(returns) < window:
+        return np.full(len(rates), np.nan)
+    volatility = rolling_windows(returns, window).std(axis=1, ddof=1)
+    if annualize:
+        volatility = volatility * np.sqrt(annualize)
+    return pad_front(volatility, len(rates))
+
+
+def period_change(days: np.ndarray, rates: np.ndarray, period_days: int) -> np.ndarray:
+    """Returns relative change of each rate to the last rate at least "period_days" calendar days before it,
+    e.g. 7 for week-over-week or 365 for year-over-year, NaN if the history doesn't reach back so far."""
+    previous = np.searchsorted(days, days - period_days, side='right') - 1
+    has_previous = previous >= 0
+    result = np.full(len(rates), np.nan)
+    result[has_previous] = rates[has_previous] / rates[previous[has_previous]] - 1
+    return result
+
+
+def range_stats(days: np.ndarray, rates: np.ndarray, from_date: datetime.date, to_date: datetime.date) -> dict:
+    """Returns aggregates of the rates for the dates from "from_date" to "to_date":
+    number of rates, first and last date and rate, min, max, mean, standard deviation and relative change."""
+    range_days, range_rates = select_range(days, rates, from_date, to_date)
+    if not len(range_rates):
+        return {'count': 0}
+    return {'count': len(range_rates),
+            'first_date': from_days(range_days[0]), 'last_date': from_days(range_days[-1]),
+            'first': float(range_rates[0]), 'last': float(range_rates[-1]),
+            'min': float(range_rates.min()), 'max': float(range_rates.max()),
+            'min_date': from_days(range_days[range_rates.argmin()]),
+            'max_date': from_days(range_days[range_rates.argmax()]),
+            'mean': float(range_rates.mean()),
+            'std': float(range_rates.std(ddof=1)) if len(range_rates) > 1 else 0.0,
+            'change': float(range_rates[-1] / range_rates[0] - 1)}
+
+
+class CrossRateMatrix:
+    """
+    Cross rates of all currencies published on one date, including RUB.
+    "matrix[i, j]" is number of units of currency j for one unit of currency i, it is computed at once
+    by division of the vector of RUB rates per one unit (rate / nominal) by itself.
+    """
+    def __init__(self, rate_date: datetime.date, char_codes: list, rub_rates: np.ndarray):
+        self.rate_date = rate_date
+        self.char_codes = tuple(char_codes) + ('RUB',)
+        self.index = {char_code: i for i, char_code in enumerate(self.char_codes)}
+        rub_rates = np.append(rub_rates, 1.0)
+        self.matrix = rub_rates[:, np.newaxis] / rub_rates[np.newaxis, :]
+        self.matrix.flags.writeable = False
+
+    def rate(self, base: str, quote: str) -> float or None:
+        """Returns number of units of "quote" for one unit of "base", None if one of them has no rate."""
+        i = self.index.get(base)
+        j = self.index.get(quote)
+        if i is None or j is None:
+            return None
+        return float(self.matrix[i, j])
+
+
+class CrossRateCache:
+    """
+    LRU cache of the matrices of cross rates {date: (time of caching, matrix)} up to "max_size" dates.
+    A cached matrix is served from memory without querying the database, the cache is cleared by invalidate()
+    after new rates are written, "max_age" (seconds) limits lifetime of matrices for the case of rows
+    written by another process.
+    """
+    def __init__(self, max_size: int = 64, max_age: float = 60):
+        self.max_size = max_size
+        self.max_age = max_age
+        self.matrices = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, input_date: datetime.date) -> CrossRateMatrix or None:
+        """Returns matrix of cross rates on the last date of rating not later than the given date,
+        the database is queried on cache miss only."""
+        with self.lock:
+            cached = self.matrices.get(input_date)
+            if cached is not None and time.monotonic() - cached[0] < self.max_age:
+                self.matrices.move_to_end(input_date)
+                return cached[1]
+        with get_db_engine().connect() as connection:
+            rows = connection.execute(rates_on_date_sql, {'input_date': input_date.isoformat()}).fetchall()
+        if not rows:
+            return None
+        rub_rates = np.fromiter((currency_rate / (nominal or 1) for _, currency_rate, nominal, _ in rows),
+                                dtype=np.float64, count=len(rows))
+        cross_rates = CrossRateMatrix(datetime.date.fromisoformat(rows[0][3]),
+                                      [char_code for char_code, _, _, _ in rows], rub_rates)
+        with self.lock:
+            self.matrices[input_date] = (time.monotonic(), cross_rates)
+            self.matrices.move_to_end(input_date)
+            while len(self.matrices) > self.max_size:
+                self.matrices.popitem(last=False)
+        return cross_rates
+
+    def invalidate(self) -> None:
+        with self.lock:
+            self.matrices.clear()
+
+
+cross_rate_cache = CrossRateCache()
+
+
+def get_cross_matrix(input_date: datetime.date or None = None) -> CrossRateMatrix or None:
+    """Returns matrix of cross rates on the date (today by default) or the last date of rating before it,
+    None if there are no rates."""
+    return cross_rate_cache.get(input_date or datetime.date.today())
+
+
+def get_cross_rate(base: str, quote: str, input_date: datetime.date or None = None) -> float and datetime.date:
+    """Returns number of units of "quote" for one unit of "base" (e.g. 'EUR', 'USD' -> USD per EUR)
+    and the date of rating, (None, None) if there are no rates of the currencies."""
+    cross_rates = get_cross_matrix(input_date)
+    if cross_rates is None:
+        return None, None
+    cross_rate = cross_rates.rate(base.upper(), quote.upper())
+    if cross_rate is None:
+        return None, None
+    return cross_rate, cross_rates.rate_date
@@ -0,0 +1,224 @@
+"""
+Read-only HTTP/JSON API over the query functions of "cbr_xml.py", for services which need rates
+without opening the database file. Dates are in ISO format 'YYYY-MM-DD', rates are stored ones (for the nominal).
+    GET /latest?currencies=USD,EUR                                last stored rate, date and dynamics of the currencies
+    GET /rates?date=YYYY-MM-DD[&currencies=USD,EUR]               rates on the date, of all currencies by default
+    GET /rates?dates=YYYY-MM-DD,YYYY-MM-DD,...&currencies=USD,EUR rates on many dates by one call
+    GET /rates?from=YYYY-MM-DD&to=YYYY-MM-DD&currencies=USD,EUR   rates for the period by one call
+Responses have a strong ETag, a request with the same "If-None-Match" gets 304 without body.
+Complete answers only about past dates (every requested currency has a rate on every day of publication)
+never change, they are cacheable by clients and proxies for a year, the others for "recent_max_age" seconds,
+so gaps filled by a later backfill are seen. Encoded responses are kept in an LRU cache for the same time,
+so repeated requests don't touch the database, and connections are kept alive (HTTP/1.1).
+"""
+import datetime
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, NamedTuple
+from urllib.parse import parse_qs, urlsplit
+
+from cbr_metrics import inc, observe
+
+
+historical_max_age = 365 * 24 * 3600  # seconds, rates on past dates never change
+recent_max_age = 60  # seconds, rates on today and the latest rates can still change
+max_dates = 1000  # limit of dates of one call with "dates"
+
+
+class RatesQueries(NamedTuple):
+    """Query functions of the script the API is served over, each one releases its database session."""
+    last_rate: Callable  # char code -> (rate, date, dynamics), (None, None, None) if there are no rates
+    rates_on_date: Callable  # date -> {char code: rate}
+    rates_for_period: Callable  # char code, first date, last date -> list of (date, rate) in order of dates
+    default_currencies: tuple = ('USD', 'EUR')
+    is_publishing_day: Callable or None = None  # date -> bool, without it answers about periods are never complete
+
+
+class ResponseCache:
+    """
+    LRU cache of the encoded responses {path with query: (expiry time, status, body, ETag, Cache-Control)}
+    up to "max_size" entries, each entry lives as long as its Cache-Control allows.
+    """
+    def __init__(self, max_size: int = 1024):
+        self.max_size = max_size
+        self.responses = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: str) -> tuple or None:
+        with self.lock:
+            cached = self.responses.get(key)
+            if cached is None or cached[0] < time.monotonic():
+                return None
+            self.responses.move_to_end(key)
+            return cached[1:]
+
+    def put(self, key: str, response: tuple, max_age: float) -> None:
+        with self.lock:
+            self.responses[key] = (time.monotonic() + min(max_age, historical_max_age), *response)
+            self.responses.move_to_end(key)
+            while len(self.responses) > self.max_size:
+                self.responses.popitem(last=False)
+
+    def invalidate(self) -> None:
+        with self.lock:
+            self.responses.clear()
+
+
+class BadRequest(ValueError):
+    """Invalid parameters of the request, answered with status 400."""
+
+
+def parse_date(date_str: str) -> datetime.date:
+    try:
+        return datetime.date.fromisoformat(date_str)
+    except ValueError:
+        raise BadRequest(f'Invalid date: {date_str}, the format is YYYY-MM-DD') from None
+
+
+def parse_currencies(query: dict, default: tuple or None) -> tuple or None:
+    if 'currencies' not in query:
+        return default
+    return tuple(char_code.strip().upper() for char_code in query['currencies'].split(',') if char_code.strip())
+
+
+def to_source_date(input_date: datetime.date) -> str:
+    """Returns date in format 'DD.MM.YYYY' of the query functions."""
+    return f'{input_date:%d.%m.%Y}'
+
+
+def is_complete(queries: RatesQueries, dates, stored_dates: dict) -> bool:
+    """Returns True if each currency {char code: set of dates with rates} has rates on all days of publication
+    among the dates, so a later ingest can't change the answer."""
+    if queries.is_publishing_day is None or not stored_dates:
+        return False
+    dates_of_all = set.intersection(*stored_dates.values())
+    # only days missing for some currency are checked by the calendar
+    return not any(queries.is_publishing_day(input_date) for input_date in dates if input_date not in dates_of_all)
+
+
+def answer(queries: RatesQueries, path: str, query: dict) -> tuple:
+    """Returns (status, JSON-serializable data, the last date the answer is about if the answer is complete,
+    None for the latest rates and incomplete answers, which can still change)."""
+    if path == '/latest':
+        latest = dict()
+        for char_code in parse_currencies(query, queries.default_currencies):
+            rate, rate_date, dynamics = queries.last_rate(char_code)
+            if rate is not None:
+                latest[char_code] = {'rate': rate, 'date': rate_date.isoformat(), 'dynamics': dynamics}
+        return 200, latest, None
+    if path != '/rates':
+        return 404, {'error': f'Unknown path {path}'}, None
+
+    if 'date' in query:
+        input_date = parse_date(query['date'])
+        currencies = parse_currencies(query, None)
+        rates = queries.rates_on_date(to_source_date(input_date))
+        if currencies is not None:
+            rates = {char_code: rates[char_code] for char_code in currencies if char_code in rates}
+        # a missing currency can be added by a later ingest, so such answer isn't cached for long;
+        # without "currencies" the answer has all stored currencies, which a later ingest can extend
+        complete = bool(currencies) and all(char_code in rates for char_code in currencies)
+        return 200, {'date': input_date.isoformat(), 'rates': rates}, input_date if complete else None
+
+    currencies = parse_currencies(query, queries.default_currencies)
+    if 'dates' in query:
+        dates = sorted({parse_date(date_str) for date_str in query['dates'].split(',') if date_str})
+        if not dates or len(dates) > max_dates:
+            raise BadRequest(f'Give from 1 to {max_dates} dates')
+        from_date, to_date = dates[0], dates[-1]
+    elif 'from' in query and 'to' in query:
+        dates = None
+        from_date, to_date = parse_date(query['from']), parse_date(query['to'])
+        if from_date > to_date:
+            raise BadRequest('"from" is later than "to"')
+    else:
+        raise BadRequest('Give "date", "dates" or "from" and "to"')
+    # each currency is read by one indexed range query, the requested dates are picked from it
+    rates = dict()
+    stored_dates = dict()
+    requested = set(dates or ())
+    for char_code in currencies:
+        period_rates = queries.rates_for_period(char_code, to_source_date(from_date), to_source_date(to_date))
+        if dates is not None:
+            period_rates = [(rate_date, rate) for rate_date, rate in period_rates if rate_date in requested]
+        rates[char_code] = [[rate_date.isoformat(), rate] for rate_date, rate in period_rates]
+        stored_dates[char_code] = {rate_date for rate_date, _ in period_rates}
+    if dates is None:
+        dates = [from_date + datetime.timedelta(days=day) for day in range((to_date - from_date).days + 1)]
+    return (200, {'from': from_date.isoformat(), 'to': to_date.isoformat(), 'rates': rates},
+            to_date if is_complete(queries, dates, stored_dates) else None)
+
+
+def encode_response(status: int, data, last_date: datetime.date or None) -> tuple:
+    """Returns (status, body, ETag, Cache-Control) of the answer."""
+    body = json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode()
+    etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+    if status != 200:
+        cache_control = 'no-store'
+    elif last_date is not None and last_date < datetime.date.today():
+        cache_control = f'public, max-age={historical_max_age}, immutable'
+    else:
+        cache_control = f'public, max-age={recent_max_age}'
+    return status, body, etag, cache_control
+
+
+def max_age_of(cache_control: str) -> float:
+    for directive in cache_control.split(','):
+        name, _, value = directive.strip().partition('=')
+        if name == 'max-age':
+            return float(value)
+    return 0
+
+
+def create_api_server(queries: RatesQueries, host: str = '127.0.0.1', port: int = 8080,
+                      response_cache: ResponseCache or None = None) -> ThreadingHTTPServer:
+    """Returns HTTP server of the API, it is started by serve_forever()."""
+    response_cache = response_cache or ResponseCache()
+
+    class ApiHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'  # connections are kept alive between requests
+        disable_nagle_algorithm = True  # headers and body are separate writes, don't wait for the delayed ACK
+
+        def do_GET(self):
+            start_time = time.perf_counter()
+            response = response_cache.get(self.path)
+            if response is None:
+                inc('cbr_api_cache_misses_total')
+                url = urlsplit(self.path)
+                query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+                try:
+                    response = encode_response(*answer(queries, url.path, query))
+                except BadRequest as err:
+                    response = encode_response(400, {'error': str(err)}, None)
+                except (Exception, SystemExit) as err:  # the query functions call sys.exit() on database errors
+                    response = encode_response(500, {'error': str(err)}, None)
+                max_age = max_age_of(response[3])
+                if max_age:
+                    response_cache.put(self.path, response, max_age)
+            else:
+                inc('cbr_api_cache_hits_total')
+            status, body, etag, cache_control = response
+            not_modified = status == 200 and etag in (self.headers.get('If-None-Match') or '')
+            self.send_response(304 if not_modified else status)
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', cache_control)
+            if not_modified:
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+            else:
+                self.send_header('Content-Type', 'application/json; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            observe('cbr_api_request_seconds', time.perf_counter() - start_time, status=status)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), ApiHandler)
+    server.daemon_threads = True
+    return server
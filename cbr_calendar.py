@@ -0,0 +1,90 @@
+import datetime
+import json
+import os
+import threading
+
+
+class PublicationCalendar:
+    """
+    Calendar of days when the source publishes new rates, learned from dates of rating given by the source.
+    The source returns the last published rates for a day without publication (weekends and holidays),
+    so the requested date is a day without publication if the date of rating differs from it.
+    Only days known to be without publication are skipped, days not seen yet are always requested.
+    "path" is JSON file the calendar is cached in between runs
+    "min_samples" is number of known days of a weekday needed to predict publication on an unseen day of it
+    """
+    def __init__(self, path: str, min_samples: int = 8):
+        self.path = path
+        self.min_samples = min_samples
+        self.published = set()
+        self.not_published = set()
+        self.changed = False
+        self.weekday_counts = None  # [(published, not published) of each weekday], counted on first prediction
+        self.lock = threading.Lock()
+
+    def load(self) -> bool:
+        """Reads the cached calendar, returns False if there is no cache."""
+        try:
+            with open(self.path) as calendar_file:
+                calendar_data = json.load(calendar_file)
+        except (OSError, ValueError):
+            return False
+        with self.lock:
+            self.published = {datetime.date.fromisoformat(day) for day in calendar_data['published']}
+            self.not_published = {datetime.date.fromisoformat(day) for day in calendar_data['not_published']}
+            self.changed = False
+            self.weekday_counts = None
+        return True
+
+    def save(self) -> None:
+        """Writes the calendar to the cache file atomically if it has been changed."""
+        with self.lock:
+            if not self.changed:
+                return
+            calendar_data = {'published': sorted(day.isoformat() for day in self.published),
+                             'not_published': sorted(day.isoformat() for day in self.not_published)}
+            self.changed = False
+        tmp_path = f'{self.path}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w') as tmp_file:
+            json.dump(calendar_data, tmp_file)
+        os.replace(tmp_path, self.path)
+
+    def learn(self, request_date: datetime.date, site_date: datetime.date) -> None:
+        """Adds the requested date and the date of rating given by the source for it:
+        the date of rating is a day with publication, days after it up to the requested date are without one.
+        Today and later days are left unknown, their rates can still be published."""
+        last_day = min(request_date, datetime.date.today() - datetime.timedelta(days=1))
+        with self.lock:
+            if site_date not in self.published:
+                self.published.add(site_date)
+                self.not_published.discard(site_date)
+                self.changed = True
+                self.weekday_counts = None
+            day = site_date + datetime.timedelta(days=1)
+            while day <= last_day:
+                if day not in self.not_published and day not in self.published:
+                    self.not_published.add(day)
+                    self.changed = True
+                    self.weekday_counts = None
+                day += datetime.timedelta(days=1)
+
+    def is_publishing_day(self, checking_date: datetime.date) -> bool:
+        """Returns False only if the date is known to be without publication, so a day not seen yet is requested."""
+        with self.lock:
+            return checking_date not in self.not_published
+
+    def expects_publication(self, checking_date: datetime.date) -> bool:
+        """Returns True if the source is expected to publish rates on the date: known days as they are learned,
+        a day not seen yet by most of the known days of its weekday if there are at least "min_samples" of them,
+        otherwise True. It decides only if missing rates of a requested day are worth waiting for."""
+        with self.lock:
+            if checking_date in self.published:
+                return True
+            if checking_date in self.not_published:
+                return False
+            if self.weekday_counts is None:
+                self.weekday_counts = [(sum(1 for day in self.published if day.weekday() == weekday),
+                                        sum(1 for day in self.not_published if day.weekday() == weekday))
+                                       for weekday in range(7)]
+            published_number, not_published_number = self.weekday_counts[checking_date.weekday()]
+        return published_number + not_published_number < self.min_samples or not_published_number <= published_number
@@ -0,0 +1,96 @@
+import functools
+import queue
+import threading
+from concurrent.futures import Future
+
+from sqlalchemy import create_engine, event
+
+
+# pragmas applied to each new SQLite connection:
+# WAL lets readers work while a writer commits, NORMAL sync is safe with WAL and fsyncs at checkpoints only
+sqlite_pragmas = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -64 * 1024,  # negative value is size in KiB, 64 MiB of page cache
+    'mmap_size': 256 * 1024 * 1024,
+    'temp_store': 'MEMORY',
+    'busy_timeout': 5000,  # ms to wait for a lock held by another connection or process
+}
+
+
+def create_sqlite_engine(path_to_database: str) -> 'sqlalchemy.engine.Engine':
+    """Returns engine for the SQLite database with "sqlite_pragmas" set on each connection."""
+    db_engine = create_engine(f'sqlite:///{path_to_database}', connect_args={'check_same_thread': False})
+
+    @event.listens_for(db_engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma, value in sqlite_pragmas.items():
+            cursor.execute(f'PRAGMA {pragma} = {value}')
+        cursor.close()
+
+    return db_engine
+
+
+class DbWriter:
+    """
+    Single writer thread of the database: all writes are queued and executed one after another,
+    so concurrent threads (bot, scheduler, backfill) never contend for the write lock.
+    "maxsize" limits the queue, callers block when it is full.
+    "on_error" is called in the writer thread after a write fails, before the caller gets the error,
+    e.g. to roll back the session of the thread, so a failed write doesn't keep the write lock
+    """
+    def __init__(self, name: str = 'db-writer', maxsize: int = 1000, on_error=None):
+        self.name = name
+        self.on_error = on_error
+        self.tasks = queue.Queue(maxsize=maxsize)
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self) -> None:
+        """Starts the writer thread if it isn't running."""
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, name=self.name, daemon=True)
+                self.thread.start()
+
+    def run(self) -> None:
+        """Executes queued writes until None is received."""
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                break
+            future, func, args, kwargs = task
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(func(*args, **kwargs))
+                except BaseException as err:  # sys.exit() of the write function is passed to the caller too
+                    if self.on_error is not None:
+                        try:
+                            self.on_error()
+                        except Exception:  # the writer thread must keep running, the caller gets the first error
+                            pass
+                    future.set_exception(err)
+
+    def submit(self, func, *args, **kwargs) -> Future:
+        """Queues the write and returns its future."""
+        self.start()
+        future = Future()
+        self.tasks.put((future, func, args, kwargs))
+        return future
+
+    def serialized(self, func):
+        """Decorator executing each call of the function in the writer thread, the caller waits for the result.
+        Calls from the writer thread itself are executed directly."""
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if threading.current_thread() is self.thread:
+                return func(*args, **kwargs)
+            return self.submit(func, *args, **kwargs).result()
+        return wrapper
+
+    def close(self) -> None:
+        """Stops the writer thread after all queued writes are executed."""
+        if self.thread is not None and self.thread.is_alive():
+            self.tasks.put(None)
+            self.thread.join()
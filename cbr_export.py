@@ -0,0 +1,178 @@
+"""
+Columnar export of the rate history of "cbr_xml.py" into memory-mapped binary files, one file per currency.
+Layout of a file (little-endian):
+    header of 64 bytes: magic b'CBRRATES', format version (uint32), char code (4 bytes),
+                        number of rows (uint64), capacity in rows (uint64),
+                        the latest exported "scraping_datetime" of the rows (32 bytes, ISO string padded with zeros)
+    column "rates"   float64[capacity] at offset 64
+    column "days"    int32[capacity] at offset 64 + 8 * capacity, days since 1970-01-01
+    column "nominal" int32[capacity] at offset 64 + 12 * capacity
+Rows are ordered by date, only the first "number of rows" values of each column are valid.
+Each export reads the rows on dates after the last exported one and the rows scraped after the latest exported
+"scraping_datetime", so rates corrected by upserts and older dates added by backfills are exported too.
+New dates are appended into the reserved capacity and the number of rows in the header is updated last,
+so a reader never sees a partly written row, corrected rates are written in place. When the capacity is exhausted
+or older dates are added the file is rewritten and replaced atomically.
+"""
+import os
+import struct
+
+import numpy as np
+from sqlalchemy import text
+
+
+magic = b'CBRRATES'
+format_version = 2
+header_format = struct.Struct('<8sI4sQQ32s')
+header_size = 64
+min_capacity = 1024
+new_rows_sql = text('SELECT request_date, currency_rate, nominal, scraping_datetime FROM rates '
+                    'WHERE char_code = :char_code AND (request_date > :last_date OR scraping_datetime >= :last_scraping) '
+                    'ORDER BY request_date')  # times of scraping are in seconds, rows of the same second are read again
+# and skipped by the export if they are equal to the exported ones
+
+
+def column_offsets(capacity: int) -> dict:
+    """Returns offsets in bytes of the columns {name: (offset, dtype)} for the capacity."""
+    return {'rates': (header_size, np.float64),
+            'days': (header_size + 8 * capacity, np.int32),
+            'nominal': (header_size + 12 * capacity, np.int32)}
+
+
+def read_header(path: str) -> tuple:
+    """Returns (char code, number of rows, capacity, the latest exported scraping datetime) from the header."""
+    with open(path, 'rb') as export_file:
+        header = export_file.read(header_format.size)
+    if len(header) < header_format.size:
+        raise ValueError(f'{path} is too short for the header')
+    file_magic, version, char_code, rows_number, capacity, last_scraping = header_format.unpack(header)
+    if file_magic != magic or version != format_version:
+        raise ValueError(f'{path} is not an export of rates of version {format_version}')
+    return char_code.rstrip(b'\0').decode(), rows_number, capacity, last_scraping.rstrip(b'\0').decode()
+
+
+def write_header(export_file, char_code: str, rows_number: int, capacity: int, last_scraping: str) -> None:
+    """Writes the header at the beginning of the opened file."""
+    export_file.seek(0)
+    export_file.write(header_format.pack(magic, format_version, char_code.encode(), rows_number, capacity,
+                                         last_scraping.encode()).ljust(header_size, b'\0'))
+
+
+def load_export(path: str) -> dict:
+    """Returns columns of the file {'days', 'rates', 'nominal'} as read-only NumPy arrays mapped to the file,
+    no data is copied."""
+    _, rows_number, capacity, _ = read_header(path)
+    columns = dict()
+    for name, (offset, dtype) in column_offsets(capacity).items():
+        columns[name] = np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(capacity,))[:rows_number]
+    return columns
+
+
+def create_file(path: str, char_code: str, capacity: int, columns: dict or None = None,
+                last_scraping: str = '') -> None:
+    """Creates the file of the capacity with the given columns, atomically replacing the existing one."""
+    tmp_path = f'{path}.tmp'
+    rows_number = len(columns['days']) if columns else 0
+    with open(tmp_path, 'wb') as export_file:
+        write_header(export_file, char_code, rows_number, capacity, last_scraping)
+        export_file.truncate(header_size + 16 * capacity)
+        for name, (offset, dtype) in column_offsets(capacity).items():
+            if rows_number:
+                export_file.seek(offset)
+                export_file.write(np.ascontiguousarray(columns[name], dtype=dtype).tobytes())
+    os.replace(tmp_path, path)
+
+
+def update_rows(path: str, char_code: str, new_columns: dict, last_scraping: str) -> tuple:
+    """Writes the rows ordered by date into the file: rates on exported dates are replaced in place,
+    later dates are appended, growing the file if needed. If there are new dates before the last exported one
+    (a backfill), the file is rewritten with the rows merged in order of dates. Rows equal to the exported ones
+    are skipped. Returns (number of rows which changed the file, number of rows in the file)."""
+    _, rows_number, capacity, exported_scraping = read_header(path)
+    exported = load_export(path)
+    positions = np.searchsorted(exported['days'], new_columns['days'])
+    exists = positions < rows_number
+    exists[exists] = exported['days'][positions[exists]] == new_columns['days'][exists]
+    changed = ~exists
+    for name in ('rates', 'nominal'):
+        exported_values = exported[name][positions[exists]]
+        new_values = new_columns[name][exists]
+        changed[exists] |= ~((exported_values == new_values) | (np.isnan(exported_values) & np.isnan(new_values)))
+    new_columns = {name: column[changed] for name, column in new_columns.items()}
+    positions = positions[changed]
+    exists = exists[changed]
+    new_days = new_columns['days']
+    if not len(new_days):
+        del exported
+        if last_scraping != exported_scraping:
+            with open(path, 'r+b') as export_file:
+                write_header(export_file, char_code, rows_number, capacity, last_scraping)
+        return 0, rows_number
+    later = new_days > exported['days'][-1] if rows_number else np.ones(len(new_days), dtype=bool)
+    new_rows_number = int(np.count_nonzero(~exists))
+    if not np.all(exists | later) or rows_number + new_rows_number > capacity:
+        kept = np.ones(rows_number, dtype=bool)
+        kept[positions[exists]] = False
+        columns = {name: np.concatenate((column[kept], new_columns[name])) for name, column in exported.items()}
+        del exported
+        order = np.argsort(columns['days'], kind='stable')
+        columns = {name: column[order] for name, column in columns.items()}
+        if len(order) > capacity:
+            capacity = max(2 * capacity, len(order))
+        create_file(path, char_code, capacity, columns, last_scraping)
+        return len(new_days), len(order)
+    del exported
+    for name, (offset, dtype) in column_offsets(capacity).items():
+        column = np.memmap(path, dtype=dtype, mode='r+', offset=offset, shape=(capacity,))
+        column[positions[exists]] = new_columns[name][exists]
+        column[rows_number:rows_number + new_rows_number] = new_columns[name][~exists]
+        column.flush()
+        del column
+    with open(path, 'r+b') as export_file:
+        write_header(export_file, char_code, rows_number + new_rows_number, capacity, last_scraping)
+        export_file.flush()
+        os.fsync(export_file.fileno())
+    return len(new_days), rows_number + new_rows_number
+
+
+def export_currency(connection: 'sqlalchemy.engine.Connection', export_dir: str, char_code: str) -> tuple:
+    """Writes to the file of the currency the rates on dates after the last exported one and the rates
+    scraped after the latest exported time of scraping (corrections and backfilled older dates).
+    Returns (number of exported rows which changed the file, number of rows in the file)."""
+    path = os.path.join(export_dir, f'{char_code}.rates')
+    last_date = '0001-01-01'
+    last_scraping = ''
+    if os.path.exists(path):
+        try:
+            _, rows_number, _, last_scraping = read_header(path)
+            exported = load_export(path)
+            if len(exported['days']):
+                last_date = str(np.datetime64(int(exported['days'][-1]), 'D'))
+            del exported
+        except ValueError:  # broken or old file is exported again
+            os.remove(path)
+            last_scraping = ''
+    rows = connection.execute(new_rows_sql, {'char_code': char_code, 'last_date': last_date,
+                                             'last_scraping': last_scraping}).fetchall()
+    new_columns = {'days': np.array([request_date for request_date, _, _, _ in rows],
+                                    dtype='datetime64[D]').astype(np.int32),
+                   'rates': np.array([np.nan if rate is None else rate for _, rate, _, _ in rows], dtype=np.float64),
+                   'nominal': np.array([nominal or 1 for _, _, nominal, _ in rows], dtype=np.int32)}
+    last_scraping = max([last_scraping] + [scraping_datetime for _, _, _, scraping_datetime in rows
+                                           if scraping_datetime])
+    if not os.path.exists(path):
+        create_file(path, char_code, max(min_capacity, 2 * len(rows)), new_columns, last_scraping)
+        return len(rows), len(rows)
+    if not rows:
+        return 0, rows_number
+    return update_rows(path, char_code, new_columns, last_scraping)
+
+
+def export_rates(db_engine: 'sqlalchemy.engine.Engine', export_dir: str, currencies: list) -> None:
+    """Exports rates of the currencies into "export_dir", appending only new dates to the existing files."""
+    os.makedirs(export_dir, exist_ok=True)
+    with db_engine.connect() as connection:
+        for char_code in currencies:
+            added_rows, rows_number = export_currency(connection, export_dir, char_code)
+            print(f'{char_code}: {added_rows} rows exported, {rows_number} rows in '
+                  f'{os.path.join(export_dir, char_code + ".rates")}')
@@ -0,0 +1,144 @@
+import datetime
+import hashlib
+import os
+import threading
+import time
+from pathlib import Path
+
+from cbr_metrics import inc
+
+
+# base URL of the source, can be replaced by a local stand-in server, e.g. CBR_BASE_URL=http://127.0.0.1:8000
+base_url = os.environ.get('CBR_BASE_URL', 'https://www.cbr.ru').rstrip('/')
+script_dir = Path(__file__).resolve().parent  # path to the folder with 'cbr_http.py'
+cache_dir = os.environ.get('CBR_CACHE_DIR', os.path.join(script_dir, 'rates_db', 'http_cache'))
+today_ttl = 600  # seconds, responses for the current (or a future) date can still change
+_client = None
+_client_lock = threading.Lock()
+
+
+class CbrHttpClient:
+    """
+    HTTP client shared by the scrapers: keep-alive connection pool, per-request timeouts
+    and on-disk response cache.
+    "cache_dir" is the folder for cached responses, each one is stored in a file named by sha256 of its URL
+    "max_cache_size" is size of the cache in bytes, least recently used responses are evicted above it
+    "timeout" is connect/read timeout of each request in seconds
+    "pool_maxsize" is number of kept-alive connections per host
+    """
+    def __init__(self, cache_dir: str = cache_dir, max_cache_size: int = 256 * 1024 * 1024, timeout: float = 10,
+                 pool_maxsize: int = 10, retries: int = 3):
+        import urllib3  # imported here, so modes without scraping don't pay for it
+        self.cache_dir = cache_dir
+        self.max_cache_size = max_cache_size
+        self.http = urllib3.PoolManager(maxsize=pool_maxsize, block=False,
+                                        timeout=urllib3.Timeout(connect=timeout, read=timeout),
+                                        retries=urllib3.Retry(total=retries, backoff_factor=0.5,
+                                                              status_forcelist=(500, 502, 503, 504)),
+                                        headers={'User-Agent': 'cbr_rates'})
+        self.cache_lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.cache_size = sum(size for _, size, _ in self.cache_entries())
+
+    def fetch(self, url: str, ttl: float or None = None) -> bytes:
+        """Returns body of the response for the given URL, from the cache if possible.
+        "ttl" is lifetime of the cached response in seconds, None keeps it permanently."""
+        cache_path = os.path.join(self.cache_dir, hashlib.sha256(url.encode()).hexdigest())
+        body = self.read_cache(cache_path)
+        if body is not None:
+            inc('cbr_http_cache_hits_total')
+            return body
+        inc('cbr_http_cache_misses_total')
+        response = self.http.request('GET', url)
+        if response.status != 200:
+            raise OSError(f'{url} returned HTTP {response.status}')
+        body = response.data
+        self.write_cache(cache_path, body, ttl)
+        return body
+
+    def read_cache(self, cache_path: str) -> bytes or None:
+        """Returns cached body or None if the response isn't cached or is expired."""
+        expires_path = cache_path + '.expires'
+        try:
+            if os.path.exists(expires_path):
+                with open(expires_path) as expires_file:
+                    if float(expires_file.read()) < time.time():
+                        return None
+            with open(cache_path, 'rb') as cache_file:
+                body = cache_file.read()
+            os.utime(cache_path)  # modification time is used as time of last access for eviction
+            return body
+        except (OSError, ValueError):
+            return None
+
+    def write_cache(self, cache_path: str, body: bytes, ttl: float or None) -> None:
+        """Stores body in the cache atomically and evicts old responses if the cache is oversized.
+        The expiry of a response with TTL is written before the body, the one of a permanent response
+        is removed after it, so a response with TTL is never visible without its expiry
+        (at worst a permanent one expires early and is requested again)."""
+        expires_path = cache_path + '.expires'
+        if ttl is not None:
+            self.replace_file(expires_path, str(time.time() + ttl).encode())
+        try:
+            old_size = os.path.getsize(cache_path)
+        except OSError:
+            old_size = 0
+        self.replace_file(cache_path, body)
+        if ttl is None and os.path.exists(expires_path):
+            os.remove(expires_path)
+        with self.cache_lock:
+            self.cache_size += len(body) - old_size
+            if self.cache_size > self.max_cache_size:
+                self.evict()
+
+    @staticmethod
+    def replace_file(path: str, content: bytes) -> None:
+        """Writes the file atomically, readers see either the old or the new content."""
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as tmp_file:
+            tmp_file.write(content)
+        os.replace(tmp_path, path)
+
+    def cache_entries(self) -> list:
+        """Returns list of (time of last access, size, path) of the cached responses."""
+        entries = list()
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_file() and '.' not in entry.name:
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def evict(self) -> None:
+        """Removes least recently used responses until the cache fits in "max_cache_size".
+        Is called under "cache_lock"."""
+        entries = self.cache_entries()
+        self.cache_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if self.cache_size <= self.max_cache_size:
+                break
+            for file_path in (path, path + '.expires'):
+                if os.path.exists(file_path):
+                    os.remove(file_path)
+            self.cache_size -= size
+
+
+def get_client() -> CbrHttpClient:
+    """Returns the shared HTTP client, created on first use."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = CbrHttpClient()
+        return _client
+
+
+def ttl_for_date(requested_date: datetime.date) -> float or None:
+    """Returns lifetime of the cached response for the given date:
+    rates on past dates never change and are cached permanently, others get a short TTL."""
+    if requested_date < datetime.date.today():
+        return None
+    return today_ttl
+
+
+def fetch(url: str, ttl: float or None = None) -> bytes:
+    """Returns body of the response for the given URL by the shared HTTP client."""
+    return get_client().fetch(url, ttl)
@@ -0,0 +1,167 @@
+import contextlib
+import functools
+import json
+import logging
+import threading
+import time
+
+
+time_buckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # seconds, for histograms
+logger = logging.getLogger('cbr_metrics')
+
+
+class Metrics:
+    """
+    Thread-safe registry of counters and timers of the hot paths.
+    Counters and timers are identified by name and labels, timers are kept as histograms of "time_buckets".
+    If "log_lines" is set, each observation is also written to the log as a JSON line.
+    """
+    def __init__(self):
+        self.counters = dict()  # (name, labels) -> value
+        self.timers = dict()  # (name, labels) -> [count, sum, counts of buckets]
+        self.log_lines = False
+        self.lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        """Increases counter by value."""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+        if self.log_lines:
+            logger.info(json.dumps({'metric': name, 'type': 'counter', 'value': value, **labels}))
+
+    def observe(self, name: str, seconds: float, **labels) -> None:
+        """Adds duration in seconds to the timer."""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            timer_data = self.timers.setdefault(key, [0, 0.0, [0] * len(time_buckets)])
+            timer_data[0] += 1
+            timer_data[1] += seconds
+            for i, bucket in enumerate(time_buckets):
+                if seconds <= bucket:
+                    timer_data[2][i] += 1
+        if self.log_lines:
+            logger.info(json.dumps({'metric': name, 'type': 'timer', 'seconds': round(seconds, 6), **labels}))
+
+    @contextlib.contextmanager
+    def timer(self, name: str, **labels):
+        """Measures duration of the "with" block."""
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start_time, **labels)
+
+    def timed(self, name: str, **labels):
+        """Decorator measuring duration of each call of the function."""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer(name, **labels):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def prometheus_text(self) -> str:
+        """Returns all metrics in Prometheus text exposition format."""
+        def format_labels(labels: tuple, extra: tuple = ()) -> str:
+            all_labels = labels + extra
+            if not all_labels:
+                return ''
+            return '{' + ','.join(f'{key}="{value}"' for key, value in all_labels) + '}'
+
+        lines = list()
+        with self.lock:
+            counters = sorted(self.counters.items())
+            timers = sorted(self.timers.items())
+        typed_names = set()
+        for (name, labels), value in counters:
+            if name not in typed_names:
+                lines.append(f'# TYPE {name} counter')
+                typed_names.add(name)
+            lines.append(f'{name}{format_labels(labels)} {value}')
+        for (name, labels), (count, total, bucket_counts) in timers:
+            if name not in typed_names:
+                lines.append(f'# TYPE {name} histogram')
+                typed_names.add(name)
+            for bucket, bucket_count in zip(time_buckets, bucket_counts):
+                lines.append(f'{name}_bucket{format_labels(labels, (("le", bucket),))} {bucket_count}')
+            lines.append(f'{name}_bucket{format_labels(labels, (("le", "+Inf"),))} {count}')
+            lines.append(f'{name}_sum{format_labels(labels)} {total}')
+            lines.append(f'{name}_count{format_labels(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+inc = metrics.inc
+observe = metrics.observe
+timer = metrics.timer
+timed = metrics.timed
+
+
+def start_metrics_server(port: int, host: str = '127.0.0.1') -> 'http.server.ThreadingHTTPServer':
+    """Starts local HTTP endpoint "http://host:port/metrics" in a background thread."""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        """Serves metrics in Prometheus text format on "/metrics"."""
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics.prometheus_text().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    return server
+
+
+def enable_log_lines() -> None:
+    """Writes every observation to stderr as a structured JSON log line."""
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    metrics.log_lines = True
+
+
+@contextlib.contextmanager
+def profile(profile_path: str or None):
+    """Runs the "with" block under cProfile if path is given, saves the stats to the file
+    and prints 20 most expensive functions by cumulative time."""
+    if not profile_path:
+        yield
+        return
+    import cProfile
+    import pstats
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(profile_path)
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(20)
+
+
+def add_cli_arguments(parser) -> None:
+    """Adds options of instrumentation to the argparse parser of a script."""
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='Serve metrics in Prometheus format on http://127.0.0.1:PORT/metrics')
+    parser.add_argument('--metrics-log', action='store_true',
+                        help='Write metrics as structured JSON log lines to stderr')
+    parser.add_argument('--profile', type=str, default=None, metavar='FILE',
+                        help='Run the mode under cProfile and save the stats to FILE')
+
+
+def setup_from_args(input_args) -> None:
+    """Enables instrumentation chosen by the command line options."""
+    if input_args.metrics_log:
+        enable_log_lines()
+    if input_args.metrics_port is not None:
+        start_metrics_server(input_args.metrics_port)
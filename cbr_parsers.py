@@ -0,0 +1,132 @@
+"""
+Parsers of the documents of the source with fixed schema, built on lxml.etree and compiled XPath:
+    XML_daily.asp    rates of all currencies on a date
+    XML_dynamic.asp  rates of one currency for a period
+    XML_valFull.asp  reference of all currency codes
+    currency_base/daily page with the table of rates on a date
+Each parser takes the raw body of the response (bytes) and returns typed records,
+rates are rounded to 2 decimals as they are stored by the scripts.
+Malformed documents raise ValueError.
+"""
+import datetime
+import re
+from typing import NamedTuple
+
+from lxml import etree
+
+
+class DailyRate(NamedTuple):
+    """Rate of a currency published by the source on a date."""
+    char_code: str
+    cbr_id: str or None  # the HTML page has no codes of the source
+    num_code: str
+    name: str
+    nominal: int
+    currency_rate: float
+
+
+class PeriodRate(NamedTuple):
+    """Rate of a currency on one date of the requested period."""
+    request_date: datetime.date
+    currency_rate: float
+    nominal: int
+
+
+class CurrencyCode(NamedTuple):
+    """Codes of a currency from the reference of the source."""
+    char_code: str
+    cbr_id: str
+    num_code: str
+    name: str
+
+
+xml_parser = etree.XMLParser(resolve_entities=False, no_network=True, remove_blank_text=True)
+html_parser = etree.HTMLParser(encoding='utf-8', no_network=True)  # the page is served in UTF-8
+# compiled once, each call is evaluated without compiling of the expression;
+# fields of all records are selected at once column by column, it's faster than a lookup in each record
+daily_columns = tuple(etree.XPath(f'/ValCurs/Valute/{field}') for field in (
+    '@ID', 'NumCode/text()', 'CharCode/text()', 'Nominal/text()', 'Name/text()', 'Value/text()'))
+daily_date = etree.XPath('string(/ValCurs/@Date)')
+period_columns = tuple(etree.XPath(f'/ValCurs/Record/{field}') for field in (
+    '@Date', 'Value/text()', 'Nominal/text()'))
+reference_items = etree.XPath('/Valuta/Item')
+html_rate_rows = etree.XPath('//table[contains(concat(" ", normalize-space(@class), " "), " data ")]'
+                             '//tr[count(td) >= 5]')
+html_date_header = etree.XPath('string(//h2[contains(concat(" ", normalize-space(@class), " "), " h3 ")])')
+site_date_regexp = re.compile(r'(?P<only_date>\d{2}.\d{2}.\d{4})')
+
+
+def to_rate(value_text: str) -> float:
+    """Returns rate from the text with decimal comma, e.g. '75,7619' -> 75.76."""
+    return float(f"{float(value_text.strip().replace(',', '.')):.2f}")
+
+
+def to_date(date_str: str) -> datetime.date:
+    """Returns date from the string in format 'DD.MM.YYYY' of the source, without slow strptime()."""
+    if len(date_str) != 10 or date_str[2] != '.' or date_str[5] != '.':
+        raise ValueError(f'Invalid date: {date_str}')
+    return datetime.date(int(date_str[6:]), int(date_str[3:5]), int(date_str[:2]))
+
+
+def parse_xml(body: bytes) -> 'lxml.etree._Element':
+    """Returns root element of the XML document, the encoding is taken from its declaration."""
+    try:
+        return etree.fromstring(body, xml_parser)
+    except etree.XMLSyntaxError as err:
+        raise ValueError(f'Invalid XML document: {err}') from err
+
+
+def select_columns(root: 'lxml.etree._Element', columns: tuple) -> zip:
+    """Returns rows of the values selected by the compiled XPath "columns", each record must have all fields."""
+    values = [column(root) for column in columns]
+    if len({len(column_values) for column_values in values}) > 1:
+        raise ValueError('Some records of the document have missing fields')
+    return zip(*values)
+
+
+def parse_daily_xml(body: bytes) -> list:
+    """Returns list of DailyRate of all currencies from the XML_daily document."""
+    return [DailyRate(char_code=char_code.strip(), cbr_id=cbr_id, num_code=num_code.strip(), name=name.strip(),
+                      nominal=int(nominal), currency_rate=to_rate(value))
+            for cbr_id, num_code, char_code, nominal, name, value in select_columns(parse_xml(body), daily_columns)]
+
+
+def parse_daily_date(body: bytes) -> datetime.date:
+    """Returns date of rating of the XML_daily document, it is earlier than the requested date
+    if the source hasn't published rates on the requested date."""
+    return to_date(daily_date(parse_xml(body)))
+
+
+def parse_dynamic_xml(body: bytes) -> list:
+    """Returns list of PeriodRate from the XML_dynamic document in order of dates."""
+    return [PeriodRate(request_date=to_date(date_str), currency_rate=to_rate(value), nominal=int(nominal))
+            for date_str, value, nominal in select_columns(parse_xml(body), period_columns)]
+
+
+def parse_currencies_xml(body: bytes) -> list:
+    """Returns list of CurrencyCode from the XML_valFull document, currencies without ISO code are skipped."""
+    currencies = list()
+    for item in reference_items(parse_xml(body)):
+        char_code = (item.findtext('ISO_Char_Code') or '').strip()
+        if char_code:
+            currencies.append(CurrencyCode(char_code=char_code, cbr_id=item.get('ID').strip(),
+                                           num_code=(item.findtext('ISO_Num_Code') or '').strip(),
+                                           name=item.findtext('Name').strip()))
+    return currencies
+
+
+def parse_daily_html(body: bytes) -> tuple:
+    """Returns (date of rating 'DD.MM.YYYY', list of DailyRate) from the currency_base/daily page."""
+    root = etree.fromstring(body, html_parser)
+    if root is None:
+        raise ValueError('Empty HTML document')
+    result = site_date_regexp.search(html_date_header(root))
+    if result is None:
+        raise ValueError('Date of rating is not found on the page')
+    daily_rates = list()
+    for row in html_rate_rows(root):
+        cells = row.findall('td')
+        num_code, char_code, nominal, name, value = (''.join(cell.itertext()).strip() for cell in cells[:5])
+        daily_rates.append(DailyRate(char_code=char_code, cbr_id=None, num_code=num_code, name=name,
+                                     nominal=int(nominal), currency_rate=to_rate(value)))
+    return result.group('only_date'), daily_rates
@@ -0,0 +1,139 @@
+"""
+Staged pipeline of ingest: items (dates or windows of a period) pass through the stages, e.g. fetch -> parse -> write,
+connected by bounded queues, so the stages work on different items at the same time:
+the next documents are downloaded while the previous ones are parsed and written.
+A stage blocks when the queue to the next stage is full (back-pressure), so the number of items in flight
+and the memory don't depend on the number of items. Time of each stage and time it was blocked by the next one
+are observed as metrics "cbr_pipeline_stage_seconds" and "cbr_pipeline_blocked_seconds".
+"""
+import queue
+import threading
+import time
+from typing import Callable, NamedTuple
+
+from cbr_metrics import observe
+
+
+_stop = object()  # end of items of a queue, one is sent to each worker of the stage
+
+
+class Stage(NamedTuple):
+    """Stage of the pipeline: "func" gets an item of the previous stage and returns the item for the next one,
+    None drops the item. The stage is run by "workers" threads, the writing stage needs one."""
+    name: str
+    func: Callable
+    workers: int = 1
+
+
+class InOrder:
+    """
+    Function of a single-worker stage called on the items in their original order. Items are (number, item) pairs
+    numbered from 0, an item coming before its turn (the previous stage has several workers) is kept
+    until the items before it are processed. Returns result of the last call, None while the item waits.
+    """
+    def __init__(self, func: Callable):
+        self.func = func
+        self.pending = dict()
+        self.next_number = 0
+
+    def __call__(self, numbered_item: tuple):
+        number, item = numbered_item
+        self.pending[number] = item
+        result = None
+        while self.next_number in self.pending:
+            result = self.func(self.pending.pop(self.next_number))
+            self.next_number += 1
+        return result
+
+
+class Pipeline:
+    """
+    Pipeline of the stages in the given order.
+    "queue_size" is capacity of each queue between the stages
+    "stats" is {stage name: [number of items, seconds of work, seconds blocked by the next stage]} of the last run
+    """
+    def __init__(self, name: str, stages: list, queue_size: int = 4):
+        self.name = name
+        self.stages = stages
+        self.queue_size = queue_size
+        self.stats = dict()
+        self.error = None
+        self.lock = threading.Lock()
+
+    def run(self, items) -> list:
+        """Passes the items through the stages and returns the items returned by the last stage in order of completion.
+        The calling thread feeds the first stage and blocks while its queue is full.
+        The first error of a stage (including sys.exit()) stops the pipeline and is raised here."""
+        self.stats = {stage.name: [0, 0.0, 0.0] for stage in self.stages}
+        self.error = None
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+        remaining_workers = [max(1, stage.workers) for stage in self.stages]
+        results = list()
+        threads = [threading.Thread(target=self.work, args=(index, queues, remaining_workers, results),
+                                    name=f'{self.name}-{stage.name}-{number}', daemon=True)
+                   for index, stage in enumerate(self.stages) for number in range(max(1, stage.workers))]
+        for thread in threads:
+            thread.start()
+        try:
+            for item in items:
+                if self.error is not None:
+                    break
+                queues[0].put(item)
+        finally:
+            for _ in range(remaining_workers[0]):
+                queues[0].put(_stop)
+            for thread in threads:
+                thread.join()
+        if self.error is not None:
+            raise self.error
+        return results
+
+    def work(self, index: int, queues: list, remaining_workers: list, results: list) -> None:
+        """Runs the stage on items of its queue until the end of items. After an error the items are only drained,
+        so the previous stages never block on a full queue."""
+        stage = self.stages[index]
+        next_queue = queues[index + 1] if index + 1 < len(queues) else None
+        while True:
+            item = queues[index].get()
+            if item is _stop:
+                break
+            if self.error is not None:
+                continue
+            start_time = time.perf_counter()
+            try:
+                result = stage.func(item)
+            except BaseException as err:
+                with self.lock:
+                    if self.error is None:
+                        self.error = err
+                continue
+            work_time = time.perf_counter() - start_time
+            observe('cbr_pipeline_stage_seconds', work_time, pipeline=self.name, stage=stage.name)
+            blocked_time = 0.0
+            if result is not None:
+                if next_queue is None:
+                    with self.lock:
+                        results.append(result)
+                else:
+                    start_time = time.perf_counter()
+                    next_queue.put(result)
+                    blocked_time = time.perf_counter() - start_time
+                    observe('cbr_pipeline_blocked_seconds', blocked_time, pipeline=self.name, stage=stage.name)
+            with self.lock:
+                stage_stats = self.stats[stage.name]
+                stage_stats[0] += 1
+                stage_stats[1] += work_time
+                stage_stats[2] += blocked_time
+        with self.lock:
+            remaining_workers[index] -= 1
+            last_worker = remaining_workers[index] == 0
+        if last_worker and next_queue is not None:
+            for _ in range(remaining_workers[index + 1]):
+                next_queue.put(_stop)
+
+    def report(self) -> str:
+        """Returns time of each stage of the last run, e.g. 'fetch: 12 items, 1.234 s of work, 0.012 s blocked'."""
+        with self.lock:
+            return '; '.join(f'{stage_name}: {items_number} items, {work_time:.3f} s of work, '
+                             f'{blocked_time:.3f} s blocked'
+                             for stage_name, (items_number, work_time, blocked_time) in self.stats.items())
@@ -0,0 +1,77 @@
+import datetime
+import random
+import threading
+
+from cbr_metrics import inc
+
+
+class DailyScheduler:
+    """
+    Runs the job once a day at "at" local time plus a random delay up to "jitter" seconds.
+    The thread sleeps until the next deadline instead of waking up every second, the sleep is split into steps
+    of at most "max_sleep" seconds, so a changed clock or a suspended host is noticed.
+    The job returns True when the rates of the day are stored. If it returns False (the rates aren't published yet)
+    or fails (including sys.exit()), it is retried up to "retries" times after "retry_delay" seconds,
+    doubled with each attempt up to "max_retry_delay", each delay is randomized between its half and full value.
+    """
+    def __init__(self, job, at: datetime.time = datetime.time(12, 0), jitter: float = 60, retries: int = 5,
+                 retry_delay: float = 600, max_retry_delay: float = 3600, max_sleep: float = 3600):
+        self.job = job
+        self.at = at
+        self.jitter = jitter
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.max_sleep = max_sleep
+        self.stopped = threading.Event()
+
+    def next_deadline(self, now: datetime.datetime) -> datetime.datetime:
+        """Returns time of the next run after "now" with jitter."""
+        deadline = datetime.datetime.combine(now.date(), self.at)
+        if deadline <= now:
+            deadline += datetime.timedelta(days=1)
+        return deadline + datetime.timedelta(seconds=random.uniform(0, self.jitter))
+
+    def last_run_date(self, now: datetime.datetime) -> datetime.date:
+        """Returns the date of the last run time not later than "now": today after "at", otherwise yesterday.
+        Days up to it are caught up on start."""
+        if now.time() >= self.at:
+            return now.date()
+        return now.date() - datetime.timedelta(days=1)
+
+    def sleep_until(self, deadline: datetime.datetime) -> bool:
+        """Sleeps until the deadline by the wall clock, returns False if the scheduler is stopped."""
+        while not self.stopped.is_set():
+            remaining = (deadline - datetime.datetime.now()).total_seconds()
+            if remaining <= 0:
+                return True
+            self.stopped.wait(min(remaining, self.max_sleep))
+        return False
+
+    def run_job(self) -> bool:
+        """Runs the job with retries, returns True if it succeeded."""
+        for attempt in range(self.retries + 1):
+            try:
+                if self.job():
+                    inc('cbr_scheduler_runs_total', result='success')
+                    return True
+                print(f'{datetime.datetime.now():%d.%m.%Y %H:%M:%S}: rates are not published yet')
+            except (Exception, SystemExit) as err:
+                print(f'{datetime.datetime.now():%d.%m.%Y %H:%M:%S}: scheduled job failed:\n{err}')
+            if attempt == self.retries:
+                break
+            inc('cbr_scheduler_runs_total', result='retry')
+            delay = min(self.max_retry_delay, self.retry_delay * 2 ** attempt)
+            if not self.sleep_until(datetime.datetime.now() + datetime.timedelta(
+                    seconds=random.uniform(delay / 2, delay))):
+                return False
+        inc('cbr_scheduler_runs_total', result='failed')
+        return False
+
+    def run(self) -> None:
+        """Runs the job every day until stop() is called."""
+        while self.sleep_until(self.next_deadline(datetime.datetime.now())):
+            self.run_job()
+
+    def stop(self) -> None:
+        self.stopped.set()
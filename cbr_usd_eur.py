@@ -1,32 +1,47 @@
 import argparse
+import bisect
 import calendar
 import datetime
 import os
-import re
-import schedule
 import sys
+import threading
 import time
-# for parsing part:
-from bs4 import BeautifulSoup
-from urllib.request import urlopen
+# for parsing part (cbr_parsers with lxml is imported on first parsing):
+from cbr_http import base_url, fetch, today_ttl, ttl_for_date
+# for skipping days without publication:
+from cbr_calendar import PublicationCalendar
+# for instrumentation:
+from cbr_metrics import inc, timed, timer
+import cbr_metrics
+# for overlapped fetching, parsing and writing:
+from cbr_pipeline import InOrder, Pipeline, Stage
+# for the daily schedule:
+from cbr_scheduler import DailyScheduler
 # for database part:
-from sqlalchemy import create_engine, Column, Integer, String, Float, ForeignKey
-from sqlalchemy.orm import sessionmaker, relationship
+from cbr_db import DbWriter, create_sqlite_engine
+from sqlalchemy import Column, Date, DateTime, Integer, String, Float, ForeignKey, func, text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import scoped_session, sessionmaker, relationship
 from sqlalchemy.ext.declarative import declarative_base
-# for telegram part:
-import telebot
-from telebot import types
+# for telegram part telebot is imported on start of the bot
 
 
 # https://www.cbr.ru/currency_base/daily/?UniDbQuery.Posted=True&UniDbQuery.To={date in format:DD.MM.YYYY}
-request_url = f'https://www.cbr.ru/currency_base/daily/?UniDbQuery.Posted=True&UniDbQuery.To='
+request_url = f'{base_url}/currency_base/daily/?UniDbQuery.Posted=True&UniDbQuery.To='
 # URL with exchange rates, without the query date
 script_path = os.path.abspath(os.path.dirname(__file__))  # path to the cbr_usd_eur.py
 path_to_database = os.path.join(script_path, 'rates_db', 'usd_eur.db')
 # path to the database, placed in the nested folder
-db_engine = create_engine(f'sqlite:///{path_to_database}')
-Session = sessionmaker(bind=db_engine)
-session = Session()
+# the engine and the per-thread sessions are created on first use by get_db_engine() and get_session(),
+# all writes are executed one after another by the single writer thread "db_writer"
+path_to_calendar = os.path.join(script_path, 'rates_db', 'publication_calendar.json')
+cbr_ids = {'USD': 'R01235', 'EUR': 'R01239'}  # codes of the source for the range requests of missed days
+# days without new rates of the source, learned from "date_rate_site" and cached, is loaded by get_calendar()
+_calendar = None
+_db_engine = None
+_session = None
+_db_lock = threading.Lock()
+db_writer = DbWriter(name='db-writer', on_error=lambda: release_session())  # a failed write is rolled back
 Base = declarative_base()
 
 
@@ -40,8 +55,8 @@ class MainInfo(Base):
     """
     __tablename__ = 'Scraping Info'
     id = Column(Integer, primary_key=True, autoincrement=True)
-    scraping_site = Column(String, default=request_url[:19])
-    scraping_datetime = Column(String, default=datetime.datetime.now())
+    scraping_site = Column(String, default=f'{base_url}/')
+    scraping_datetime = Column(DateTime, default=datetime.datetime.now, index=True)
     currency_1 = Column(String, default='USD')
     currency_2 = Column(String, default='EUR')
     out_usd = relationship('USD', backref='main_table_data')
@@ -52,63 +67,175 @@ class Currency(Base):
     """
     The table for each currency includes rate on a given by user date, date from the source,
     the difference and the dynamics of change is given relatively to the previous rate on the date given by the source.
-    "request_date" is requesting date of exchange rates given by user
+    "request_date" is requesting date of exchange rates given by user, unique: repeated requests update the row
     "currency_rate" is rate at requesting date
     "date_rate_site" is date of exchange rates given by source (website)
+    dates are stored as sortable ISO dates and indexed
     "currency_dynamics" displays that rate increased, decreased or has no change in order to its previous value
     """
     __abstract__ = True
     id = Column(Integer, primary_key=True)
-    request_date = Column(String, default=None)
+    request_date = Column(Date, default=None, index=True, unique=True)
     currency_rate = Column(Float, default=None)
-    date_rate_site = Column(String, default=None)
+    date_rate_site = Column(Date, default=None, index=True)
     currency_dynamics = Column(String, default=None)
     currency_difference = Column(Float, default=None)
 
 
 class USD(Currency):
     __tablename__ = 'USD rates'
-    usd_scraping_datetime = Column(String, ForeignKey('Scraping Info.scraping_datetime'))
+    usd_scraping_datetime = Column(DateTime, ForeignKey('Scraping Info.scraping_datetime'))
 
 
 class EUR(Currency):
     __tablename__ = 'EUR rates'
-    eur_scraping_datetime = Column(String, ForeignKey('Scraping Info.scraping_datetime'))
+    eur_scraping_datetime = Column(DateTime, ForeignKey('Scraping Info.scraping_datetime'))
+
+
+def get_db_engine() -> 'sqlalchemy.engine.Engine':
+    """Returns the database engine (WAL journal and tuned pragmas), created on first use."""
+    global _db_engine
+    with _db_lock:
+        if _db_engine is None:
+            _db_engine = create_sqlite_engine(path_to_database)
+        return _db_engine
+
+
+def get_session() -> 'sqlalchemy.orm.Session':
+    """Returns the database session of the current thread, created on first use."""
+    global _session
+    engine = get_db_engine()
+    with _db_lock:
+        if _session is None:
+            _session = scoped_session(sessionmaker(bind=engine))
+    return _session()
+
+
+def release_session() -> None:
+    """Closes the session of the current thread, so the next read sees the latest committed data."""
+    if _session is not None:
+        _session.remove()
 
 
 def add_rates_to_db(request_date: str = datetime.datetime.now().strftime('%d.%m.%Y')) -> 'sqlite':
     """Adds exchange rates, difference and dynamics of changing to the appropriate tables in the database."""
-    py_run_datetime = datetime.datetime.now().strftime('%d.%m.%Y %H:%M:%S')
-    usd_rate, site_date = get_rate(request_date, 'USD')
-    eur_rate, site_date = get_rate(request_date, 'EUR')
-
-    usd_prev = get_previous_rate(USD, request_date)
-    eur_prev = get_previous_rate(EUR, request_date)
-
-    Base.metadata.create_all(db_engine)
-    usd_dyn, usd_diff = edit_currency_dynamics(usd_rate, usd_prev)
-    eur_dyn, eur_diff = edit_currency_dynamics(eur_rate, eur_prev)
-    data_inf = MainInfo(scraping_datetime=py_run_datetime)
-    data_usd = USD(main_table_data=data_inf, currency_rate=usd_rate, currency_dynamics=usd_dyn,
-                   currency_difference=usd_diff, request_date=request_date, date_rate_site=site_date)
-    data_eur = EUR(main_table_data=data_inf, currency_rate=eur_rate, currency_dynamics=eur_dyn,
-                   currency_difference=eur_diff, request_date=request_date, date_rate_site=site_date)
-    session.add_all([data_inf, data_usd, data_eur])
-    session.commit()
-
-
-def get_previous_rate(currency_name: type, req_date: str) -> float:
-    """Returns from the appropriate table previous rate of given currency for the last date of rating from the source,
-     without taking into account the requested date of the rate."""
-    prev_rate = None
+    backfill_dates([request_date], workers=1, requests_per_sec=0)
+
+
+def get_calendar() -> PublicationCalendar:
+    """Returns the calendar of publication days of the source, loaded from the cache on first use.
+    If there is no cache yet, the calendar is learned from dates stored in the database."""
+    global _calendar
+    with _db_lock:
+        if _calendar is not None:
+            return _calendar
+    publication_calendar = PublicationCalendar(path_to_calendar)
+    if not publication_calendar.load():
+        try:
+            Base.metadata.create_all(get_db_engine())
+            for currency_name in (USD, EUR):
+                for request_date, site_date in get_session().query(
+                        currency_name.request_date, currency_name.date_rate_site).filter(
+                        currency_name.date_rate_site.isnot(None)):
+                    publication_calendar.learn(request_date, site_date)
+        except Exception as err:
+            sys.exit(f'Error in learning publication calendar:\n{err}')
+        finally:
+            release_session()
+        publication_calendar.save()
+    with _db_lock:
+        if _calendar is None:
+            _calendar = publication_calendar
+        return _calendar
+
+
+@timed('cbr_db_write_seconds', function='write_rates_to_db')
+@db_writer.serialized
+def write_rates_to_db(request_date: str, rates: dict, site_date: str) -> 'sqlite':
+    """Adds already scraped exchange rates {'USD': rate, 'EUR': rate} on the date of rating from the source,
+    difference and dynamics of changing to the appropriate tables in the database."""
+    py_run_datetime = datetime.datetime.now().replace(microsecond=0)
+    usd_rate = rates['USD']
+    eur_rate = rates['EUR']
+    request_date = str_to_date(request_date)
+    site_date = str_to_date(site_date)
+
     try:
-        prev_rate_info = session.query(currency_name).filter(currency_name.date_rate_site != req_date).order_by(
-            currency_name.id.desc()).first()  # getting last rate with date != req_date
-        prev_rate = prev_rate_info.currency_rate
+        Base.metadata.create_all(get_db_engine())
+        get_session().add(MainInfo(scraping_datetime=py_run_datetime))
+        get_session().execute(upsert_rate_statement(USD), [{
+            'request_date': request_date, 'currency_rate': usd_rate, 'date_rate_site': site_date,
+            'usd_scraping_datetime': py_run_datetime}])
+        get_session().execute(upsert_rate_statement(EUR), [{
+            'request_date': request_date, 'currency_rate': eur_rate, 'date_rate_site': site_date,
+            'eur_scraping_datetime': py_run_datetime}])
+        update_dynamics(get_session(), USD, site_date, site_date)
+        update_dynamics(get_session(), EUR, site_date, site_date)
+        get_session().commit()
     except Exception as err:
-        sys.exit(f'Error in getting previous rate:\n{err}')
-    finally:
-        return prev_rate
+        get_session().rollback()
+        sys.exit(f'Error! Adding data to database failed:\n{err}')
+    get_calendar().learn(request_date, site_date)
+    inc('cbr_rows_written_total', table=USD.__tablename__)
+    inc('cbr_rows_written_total', table=EUR.__tablename__)
+
+
+def upsert_rate_statement(currency_name: type) -> 'sqlalchemy.sql.Insert':
+    """Returns "INSERT ... ON CONFLICT (request_date) DO UPDATE" statement for the table of the currency,
+    so the rate requested on the same date again replaces the values of the existing row.
+    Dynamics and difference are left to update_dynamics()."""
+    statement = sqlite_insert(currency_name.__table__)
+    return statement.on_conflict_do_update(
+        index_elements=['request_date'],
+        set_={column.name: statement.excluded[column.name] for column in currency_name.__table__.columns
+              if column.name not in ('id', 'request_date', 'currency_dynamics', 'currency_difference')})
+
+
+def update_dynamics(connection: 'sqlalchemy.orm.Session or sqlalchemy.engine.Connection', currency_name: type,
+                    from_site_date: datetime.date, to_site_date: datetime.date) -> int:
+    """Sets difference and dynamics of the rows of the currency with date of rating from "from_site_date"
+    to "to_site_date" and of the next date of rating after them, relatively to the rate on the previous date of rating,
+    by one set-based statement with LAG() in the transaction of the caller. The window of LAG() is limited
+    to the stored date of rating before the range and the one after it, so the cost doesn't grow with the history.
+    Returns number of updated rows."""
+    table_name = currency_name.__tablename__
+    return connection.execute(text(f"""
+        UPDATE "{table_name}" SET
+            currency_dynamics = CASE
+                WHEN ordered.previous_rate IS NULL THEN NULL
+                WHEN "{table_name}".currency_rate > ordered.previous_rate THEN 'increased'
+                WHEN "{table_name}".currency_rate < ordered.previous_rate THEN 'decreased'
+                ELSE 'no change' END,
+            currency_difference = round("{table_name}".currency_rate - ordered.previous_rate, 2)
+        FROM (SELECT date_rate_site, LAG(currency_rate) OVER (ORDER BY date_rate_site) AS previous_rate
+              FROM "{table_name}" WHERE id IN (
+                  SELECT max(id) FROM "{table_name}"
+                  WHERE date_rate_site >= coalesce((SELECT max(date_rate_site) FROM "{table_name}"
+                                                    WHERE date_rate_site < :from_site_date), :from_site_date)
+                    AND date_rate_site <= coalesce((SELECT min(date_rate_site) FROM "{table_name}"
+                                                    WHERE date_rate_site > :to_site_date), :to_site_date)
+                  GROUP BY date_rate_site)) AS ordered
+        WHERE "{table_name}".date_rate_site = ordered.date_rate_site
+          AND "{table_name}".date_rate_site >= :from_site_date"""),
+        {'from_site_date': from_site_date.isoformat(), 'to_site_date': to_site_date.isoformat()}).rowcount
+
+
+@db_writer.serialized
+def recompute_dynamics() -> 'sqlite':
+    """Recomputes difference and dynamics of all rows of the tables of currencies in order of dates of rating."""
+    try:
+        Base.metadata.create_all(get_db_engine())
+        with get_db_engine().begin() as connection:
+            for currency_name in (USD, EUR):
+                updated_rows = update_dynamics(connection, currency_name, datetime.date.min, datetime.date.max)
+                print(f'{currency_name.__tablename__}: dynamics of {updated_rows} rows recomputed')
+    except Exception as err:
+        sys.exit(f'Error! Recomputing of dynamics failed:\n{err}')
+
+
+def str_to_date(date_str: str) -> datetime.date:
+    """Returns date from the string in format 'DD.MM.YYYY' or 'DD/MM/YYYY'."""
+    return datetime.datetime.strptime(date_str.strip().replace('/', '.'), '%d.%m.%Y').date()
 
 
 def get_last_rate(currency_name: type) -> float and str:
@@ -116,8 +243,8 @@ def get_last_rate(currency_name: type) -> float and str:
     last_rate = None
     last_rate_date = None
     try:
-        last_row = session.query(currency_name).count()  # number of the last row in table
-        last_data = session.query(currency_name).get(last_row)  # full info from the last row in table
+        last_data = get_session().query(currency_name).order_by(
+            currency_name.request_date.desc()).first()  # full info from the row of the last requested date
         last_rate = last_data.currency_rate  # last given currency_rate in the table
         last_rate_date = last_data.date_rate_site  # last given date_rate_site in the table
     except Exception as err:
@@ -126,36 +253,135 @@ def get_last_rate(currency_name: type) -> float and str:
         return last_rate, last_rate_date
 
 
+@db_writer.serialized
+def migrate_db_dates() -> 'sqlite':
+    """Converts dates stored as 'DD.MM.YYYY' / 'DD/MM/YYYY' strings in the existing database
+    into sortable ISO format and creates indexes on the date columns. Already converted rows are skipped,
+    duplicate rows of the same requested date are removed before the unique index is created."""
+    date_pattern = '[0-3][0-9][./][0-1][0-9][./][0-9][0-9][0-9][0-9]*'
+    date_columns = {MainInfo: ('scraping_datetime',),
+                    USD: ('request_date', 'date_rate_site', 'usd_scraping_datetime'),
+                    EUR: ('request_date', 'date_rate_site', 'eur_scraping_datetime')}
+    try:
+        db_engine = get_db_engine()
+        with db_engine.begin() as connection:
+            for table_name, column_names in date_columns.items():
+                table = table_name.__table__
+                if not db_engine.dialect.has_table(connection, table.name):
+                    continue
+                for column_name in column_names:
+                    connection.execute(text(
+                        f'UPDATE "{table.name}" SET {column_name} = '
+                        f"substr({column_name}, 7, 4) || '-' || substr({column_name}, 4, 2) || '-' || "
+                        f"substr({column_name}, 1, 2) || substr({column_name}, 11) "
+                        f"WHERE {column_name} GLOB '{date_pattern}'"))
+                if table_name is not MainInfo:
+                    remove_duplicate_rates(connection, table_name)
+                create_indexes(connection, table)
+    except Exception as err:
+        sys.exit(f'Error! Migration of the database failed:\n{err}')
+
+
+def create_indexes(connection: 'sqlalchemy.engine.Connection', table: 'sqlalchemy.Table') -> None:
+    """Creates missing indexes of the table. An index created without UNIQUE by an older version of the script
+    is dropped and created again, "INSERT ... ON CONFLICT (request_date)" needs the unique one."""
+    unique_indexes = {row[1]: bool(row[2]) for row in connection.execute(text(f'PRAGMA index_list("{table.name}")'))}
+    for index in table.indexes:
+        if index.unique and unique_indexes.get(index.name) is False:
+            index.drop(bind=connection)
+        index.create(bind=connection, checkfirst=True)
+
+
+def check_db_migrated() -> None:
+    """Exits with a message if the existing database has dates in format 'DD.MM.YYYY' or no unique index
+    of "request_date": the modes read ISO dates and write by "INSERT ... ON CONFLICT (request_date)",
+    'migrate' mode converts such database."""
+    if not os.path.exists(path_to_database):
+        return
+    try:
+        db_engine = get_db_engine()
+        with db_engine.connect() as connection:
+            for currency_name in (USD, EUR):
+                table_name = currency_name.__tablename__
+                if not db_engine.dialect.has_table(connection, table_name):
+                    continue
+                old_dates = connection.execute(text(
+                    f'SELECT 1 FROM "{table_name}" WHERE request_date GLOB \'[0-3][0-9][./]*\' LIMIT 1')).first()
+                unique_indexes = {row[1] for row in connection.execute(text(f'PRAGMA index_list("{table_name}")'))
+                                  if row[2]}
+                if old_dates is not None or not all(index.name in unique_indexes
+                                                    for index in currency_name.__table__.indexes if index.unique):
+                    sys.exit(f'Error! The database {path_to_database} has the old format of dates or no unique index '
+                             f'of "request_date", run "cbr_usd_eur.py migrate" first')
+    except Exception as err:
+        sys.exit(f'Error in checking the database:\n{err}')
+
+
+def remove_duplicate_rates(connection: 'sqlalchemy.engine.Connection', currency_name: type) -> int:
+    """Removes rows with repeated requested date from the table of the currency, the last added row is kept.
+    Returns number of the removed rows."""
+    table_name = currency_name.__tablename__
+    return connection.execute(text(
+        f'DELETE FROM "{table_name}" WHERE id NOT IN '
+        f'(SELECT max(id) FROM "{table_name}" GROUP BY request_date)')).rowcount
+
+
+@db_writer.serialized
+def compact_db() -> 'sqlite':
+    """Removes duplicate rates of the same requested date and records of script runs without rates,
+    replaces the index of "request_date" by the unique one, then rebuilds the database file."""
+    try:
+        db_engine = get_db_engine()
+        Base.metadata.create_all(db_engine)
+        with db_engine.begin() as connection:
+            for currency_name in (USD, EUR):
+                removed_rows = remove_duplicate_rates(connection, currency_name)
+                print(f'{currency_name.__tablename__}: {removed_rows} duplicate rows removed')
+                create_indexes(connection, currency_name.__table__)
+            removed_rows = connection.execute(text(
+                'DELETE FROM "Scraping Info" WHERE scraping_datetime NOT IN '
+                '(SELECT usd_scraping_datetime FROM "USD rates" WHERE usd_scraping_datetime IS NOT NULL '
+                'UNION SELECT eur_scraping_datetime FROM "EUR rates" WHERE eur_scraping_datetime IS NOT NULL)')).rowcount
+            print(f'Scraping Info: {removed_rows} rows without rates removed')
+        with db_engine.connect() as connection:
+            connection = connection.execution_options(isolation_level='AUTOCOMMIT')  # VACUUM can't run in transaction
+            connection.execute(text('VACUUM'))
+            connection.execute(text('ANALYZE'))
+    except Exception as err:
+        sys.exit(f'Error! Compaction of the database failed:\n{err}')
+
+
 def get_rate(requesting_date: str, currency_name: str) -> float and str:  # stable
     """Scrapes URL for getting rate of the given currency and date of rating."""
-    scraping_url = request_url + requesting_date
+    rates, site_date = get_rates(requesting_date, (currency_name,))
+    return rates[currency_name], site_date
+
+
+def get_rates(requesting_date: str, currency_names: tuple = ('USD', 'EUR')) -> dict and str:
+    """Scrapes URL once for getting rates of the given currencies {currency name: rate} and date of rating."""
+    return parse_rates(fetch_page(requesting_date), currency_names)
+
+
+def fetch_page(requesting_date: str) -> bytes:
+    """Scrapes URL once for the given date and returns the page with rates of all currencies."""
     try:
-        html = urlopen(scraping_url)
-        bs_obj = BeautifulSoup(html, 'lxml')
-        currency_rate = (bs_obj.find('td',
-                                     string={currency_name}).parent.find_all('td')[4].get_text()).replace(',', '.')
-        currency_rate = float(format(float(currency_rate), '.2f'))
-        date_of_rating_full_text = bs_obj.find('h2', class_="h3").get_text()
-        regexp = re.compile(r'(?P<only_date>\d{2}.\d{2}.\d{4})')
-        result = regexp.search(date_of_rating_full_text)
-        site_date = result.group('only_date')
-        return currency_rate, site_date
+        with timer('cbr_fetch_seconds', document='daily_html'):
+            return fetch(request_url + requesting_date, ttl_for_date(str_to_date(requesting_date)))
     except Exception as err:
         sys.exit(f'Scrapy failed:\n{err}')
 
 
-def edit_currency_dynamics(current_rate: float, previous_rate: float = 0) -> str and float:
-    """Returns detailed description of the given currency rate change:
-    difference between rates and dynamics of the change."""
-    if previous_rate is None:
-        return None, None
-    else:
-        if current_rate > previous_rate:
-            return 'increased', format((current_rate-previous_rate), '.2f')
-        elif current_rate < previous_rate:
-            return 'decreased', format((current_rate-previous_rate), '.2f')
-        else:
-            return 'no change', 0
+def parse_rates(html: bytes, currency_names: tuple = ('USD', 'EUR')) -> dict and str:
+    """Returns rates of the given currencies {currency name: rate} and date of rating from the page."""
+    try:
+        from cbr_parsers import parse_daily_html
+        with timer('cbr_parse_seconds', document='daily_html'):
+            site_date, daily_rates = parse_daily_html(html)
+            page_rates = {rate_info.char_code: rate_info.currency_rate for rate_info in daily_rates}
+            rates = {currency_name: page_rates[currency_name] for currency_name in currency_names}
+        return rates, site_date
+    except Exception as err:
+        sys.exit(f'Parsing failed:\n{err}')
 
 
 def get_info_for_tlg_bot(currency_name: type) -> float and str and float and str:
@@ -166,8 +392,8 @@ def get_info_for_tlg_bot(currency_name: type) -> float and str and float and str
     last_rate_diff = None
     last_rate_dyn = None
     try:
-        last_row = session.query(currency_name).count()  # number of the last row in table
-        last_data = session.query(currency_name).get(last_row)  # full info from the last row in table
+        last_data = get_session().query(currency_name).order_by(
+            currency_name.request_date.desc()).first()  # full info from the row of the last requested date
         last_rate = last_data.currency_rate  # last given currency_rate in the table
         last_rate_date = last_data.date_rate_site  # last given date_rate_site in the table
         last_rate_diff = last_data.currency_difference
@@ -178,16 +404,19 @@ def get_info_for_tlg_bot(currency_name: type) -> float and str and float and str
         return last_rate, last_rate_date, last_rate_diff, last_rate_dyn
 
 
-def telegram_bot():
-    """Starts telegram bot. Help, display rates and test function are realised."""
+def create_telegram_bot(bot_threads: int = 4) -> 'telebot.TeleBot':
+    """Returns telegram bot with registered commands. Help, display rates and test function are realised.
+    Commands of different users are handled in parallel by "bot_threads" worker threads."""
+    import telebot
     telegram_settings = os.path.join('/'.join(script_path.split('/')[:-1]), 'telegram_settings', 'name_token.txt')
     # gets previous folder for 'cbr_usd_eur.py' and opens file 'name_token.txt' in the folder 'telegram_settings'
     with open(telegram_settings) as t_bot:
         bot_name, bot_token = t_bot
     bot_token = bot_token.rstrip()
-    tlg_bot = telebot.TeleBot(bot_token)
+    tlg_bot = telebot.TeleBot(bot_token, threaded=True, num_threads=bot_threads)
 
     @tlg_bot.message_handler(commands=['start'])
+    @timed('cbr_bot_handler_seconds', command='start')
     def start_command(message):
         tlg_bot.send_message(
             message.chat.id,
@@ -196,40 +425,182 @@ def telegram_bot():
         )
 
     @tlg_bot.message_handler(commands=['rates'])
+    @timed('cbr_bot_handler_seconds', command='rates')
     def rates_command(message):
         """Displays last inputted information about two currencies USD and EUR"""
         usd_rate, usd_date, usd_diff, usd_dyn = get_info_for_tlg_bot(USD)
         eur_rate, eur_date, eur_diff, eur_dyn = get_info_for_tlg_bot(EUR)
-        tlg_bot.send_message(message.chat.id, f'USD on {usd_date} is {usd_rate},'
+        release_session()
+        tlg_bot.send_message(message.chat.id, f'USD on {usd_date:%d.%m.%Y} is {usd_rate},'
                                               f' {usd_dyn} by {abs(usd_diff)}\n'
-                                              f'EUR on {eur_date} is {eur_rate},'
+                                              f'EUR on {eur_date:%d.%m.%Y} is {eur_rate},'
                                               f' {eur_dyn} by {abs(eur_diff)}')
 
     @tlg_bot.message_handler(commands=['F1'])
+    @timed('cbr_bot_handler_seconds', command='F1')
     def query_command(message):
         """Test function."""
         tlg_bot.send_message(message.chat.id, "The function F1 is running..")
 
     @tlg_bot.message_handler(commands=['help'])
+    @timed('cbr_bot_handler_seconds', command='help')
     def help_command(message):
         """Help mode."""
         tlg_bot.send_message(message.chat.id, '1) To run function_1 press /F1.\n'
                                               '2) To run function_2 press /F2.\n...\n')
 
+    return tlg_bot
+
+
+def telegram_bot():
+    """Starts telegram bot."""
+    tlg_bot = create_telegram_bot()
     tlg_bot.polling(none_stop=True)
 
 
-def scrapy_month(month: int, year: int) -> 'sqlite':
+def start_telegram_bot_thread() -> threading.Thread:
+    """Starts telegram bot in a background thread, so the schedule loop runs alongside it."""
+    tlg_bot = create_telegram_bot()
+    bot_thread = threading.Thread(target=tlg_bot.polling, kwargs={'none_stop': True},
+                                  name='telegram-bot', daemon=True)
+    bot_thread.start()
+    return bot_thread
+
+
+def scheduled_job() -> bool:
+    """Adds exchange rates on the current date to the database, days known to be without publication are skipped.
+    Returns False if the rates on the date aren't published yet, so the scheduler retries the job;
+    days without publication expected by the publication calendar aren't retried."""
+    today = datetime.date.today()
+    if not get_calendar().is_publishing_day(today):
+        inc('cbr_skipped_requests_total', reason='not_published')
+        return True
+    add_rates_to_db(today.strftime('%d.%m.%Y'))
+    _, site_date = get_last_rate(USD)
+    release_session()
+    return site_date is not None and (site_date >= today or not get_calendar().expects_publication(today))
+
+
+def catch_up_missed_days(to_date: datetime.date) -> 'sqlite':
+    """Adds exchange rates on the days after the last requested date up to "to_date",
+    missed while the script wasn't running. Rates of the whole gap are requested by one range request
+    of XML_dynamic per currency instead of a page per day, the rate on each missed day is the last one set
+    on or before it. Days without publication of the source are skipped as by the schedule."""
+    last_date = None
+    try:
+        Base.metadata.create_all(get_db_engine())
+        last_date = get_session().query(func.max(USD.request_date)).scalar()
+    except Exception as err:
+        sys.exit(f'Error in getting the last requested date:\n{err}')
+    finally:
+        release_session()
+    if last_date is None or last_date >= to_date:
+        return
+    missed_dates = [last_date + datetime.timedelta(days=day) for day in range(1, (to_date - last_date).days + 1)]
+    missed_dates = [missed_date for missed_date in missed_dates if get_calendar().is_publishing_day(missed_date)]
+    if not missed_dates:
+        return
+    print(f'{len(missed_dates)} missed days from {missed_dates[0]:%d.%m.%Y} to {to_date:%d.%m.%Y} are caught up')
+    # the range starts before the gap, so the first missed days after holidays have the rate set before them
+    range_from = last_date - datetime.timedelta(days=14)
+    period_rates = {currency_name: get_period_rates(cbr_id, range_from, to_date)
+                    for currency_name, cbr_id in cbr_ids.items()}
+    period_dates = {currency_name: [rate_date for rate_date, _, _ in currency_rates]
+                    for currency_name, currency_rates in period_rates.items()}
+    for missed_date in missed_dates:
+        rates = dict()
+        site_date = None
+        for currency_name, currency_rates in period_rates.items():
+            # records are in order of dates, the last one on or before the missed date is taken
+            position = bisect.bisect_right(period_dates[currency_name], missed_date)
+            if position:
+                rate_date, rates[currency_name], _ = currency_rates[position - 1]
+                site_date = max(site_date or rate_date, rate_date)
+        if len(rates) == len(period_rates):
+            write_rates_to_db(f'{missed_date:%d.%m.%Y}', rates, f'{site_date:%d.%m.%Y}')
+    get_calendar().save()
+
+
+def get_period_rates(cbr_id: str, from_date: datetime.date, to_date: datetime.date) -> list:
+    """Scrapes XML_dynamic once for the code of the currency in the source and the period
+    and returns list of (date, rate, nominal) records in order of dates."""
+    # https://www.cbr.ru/scripts/XML_dynamic.asp?date_req1={DD/MM/YYYY}&date_req2={DD/MM/YYYY}&VAL_NM_RQ={currency_id}
+    scraping_url = (f'{base_url}/scripts/XML_dynamic.asp?'
+                    f'date_req1={from_date:%d/%m/%Y}&date_req2={to_date:%d/%m/%Y}&VAL_NM_RQ={cbr_id}')
+    try:
+        from cbr_parsers import parse_dynamic_xml
+        with timer('cbr_fetch_seconds', document='XML_dynamic'):
+            xml_cbr = fetch(scraping_url, ttl_for_date(to_date))
+        with timer('cbr_parse_seconds', document='XML_dynamic'):
+            return parse_dynamic_xml(xml_cbr)
+    except Exception as err:
+        sys.exit(f'Scrapy failed:\n{err}')
+
+
+class RateLimiter:
+    """
+    Limits the number of requests started per second, shared between the threads of the backfill.
+    "requests_per_sec" is the cap, 0 disables the limit
+    """
+    def __init__(self, requests_per_sec: float):
+        self.interval = 1 / requests_per_sec if requests_per_sec > 0 else 0
+        self.next_time = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self) -> None:
+        """Blocks the calling thread until the next request is allowed."""
+        with self.lock:
+            now = time.monotonic()
+            delay = max(0.0, self.next_time - now)
+            self.next_time = max(now, self.next_time) + self.interval
+        if delay:
+            time.sleep(delay)
+
+
+def scrapy_month(month: int, year: int, workers: int = 10, requests_per_sec: float = 10) -> 'sqlite':
     """Adds exchange rates, difference and dynamics of changing
-    to the appropriate tables in the database for inputted month."""
+    to the appropriate tables in the database for inputted month.
+    Days without publication of the source aren't requested, they would return rates of the previous publication."""
 
     req_period = list()
     for full_date in calendar.Calendar().itermonthdays3(year, month):
         y, m, d = full_date
         if m == month:
             check_date(req_period, d, m, y)
-    for req_date in req_period:
-        add_rates_to_db(req_date)
+    publishing_dates = [req_date for req_date in req_period if get_calendar().is_publishing_day(str_to_date(req_date))]
+    if len(publishing_dates) < len(req_period):
+        inc('cbr_skipped_requests_total', len(req_period) - len(publishing_dates), reason='not_published')
+        print(f'{len(req_period) - len(publishing_dates)} days without publication are skipped')
+    pipeline = backfill_dates(publishing_dates, workers, requests_per_sec)
+    print(f'Pipeline: {pipeline.report()}')
+
+
+def backfill_dates(req_dates: list, workers: int = 10, requests_per_sec: float = 10) -> Pipeline:
+    """Scrapes the page of each date once and adds the rates to the database by the pipeline fetch -> parse -> write:
+    pages are requested concurrently by "workers" threads and not faster than "requests_per_sec",
+    while the fetched ones are parsed and written by the single writer. Dates are written in the given order:
+    rates parsed before their turn wait in the write stage until the previous dates are written.
+    Returns the pipeline with time of its stages."""
+    rate_limiter = RateLimiter(requests_per_sec)
+
+    def fetch_stage(numbered_date: tuple) -> tuple:
+        number, req_date = numbered_date
+        rate_limiter.wait()
+        return number, (req_date, fetch_page(req_date))
+
+    def parse_stage(fetched: tuple) -> tuple:
+        number, (req_date, html) = fetched
+        return number, (req_date, *parse_rates(html))
+
+    pipeline = Pipeline('daily_html', [Stage('fetch', fetch_stage, workers),
+                                       Stage('parse', parse_stage),
+                                       Stage('write', InOrder(lambda parsed: write_rates_to_db(*parsed)))],
+                        queue_size=max(4, workers))
+    try:
+        pipeline.run(enumerate(req_dates))
+    finally:
+        get_calendar().save()  # dates written before an error are kept in the calendar too
+    return pipeline
 
 
 def check_date(input_data: list, checking_day: int, checking_month: int, checking_year: int) -> None:
@@ -264,37 +635,62 @@ def main():
         database functions
         class definitions
     Secondly, main arguments are defined from the command line by using argparse module:
-        mode ('schedule', 'period', 'schedule_bot', 'telegrambot')
+        mode ('schedule', 'period', 'schedule_bot', 'telegrambot', 'migrate', 'compact', 'recompute')
         request period (optional)
-    For 'schedule' is executed:
-        add_rates_to_db
+    For 'schedule' are executed:
+        catch_up_missed_days
+        add_rates_to_db (by DailyScheduler)
     For 'period' is executed:
         scrapy_month
-    For 'schedule_bot' are executed next functions:
-        add_rates_to_db
-        telegram_bot
+        backfill_dates
+    For 'schedule_bot' are executed together:
+        catch_up_missed_days
+        add_rates_to_db (by DailyScheduler)
+        telegram_bot (in a background thread)
     For 'telegrambot' is executed:
         telegram_bot
+    For 'migrate' is executed:
+        migrate_db_dates
+    For 'compact' is executed:
+        compact_db
+    For 'recompute' is executed:
+        recompute_dynamics
 
     * some functions are same for a few modes,so "if-else" structure was used to prevent code repetition:
 
     if 'schedule' or 'schedule_bot':
         if 'schedule_bot':
-            telegram_bot()
-        add_rates_to_db()
+            start_telegram_bot_thread()
+        catch_up_missed_days()
+        DailyScheduler(scheduled_job).run()
     elif 'period':
         scrapy_month()
     else:  # 'telegrambot'
         telegram_bot()
 
     Extra functions are also used:
-        get_previous_rate
         get_last_rate
         get_rate
-        edit_currency_dynamics
+        get_rates
+        get_period_rates
+        fetch_page
+        parse_rates
+        write_rates_to_db
+        upsert_rate_statement
+        remove_duplicate_rates
+        check_db_migrated
+        update_dynamics
         get_info_for_tlg_bot
         check_date
         get_date_for_scrapy
+        get_calendar
+        get_db_engine
+        get_session
+        release_session
+        str_to_date
+        create_telegram_bot
+        start_telegram_bot_thread
+        scheduled_job
         """
     parser = argparse.ArgumentParser(prog='ScrapyCBR',
                                      usage='scrapy_cbr.py [-h] [mode, query_period(optional)]',
@@ -303,39 +699,62 @@ def main():
         %(prog)s requests exchanged rates of USD and EUR from www.cbr.ru.
         Reference information about script:
           schedule = gets exchange rates according to the schedule, every day at 12:00, and
-          entering the data into a table in the database
+          entering the data into a table in the database,
+          days missed while the script wasn't running are caught up on start
           period "MM.YYYY" = gets exchange rates for the given month "MM.YYYY" and
           entering the data into a table in the database
           schedule_bot = runs "schedule" mode and telegram bot launcher
           telegrambot = runs telegram bot launcher only
+          migrate = converts dates in the existing database into sortable format and indexes them
+          compact = removes duplicate rates from the existing database and rebuilds the database file
+          recompute = recomputes difference and dynamics of all rates in order of dates of rating
           ''')
     parser.add_argument('mode', type=str, help='Choose the mode',
-                        choices=['schedule', 'period', 'schedule_bot', 'telegrambot'])
+                        choices=['schedule', 'period', 'schedule_bot', 'telegrambot', 'migrate', 'compact', 'recompute'])
     parser.add_argument('query_period', type=str,
                         help='Input the period in format "MM.YYYY"', nargs='?', default=None)
+    parser.add_argument('--workers', type=int, default=10,
+                        help='Number of concurrent requests for "period" mode')
+    parser.add_argument('--rps', type=float, default=10,
+                        help='Maximum requests per second for "period" mode, 0 for no limit')
+    cbr_metrics.add_cli_arguments(parser)
     input_args = parser.parse_args()
     query_month = str(input_args.query_period)
     mode = input_args.mode
+    cbr_metrics.setup_from_args(input_args)
 
-    if mode in ['schedule', 'schedule_bot']:
-        if mode == 'schedule_bot':
-            telegram_bot()
+    with cbr_metrics.profile(input_args.profile):
+        if mode != 'migrate':
+            check_db_migrated()
 
-        schedule.every().day.at("12:00").do(add_rates_to_db)
-        while True:
-            schedule.run_pending()
-            time.sleep(1)
+        if mode in ['schedule', 'schedule_bot']:
+            if mode == 'schedule_bot':
+                start_telegram_bot_thread()
 
-    elif mode == 'period':
-        if len(query_month) == 7 and query_month[2] == '.':
-            month = int(query_month[:2])
-            year = int(query_month[-4:])
-        else:
-            sys.exit(f'Invalid format of the inputted period: {query_month}')
-        scrapy_month(month, year)
+            # responses for today are cached for "today_ttl" seconds, so retries wait at least as long
+            scheduler = DailyScheduler(scheduled_job, at=datetime.time(12, 0), retry_delay=2 * today_ttl)
+            catch_up_missed_days(scheduler.last_run_date(datetime.datetime.now()))
+            scheduler.run()
 
-    else:  # mode == 'telegrambot'
-        telegram_bot()
+        elif mode == 'period':
+            if len(query_month) == 7 and query_month[2] == '.':
+                month = int(query_month[:2])
+                year = int(query_month[-4:])
+            else:
+                sys.exit(f'Invalid format of the inputted period: {query_month}')
+            scrapy_month(month, year, input_args.workers, input_args.rps)
+
+        elif mode == 'migrate':
+            migrate_db_dates()
+
+        elif mode == 'compact':
+            compact_db()
+
+        elif mode == 'recompute':
+            recompute_dynamics()
+
+        else:  # mode == 'telegrambot'
+            telegram_bot()
 
 
 if __name__ == '__main__':
@@ -1,155 +1,539 @@
-from bs4 import BeautifulSoup
 from pathlib import Path
-from sqlalchemy import create_engine, Column, Integer, String, Float, ForeignKey
-from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy import Column, Date, DateTime, Index, Integer, String, Float, ForeignKey, func, text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import scoped_session, sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
-from urllib.request import urlopen
+from cbr_calendar import PublicationCalendar
+from cbr_db import DbWriter, create_sqlite_engine
+from cbr_http import base_url, fetch, today_ttl, ttl_for_date
+from cbr_metrics import inc, timed, timer
+from cbr_pipeline import Pipeline, Stage
+from cbr_scheduler import DailyScheduler
+import cbr_metrics
+from collections import OrderedDict
 import argparse
 import datetime
 import os
-import schedule
 import sys
-import telebot
+import threading
 import time
 
 
-request_url = 'https://www.cbr.ru/scripts/XML_daily'
+request_url = f'{base_url}/scripts/XML_daily'
 script_dir = Path(__file__).resolve().parent  # path to the folder with 'cbr_xml.py'
 path_to_database = os.path.join(script_dir, 'rates_db', 'cbr_ru.db')  # path to the database
-db_engine = create_engine(f'sqlite:///{path_to_database}')
-Session = sessionmaker(bind=db_engine)
-session = Session()
+path_to_legacy_database = os.path.join(script_dir, 'rates_db', 'usd_eur.db')  # the database of 'cbr_usd_eur.py'
+legacy_chunk_size = 5000  # rows of the legacy database read and inserted at once by 'import' mode
+export_dir = os.path.join(script_dir, 'rates_db', 'export')  # folder for columnar files of 'export' mode
+# days of publication of the source, shared with 'cbr_usd_eur.py', the source is the same
+path_to_calendar = os.path.join(script_dir, 'rates_db', 'publication_calendar.json')
+tracked_currencies = ('USD', 'EUR')  # currencies requested by 'period' mode and displayed by telegram bot
+known_cbr_ids = {'USD': 'R01235', 'EUR': 'R01239'}  # codes of the source, used until the reference table is filled
+period_window_days = 365  # 'period' mode requests long ranges by windows of this number of days
+api_port = 8080  # port of the HTTP/JSON API of 'api' mode, served on 127.0.0.1 by default
+fetch_workers = 2  # concurrent requests of the ingest pipeline, documents are parsed and written meanwhile
+sync_start_date = datetime.date(1992, 7, 1)  # the first date of rates for a period in the source, used by 'sync' mode
+# the engine and the per-thread sessions are created on first use by get_db_engine() and get_session(),
+# all writes are executed one after another by the single writer thread "db_writer"
+_db_engine = None
+_session = None
+_calendar = None
+_db_lock = threading.Lock()
+db_writer = DbWriter(name='db-writer', on_error=lambda: release_session())  # a failed write is rolled back
 Base = declarative_base()
+# the legacy tables have their own metadata, so create_all() of "Base" doesn't add them to new databases
+LegacyBase = declarative_base()
 
 
-class Currency(Base):
+class CurrencyInfo(Base):
     """
-    The table for each currency includes rate on a given by user date, date from the source,
+    The reference table of currencies given by the source.
+    "char_code" is ISO char code of currency, e.g. 'USD'
+    "cbr_id" is code of currency in the source, e.g. 'R01235', it is used for requesting rates for a period
+    "num_code" is ISO numeric code of currency
+    "name" is name of currency given by the source
+    """
+    __tablename__ = 'currencies'
+    char_code = Column(String(3), primary_key=True)
+    cbr_id = Column(String, unique=True, index=True)
+    num_code = Column(String, default=None)
+    name = Column(String, default=None)
+
+
+class Rate(Base):
+    """
+    The table with rates of all currencies in long format, one row per currency and date,
+    the difference and the dynamics of change is given relatively to the previous rate of the currency.
+    "char_code" and "request_date" are the composite primary key, "request_date" is also indexed
+    for queries across all currencies
+    "request_date" is requesting date of exchange rates given by user, stored as sortable ISO date
+    "nominal" is number of currency units the rate is given for
+    "currency_rate" is rate at requesting date
+    "currency_dynamics" displays that rate increased, decreased or has no change in order to its previous value
+    "scraping_site" is website for getting exchange rates, default 'www.cbr.ru'
+    "scraping_datetime" is date&time of script running
+    """
+    __tablename__ = 'rates'
+    char_code = Column(String(3), ForeignKey('currencies.char_code'), primary_key=True)
+    request_date = Column(Date, primary_key=True)
+    nominal = Column(Integer, default=1)
+    currency_rate = Column(Float, default=None)
+    currency_dynamics = Column(String, default=None)
+    scraping_site = Column(String, default='www.cbr.ru')
+    scraping_datetime = Column(DateTime, default=datetime.datetime.now)
+    __table_args__ = (Index('ix_rates_request_date', 'request_date'),)
+
+
+class SyncedRange(Base):
+    """
+    The table with checkpoints of 'sync' mode: ranges of dates already requested from the source for the currency,
+    dates of the ranges without rates are days off of the source and aren't requested again.
+    Adjacent and overlapping ranges of the currency are merged into one row.
+    "from_date" and "to_date" are the first and the last date of the range
+    """
+    __tablename__ = 'synced_ranges'
+    id = Column(Integer, primary_key=True)
+    char_code = Column(String(3), ForeignKey('currencies.char_code'))
+    from_date = Column(Date)
+    to_date = Column(Date)
+    __table_args__ = (Index('ix_synced_ranges_char_code', 'char_code', 'from_date'),)
+
+
+class Currency(LegacyBase):
+    """
+    The legacy table for each currency, used before the table "rates", is kept for migration of existing databases.
+    The table includes rate on a given by user date, date from the source,
     the difference and the dynamics of change is given relatively to the previous rate on the date given by the source.
     "scraping_site" is website for getting exchange rates, default 'www.cbr.ru'
     "scraping_datetime" is date&time of script running
-    "request_date" is requesting date of exchange rates given by user
+    "request_date" is requesting date of exchange rates given by user, stored as sortable ISO date and indexed
     "currency_rate" is rate at requesting date
     "currency_dynamics" displays that rate increased, decreased or has no change in order to its previous value
     """
     __abstract__ = True
     id = Column(Integer, primary_key=True, autoincrement=True)
     scraping_site = Column(String, default='www.cbr.ru')
-    scraping_datetime = Column(String, default=datetime.datetime.now())
-    request_date = Column(String, default=None)
+    scraping_datetime = Column(DateTime, default=datetime.datetime.now)
+    request_date = Column(Date, default=None, index=True)
     currency_rate = Column(Float, default=None)
     currency_dynamics = Column(String, default=None)
 
 
 class USD(Currency):
     """
-    The table with USD rates.
+    The legacy table with USD rates.
     """
     __tablename__ = 'USD rates'
 
 
 class EUR(Currency):
     """
-    The table with EUR rates.
+    The legacy table with EUR rates.
     """
     __tablename__ = 'EUR rates'
 
 
+def get_db_engine() -> 'sqlalchemy.engine.Engine':
+    """Returns the database engine (WAL journal and tuned pragmas), created on first use."""
+    global _db_engine
+    with _db_lock:
+        if _db_engine is None:
+            _db_engine = create_sqlite_engine(path_to_database)
+        return _db_engine
+
+
+def get_session() -> 'sqlalchemy.orm.Session':
+    """Returns the database session of the current thread, created on first use."""
+    global _session
+    engine = get_db_engine()
+    with _db_lock:
+        if _session is None:
+            _session = scoped_session(sessionmaker(bind=engine))
+    return _session()
+
+
+def release_session() -> None:
+    """Closes the session of the current thread, so the next read sees the latest committed data."""
+    if _session is not None:
+        _session.remove()
+
+
+def get_calendar() -> PublicationCalendar:
+    """Returns the calendar of publication days of the source, loaded from the cache on first use."""
+    global _calendar
+    with _db_lock:
+        if _calendar is None:
+            _calendar = PublicationCalendar(path_to_calendar)
+            _calendar.load()
+        return _calendar
+
+
 def get_rates_and_add_to_db(request_date: str) -> 'database':
-    """Adds exchange rates, difference and dynamics of changing to the appropriate tables in the database."""
-    usd_rate = get_rate_xml(request_date, 'USD')
-    add_data_to_db(USD, request_date, usd_rate)
+    """Adds exchange rates of all currencies, difference and dynamics of changing to the table in the database."""
+    ingest_daily_rates([request_date], workers=1)
 
-    eur_rate = get_rate_xml(request_date, 'EUR')
-    add_data_to_db(EUR, request_date, eur_rate)
 
+def ingest_daily_rates(request_dates: list, workers: int = fetch_workers) -> Pipeline:
+    """Adds exchange rates of all currencies on each of the dates by the pipeline fetch -> parse -> write:
+    the next dates are requested by "workers" threads while the previous ones are parsed and written.
+    Returns the pipeline with time of its stages."""
+    def parse_stage(fetched: tuple) -> tuple:
+        request_date, xml_cbr = fetched
+        daily_rates = parse_daily_rates(xml_cbr)
+        if not daily_rates:
+            sys.exit(f'Error! There are no rates on {request_date} in the source')
+        return request_date, daily_rates
 
-def get_rate_xml(requesting_date: str, currency_name: str) -> float:
-    """Scrapes URL for getting rate of the given currency and date of rating."""
-    scraping_url = f'https://cbr.ru/scripts/XML_daily.asp?date_req={requesting_date}'
+    pipeline = Pipeline('daily', [
+        Stage('fetch', lambda request_date: (request_date, fetch_daily_xml(request_date)), workers),
+        Stage('parse', parse_stage),
+        Stage('write', lambda parsed: add_daily_rates_to_db(*parsed))])  # one request for all currencies on the date
+    pipeline.run(request_dates)
+    return pipeline
+
+
+def get_daily_xml(requesting_date: str) -> list:
+    """Scrapes URL once for the given date and returns info about all currencies published by the source:
+    list of dicts with keys 'char_code', 'cbr_id', 'num_code', 'name', 'nominal', 'currency_rate'."""
+    return parse_daily_rates(fetch_daily_xml(requesting_date))
+
+
+def fetch_daily_xml(requesting_date: str) -> bytes:
+    """Scrapes URL once for the given date and returns XML document with rates of all currencies."""
+    scraping_url = f'{request_url}.asp?date_req={requesting_date}'
     try:
-        xml_cbr = urlopen(scraping_url)
-        bs_obj = BeautifulSoup(xml_cbr, 'lxml')
-        currency_rate = (bs_obj.find('charcode',
-                                     text={currency_name}).parent.find('value').get_text()).replace(',', '.')
-        currency_rate = float(currency_rate)
+        with timer('cbr_fetch_seconds', document='XML_daily'):
+            return fetch(scraping_url, ttl_for_date(str_to_date(requesting_date)))
     except Exception as err:
         sys.exit(f'Error! Scrapy failed:\n{err}')
-    else:
-        return float(f'{currency_rate:.2f}')
 
 
-def add_data_to_db(currency_name: type, request_date: str, cur_rate: float) -> 'database':
-    """Adds exchange rates, difference and dynamics of changing to the appropriate tables in the database."""
+def parse_daily_rates(xml_cbr: bytes) -> list:
+    """Returns info about all currencies of XML_daily document as list of dicts, see get_daily_xml()."""
+    try:
+        from cbr_parsers import parse_daily_xml
+        with timer('cbr_parse_seconds', document='XML_daily'):
+            return [rate_info._asdict() for rate_info in parse_daily_xml(xml_cbr)]
+    except Exception as err:
+        sys.exit(f'Error! Parsing failed:\n{err}')
+
+
+def get_rates_xml(requesting_date: str) -> dict:
+    """Scrapes URL once for the given date and returns rates of all currencies published by the source
+    as a mapping {char code: rate}, e.g. {'AUD': 54.12, ..., 'USD': 75.76, ...}."""
+    return {rate_info['char_code']: rate_info['currency_rate'] for rate_info in get_daily_xml(requesting_date)}
+
+
+def get_rate_xml(requesting_date: str, currency_name: str) -> float:
+    """Scrapes URL for getting rate of the given currency and date of rating."""
+    daily_rates = get_rates_xml(requesting_date)
+    if currency_name not in daily_rates:
+        sys.exit(f'Error! There is no {currency_name} rate on {requesting_date} in the source')
+    return daily_rates[currency_name]
+
+
+def str_to_date(date_str: str) -> datetime.date:
+    """Returns date from the string in format 'DD.MM.YYYY' or 'DD/MM/YYYY'."""
+    return datetime.datetime.strptime(date_str.strip().replace('/', '.'), '%d.%m.%Y').date()
+
+
+def upsert_statement(table_name: type) -> 'sqlalchemy.sql.Insert':
+    """Returns bulk "INSERT ... ON CONFLICT (primary key) DO UPDATE" statement for the table,
+    so repeated ingest of the same currency and date updates the row instead of adding a duplicate."""
+    table = table_name.__table__
+    statement = sqlite_insert(table)
+    primary_key = [column.name for column in table.primary_key.columns]
+    return statement.on_conflict_do_update(
+        index_elements=primary_key,
+        set_={column.name: statement.excluded[column.name] for column in table.columns if column.name not in primary_key})
+
+
+@timed('cbr_db_write_seconds', function='add_data_to_db')
+@db_writer.serialized
+def add_data_to_db(char_code: str, request_date: str, cur_rate: float, nominal: int = 1) -> 'database':
+    """Adds exchange rate of the currency, difference and dynamics of changing to the table in the database."""
     try:
-        script_run_datetime = datetime.datetime.now().strftime('%d.%m.%Y %H:%M:%S')
-        cur_previous = get_previous_rate(currency_name, request_date)
-        cur_dyn = edit_currency_dynamics(cur_rate, cur_previous)
-
-        Base.metadata.create_all(db_engine)
-        data_cur_rate = currency_name(scraping_datetime=script_run_datetime, request_date=request_date,
-                                      currency_rate=cur_rate, currency_dynamics=cur_dyn)
-        session.add(data_cur_rate)
-        session.commit()
+        script_run_datetime = datetime.datetime.now().replace(microsecond=0)
+        request_date = str_to_date(request_date)
+
+        Base.metadata.create_all(get_db_engine())
+        get_session().execute(upsert_statement(Rate), [{
+            'char_code': char_code, 'request_date': request_date, 'nominal': nominal,
+            'scraping_datetime': script_run_datetime, 'currency_rate': cur_rate}])
+        update_dynamics(get_session(), char_code, request_date, request_date)
+        get_session().commit()
+        rates_cache.invalidate()
+        inc('cbr_rows_written_total', table=Rate.__tablename__)
     except Exception as err:
         sys.exit(f'Error! Adding data to database failed:\n{err}')
 
 
-def get_previous_rate(currency_name: type, req_date: str) -> float:
-    """Returns from the appropriate table previous rate of given currency for the last date of rating from the source,
-     without taking into account the requested date of the rate."""
-    prev_rate = None
+@timed('cbr_db_write_seconds', function='add_daily_rates_to_db')
+@db_writer.serialized
+def add_daily_rates_to_db(request_date: str, daily_rates: list) -> 'database':
+    """Adds exchange rates of all currencies on the date, difference and dynamics of changing
+    to the table in the database with one bulk insert, info about currencies is added to the reference table.
+    "daily_rates" is a list of dicts returned by get_daily_xml()."""
     try:
-        prev_rate_info = session.query(currency_name).filter(currency_name.request_date != req_date).order_by(
-            currency_name.id.desc()).first()  # getting last rate with not {req_date} date
-        prev_rate = prev_rate_info.currency_rate
+        script_run_datetime = datetime.datetime.now().replace(microsecond=0)
+        request_date = str_to_date(request_date)
+
+        Base.metadata.create_all(get_db_engine())
+        currencies = [{'char_code': rate_info['char_code'], 'cbr_id': rate_info['cbr_id'],
+                       'num_code': rate_info['num_code'], 'name': rate_info['name']} for rate_info in daily_rates]
+        rows = [{'char_code': rate_info['char_code'], 'request_date': request_date, 'nominal': rate_info['nominal'],
+                 'scraping_datetime': script_run_datetime, 'currency_rate': rate_info['currency_rate']}
+                for rate_info in daily_rates]
+        get_session().execute(upsert_statement(CurrencyInfo), currencies)
+        get_session().execute(upsert_statement(Rate), rows)
+        update_dynamics(get_session(), None, request_date, request_date)  # all currencies in one statement
+        get_session().commit()
+        rates_cache.invalidate()
+        inc('cbr_rows_written_total', len(rows), table=Rate.__tablename__)
     except Exception as err:
-        sys.exit(f'Error in getting previous rate:\n{err}')
-    finally:
-        return prev_rate
+        get_session().rollback()
+        sys.exit(f'Error! Adding data to database failed:\n{err}')
 
 
-def edit_currency_dynamics(current_rate: float, previous_rate: float) -> str or None:
-    """Returns detailed description of the given currency rate change:
-    difference between rates and dynamics of the change."""
-    if previous_rate is None:
-        return None
-    else:
-        if current_rate > previous_rate:
-            return f'+{(current_rate-previous_rate):.2f}'
-        else:
-            return f'{(current_rate-previous_rate):.2f}'
+# dynamics of each row is the difference from the previous rate of the currency in order of dates,
+# LAG() gives the previous rate of all rows in one pass; the updated rows are limited to the range of dates
+# and the next stored date after it, the window includes the stored date before the range
+dynamics_sql = text("""
+    UPDATE rates SET currency_dynamics = CASE
+            WHEN ordered.previous_rate IS NULL THEN NULL
+            WHEN rates.currency_rate > ordered.previous_rate
+                THEN printf('+%.2f', rates.currency_rate - ordered.previous_rate)
+            ELSE printf('%.2f', rates.currency_rate - ordered.previous_rate) END
+    FROM (SELECT char_code, request_date,
+                 LAG(currency_rate) OVER (PARTITION BY char_code ORDER BY request_date) AS previous_rate
+          FROM rates AS history
+          WHERE (:char_code IS NULL OR char_code = :char_code)
+            AND request_date >= coalesce((SELECT max(request_date) FROM rates
+                                          WHERE char_code = history.char_code AND request_date < :from_date),
+                                         :from_date)
+            AND request_date <= coalesce((SELECT min(request_date) FROM rates
+                                          WHERE char_code = history.char_code AND request_date > :to_date),
+                                         :to_date)) AS ordered
+    WHERE rates.char_code = ordered.char_code AND rates.request_date = ordered.request_date
+      AND rates.request_date >= :from_date""")
+
 
+def update_dynamics(connection: 'sqlalchemy.orm.Session or sqlalchemy.engine.Connection', char_code: str or None,
+                    from_date: datetime.date, to_date: datetime.date) -> int:
+    """Sets dynamics of rates of the currency (all currencies if None) for the range of dates and of the next stored
+    date after it by one set-based statement in the transaction of the caller. Returns number of updated rows."""
+    return connection.execute(dynamics_sql, {'char_code': char_code, 'from_date': from_date.isoformat(),
+                                             'to_date': to_date.isoformat()}).rowcount
 
-def scrapy_period(currency_name: type, cur_id: str, from_date: str, to_date: str) -> 'database':
+
+@timed('cbr_db_write_seconds', function='recompute_dynamics')
+@db_writer.serialized
+def recompute_dynamics() -> 'database':
+    """Recomputes difference and dynamics of changing of all rows in the table "rates" in order of dates."""
+    try:
+        Base.metadata.create_all(get_db_engine())
+        with get_db_engine().begin() as connection:
+            updated_rows = update_dynamics(connection, None, datetime.date.min, datetime.date.max)
+        rates_cache.invalidate()
+        print(f'Dynamics of {updated_rows} rows recomputed')
+    except Exception as err:
+        sys.exit(f'Error! Recomputing of dynamics failed:\n{err}')
+
+
+def scrapy_period(char_code: str, cur_id: str, from_date: str, to_date: str, bulk: bool = True,
+                  window_days: int = period_window_days, workers: int = fetch_workers) -> 'database':
     """Scrapes URL for getting rate of the given currency and period of rating.
     Adds exchange rates, difference and dynamics of changing
-    to the appropriate tables in the database for inputted period."""
+    to the table in the database for inputted period.
+    The period is requested by windows of "window_days" days through the pipeline fetch -> parse -> write:
+    "workers" windows are requested at once while the previous ones are parsed and committed.
+    Each window is fetched, parsed and written whole and the queues between the stages are bounded,
+    so memory is bounded by the window size and doesn't depend on the length of the period,
+    and an interrupted run keeps the committed windows.
+    In bulk mode each window is written in one transaction, otherwise row by row."""
+    def write_window(window: tuple, window_rates: list) -> int:
+        if bulk:
+            add_period_to_db(char_code, window_rates)
+        else:
+            for currency_date, currency_rate, nominal in window_rates:
+                add_data_to_db(char_code, f'{currency_date:%d.%m.%Y}', currency_rate, nominal)
+        return len(window_rates)
+
+    start_time = time.perf_counter()
+    pipeline = period_pipeline(cur_id, write_window, workers)
+    rows_number = sum(pipeline.run(split_period(str_to_date(from_date), str_to_date(to_date), window_days)))
+    report_ingest_speed(char_code, rows_number, time.perf_counter() - start_time)
+    print(f'{char_code} pipeline: {pipeline.report()}')
+
+
+def period_pipeline(cur_id: str, write_window, workers: int = fetch_workers) -> Pipeline:
+    """Returns pipeline of windows (first date, last date) of a period of the currency: XML_dynamic of each window
+    is requested by "workers" threads, parsed and passed to "write_window(window, window_rates)"
+    in the single writing stage, the pipeline returns its results."""
+    def parse_stage(fetched: tuple) -> tuple:
+        window, xml_cbr = fetched
+        return window, parse_period_xml(xml_cbr)
+
+    return Pipeline('period', [
+        Stage('fetch', lambda window: (window, fetch_period_xml(cur_id, *window)), workers),
+        Stage('parse', parse_stage),
+        Stage('write', lambda parsed: write_window(*parsed))])
+
+
+def split_period(from_date: datetime.date, to_date: datetime.date, window_days: int) -> list:
+    """Returns list of (first date, last date) of consecutive windows of "window_days" days covering the period."""
+    windows = list()
+    window_from = from_date
+    while window_from <= to_date:
+        window_to = min(window_from + datetime.timedelta(days=max(1, window_days) - 1), to_date)
+        windows.append((window_from, window_to))
+        window_from = window_to + datetime.timedelta(days=1)
+    return windows
+
+
+def get_period_xml(cur_id: str, from_date: datetime.date, to_date: datetime.date) -> list:
+    """Scrapes URL once for the given currency code of the source and period
+    and returns list of (date, rate, nominal) records in order of dates."""
+    return parse_period_xml(fetch_period_xml(cur_id, from_date, to_date))
+
+
+def fetch_period_xml(cur_id: str, from_date: datetime.date, to_date: datetime.date) -> bytes:
+    """Scrapes URL once for the given currency code of the source and period and returns XML document."""
     # https://www.cbr.ru/scripts/XML_dynamic.asp?date_req1={DD/MM/YYYY}&date_req2={DD/MM/YYYY}&VAL_NM_RQ={currency_id}
-    req_url = f'https://www.cbr.ru/scripts/XML_dynamic.asp?date_req1={from_date}&date_req2={to_date}&VAL_NM_RQ={cur_id}'
+    req_url = (f'{base_url}/scripts/XML_dynamic.asp?'
+               f'date_req1={from_date:%d/%m/%Y}&date_req2={to_date:%d/%m/%Y}&VAL_NM_RQ={cur_id}')
     try:
-        xml_cbr = urlopen(req_url)
-        bs_obj = BeautifulSoup(xml_cbr, 'lxml')
-        full_data = bs_obj.find_all('record')
+        with timer('cbr_fetch_seconds', document='XML_dynamic'):
+            return fetch(req_url, ttl_for_date(to_date))
+    except Exception as err:
+        sys.exit(f'Error! Scrapy failed:\n{err}')
 
-        for rate_info in full_data:
-            currency_date = rate_info.get('date')
-            currency_rate = float(f"{float(rate_info.find('value').get_text().replace(',', '.')):.2f}")
-            add_data_to_db(currency_name, currency_date, currency_rate)
 
+def parse_period_xml(xml_cbr: bytes) -> list:
+    """Returns list of (date, rate, nominal) records of XML_dynamic document in order of dates.
+    The document of one window is parsed at once, the window size is the memory bound of a period."""
+    try:
+        from cbr_parsers import parse_dynamic_xml
+        with timer('cbr_parse_seconds', document='XML_dynamic'):
+            return parse_dynamic_xml(xml_cbr)
     except Exception as err:
-        sys.exit(f'Error! Scrapy failed:\n{err}')
+        sys.exit(f'Error! Parsing failed:\n{err}')
+
+
+@timed('cbr_db_write_seconds', function='add_period_to_db')
+@db_writer.serialized
+def add_period_to_db(char_code: str, period_rates: list) -> 'database':
+    """Adds exchange rates, difference and dynamics of changing for the whole period
+    to the table in the database with one bulk insert in one transaction.
+    "period_rates" is a list of (date, rate, nominal), dynamics is set by one statement after the insert."""
+    if not period_rates:
+        return
+    try:
+        script_run_datetime = datetime.datetime.now().replace(microsecond=0)
+        period_rates = sorted(period_rates)
+
+        Base.metadata.create_all(get_db_engine())
+        rows = [{'char_code': char_code, 'request_date': currency_date, 'nominal': nominal,
+                 'scraping_datetime': script_run_datetime, 'currency_rate': currency_rate}
+                for currency_date, currency_rate, nominal in period_rates]
+        get_session().execute(upsert_statement(Rate), rows)
+        update_dynamics(get_session(), char_code, period_rates[0][0], period_rates[-1][0])
+        get_session().commit()
+        rates_cache.invalidate()
+        inc('cbr_rows_written_total', len(rows), table=Rate.__tablename__)
+    except Exception as err:
+        get_session().rollback()
+        sys.exit(f'Error! Adding data to database failed:\n{err}')
+
+
+def sync_currency(char_code: str, cur_id: str, from_date: datetime.date, to_date: datetime.date,
+                  window_days: int = period_window_days, workers: int = fetch_workers) -> 'database':
+    """Requests from the source only the dates of the period which have neither rate of the currency
+    in the table nor a checkpoint, by windows of "window_days" days through the pipeline of scrapy_period().
+    The checkpoint of each window is saved after its rates are committed, so an interrupted run is resumed."""
+    def write_window(window: tuple, window_rates: list) -> int:
+        window_from, window_to = window
+        add_period_to_db(char_code, window_rates)
+        # rates on today and later can still be published, so they aren't checkpointed
+        checkpoint_to = min(window_to, datetime.date.today() - datetime.timedelta(days=1))
+        if checkpoint_to >= window_from:
+            add_synced_range(char_code, window_from, checkpoint_to)
+        return len(window_rates)
+
+    missing_ranges = get_missing_ranges(char_code, from_date, to_date)
+    windows = [window for missing_from, missing_to in missing_ranges
+               for window in split_period(missing_from, missing_to, window_days)]
+    start_time = time.perf_counter()
+    rows_number = sum(period_pipeline(cur_id, write_window, workers).run(windows))
+    print(f'{char_code}: {len(missing_ranges)} missing ranges, {len(windows)} requests')
+    report_ingest_speed(char_code, rows_number, time.perf_counter() - start_time)
+
 
+def get_missing_ranges(char_code: str, from_date: datetime.date, to_date: datetime.date) -> list:
+    """Returns list of (first date, last date) of consecutive dates of the period
+    which have neither rate of the currency in the table nor a checkpoint of 'sync' mode."""
+    missing_ranges = list()
+    try:
+        Base.metadata.create_all(get_db_engine())
+        known_dates = {rate_date for rate_date, in get_session().query(Rate.request_date).filter(
+            Rate.char_code == char_code, Rate.request_date.between(from_date, to_date))}
+        synced_ranges = get_session().query(SyncedRange.from_date, SyncedRange.to_date).filter(
+            SyncedRange.char_code == char_code, SyncedRange.from_date <= to_date, SyncedRange.to_date >= from_date)
+        for synced_from, synced_to in synced_ranges:
+            known_dates.update(synced_from + datetime.timedelta(days=day)
+                               for day in range((synced_to - synced_from).days + 1))
+        range_from = None
+        checking_date = from_date
+        while checking_date <= to_date + datetime.timedelta(days=1):
+            missing = checking_date <= to_date and checking_date not in known_dates
+            if missing and range_from is None:
+                range_from = checking_date
+            elif not missing and range_from is not None:
+                missing_ranges.append((range_from, checking_date - datetime.timedelta(days=1)))
+                range_from = None
+            checking_date += datetime.timedelta(days=1)
+    except Exception as err:
+        sys.exit(f'Error in getting missing dates:\n{err}')
+    finally:
+        release_session()
+        return missing_ranges
+
+
+@timed('cbr_db_write_seconds', function='add_synced_range')
+@db_writer.serialized
+def add_synced_range(char_code: str, from_date: datetime.date, to_date: datetime.date) -> 'database':
+    """Saves checkpoint of 'sync' mode, the range is merged with adjacent and overlapping ranges of the currency."""
+    try:
+        one_day = datetime.timedelta(days=1)
+        overlapping = get_session().query(SyncedRange).filter(
+            SyncedRange.char_code == char_code,
+            SyncedRange.from_date <= to_date + one_day, SyncedRange.to_date >= from_date - one_day).all()
+        for synced_range in overlapping:
+            from_date = min(from_date, synced_range.from_date)
+            to_date = max(to_date, synced_range.to_date)
+            get_session().delete(synced_range)
+        get_session().add(SyncedRange(char_code=char_code, from_date=from_date, to_date=to_date))
+        get_session().commit()
+    except Exception as err:
+        get_session().rollback()
+        sys.exit(f'Error! Adding checkpoint to database failed:\n{err}')
+
+
+def report_ingest_speed(char_code: str, rows_number: int, elapsed_time: float) -> None:
+    """Prints number of added rows and ingest speed in rows per second."""
+    rows_per_sec = rows_number / elapsed_time if elapsed_time > 0 else float('inf')
+    print(f'{char_code} rates: {rows_number} rows added in {elapsed_time:.3f} s ({rows_per_sec:.0f} rows/s)')
 
-def last_rate_for_tlg(currency_name: type) -> float and str and str:
-    """Returns from the appropriate table last inputted data:
+
+def last_rate_for_tlg(char_code: str) -> float and str and str:
+    """Returns from the table last inputted data of given currency:
     rate, date of rating, difference from the previous value, dynamics of rate changing."""
     last_rate = None
     last_rate_date = None
     last_rate_dyn = None
     try:
-        last_row = session.query(currency_name).count()  # number of the last row in table
-        last_data = session.query(currency_name).get(last_row)  # full info from the last row in table
+        last_data = get_session().query(Rate).filter(Rate.char_code == char_code).order_by(
+            Rate.request_date.desc()).first()  # the row with the latest date
         last_rate = last_data.currency_rate  # last given currency_rate in the table
         last_rate_date = last_data.request_date  # last given request_date in the table
         last_rate_dyn = last_data.currency_dynamics  # last given currency_dynamics in the table
@@ -159,12 +543,12 @@ def last_rate_for_tlg(currency_name: type) -> float and str and str:
         return last_rate, last_rate_date, last_rate_dyn
 
 
-def get_rate_on_date(currency_name: type, input_date: str) -> float:
-    """Returns from the appropriate table rate of given currency on inputted date."""
+def get_rate_on_date(char_code: str, input_date: str) -> float:
+    """Returns from the table rate of given currency on inputted date."""
     rate_on_date = None
     try:
-        query_data = session.query(currency_name).filter(currency_name.request_date == input_date).order_by(
-            currency_name.id.desc()).first()
+        query_data = get_session().query(Rate.currency_rate).filter(
+            Rate.char_code == char_code, Rate.request_date == str_to_date(input_date)).first()
         rate_on_date = query_data.currency_rate
     except Exception as err:
         sys.exit(f'Error in getting last rate:\n{err}')
@@ -172,44 +556,387 @@ def get_rate_on_date(currency_name: type, input_date: str) -> float:
         return rate_on_date
 
 
-def process_mode_telegrambot():
-    """Starts telegram bot. Help, display rates and test function are realised."""
+def get_rates_on_date(input_date: str) -> dict:
+    """Returns from the table rates of all currencies on inputted date {char code: rate} by one indexed query."""
+    rates_on_date = dict()
+    try:
+        query_data = get_session().query(Rate.char_code, Rate.currency_rate).filter(
+            Rate.request_date == str_to_date(input_date))
+        rates_on_date = {char_code: rate for char_code, rate in query_data}
+    except Exception as err:
+        sys.exit(f'Error in getting rates on date:\n{err}')
+    finally:
+        return rates_on_date
+
+
+def get_rates_for_period(char_code: str, from_date: str, to_date: str) -> list:
+    """Returns from the table list of (date, rate) of given currency for inputted period,
+    ordered by date. The range is filtered by the primary key ("char_code", "request_date")."""
+    period_rates = list()
+    try:
+        query_data = get_session().query(Rate.request_date, Rate.currency_rate).filter(
+            Rate.char_code == char_code,
+            Rate.request_date.between(str_to_date(from_date), str_to_date(to_date))).order_by(Rate.request_date)
+        period_rates = [(rate_date, rate) for rate_date, rate in query_data]
+    except Exception as err:
+        sys.exit(f'Error in getting rates for period:\n{err}')
+    finally:
+        return period_rates
+
+
+def get_first_rate_date(char_code: str) -> datetime.date or None:
+    """Returns the first date of the stored rates of given currency or None if there are no rates."""
+    first_date = None
+    try:
+        Base.metadata.create_all(get_db_engine())
+        first_date = get_session().query(func.min(Rate.request_date)).filter(Rate.char_code == char_code).scalar()
+    except Exception as err:
+        sys.exit(f'Error in getting first date of rates:\n{err}')
+    finally:
+        release_session()
+        return first_date
+
+
+def get_cbr_id(char_code: str) -> str:
+    """Returns code of the currency in the source (e.g. 'R01235' for 'USD') from the reference table
+    or "known_cbr_ids", the reference table is filled from the source if the currency is unknown."""
+    cbr_id = query_cbr_id(char_code) or known_cbr_ids.get(char_code)
+    if cbr_id is None:
+        update_currencies_reference()
+        cbr_id = query_cbr_id(char_code)
+    if cbr_id is None:
+        sys.exit(f'Error! Unknown currency {char_code}')
+    return cbr_id
+
+
+def query_cbr_id(char_code: str) -> str or None:
+    """Returns code of the currency in the source from the reference table."""
+    cbr_id = None
+    try:
+        currency_info = get_session().get(CurrencyInfo, char_code)
+        cbr_id = currency_info.cbr_id
+    except Exception:  # there is no currency or no reference table yet
+        get_session().rollback()
+    finally:
+        release_session()
+    return cbr_id
+
+
+@db_writer.serialized
+def update_currencies_reference() -> 'database':
+    """Fills the reference table of currencies from the list of all currency codes of the source."""
+    # https://www.cbr.ru/scripts/XML_valFull.asp
+    try:
+        from cbr_parsers import parse_currencies_xml
+        xml_cbr = fetch(f'{base_url}/scripts/XML_valFull.asp', ttl=24 * 60 * 60)
+        currencies = [currency_info._asdict() for currency_info in parse_currencies_xml(xml_cbr)]
+        Base.metadata.create_all(get_db_engine())
+        if currencies:
+            get_session().execute(upsert_statement(CurrencyInfo), currencies)
+        get_session().commit()
+    except Exception as err:
+        get_session().rollback()
+        sys.exit(f'Error! Updating of currencies failed:\n{err}')
+
+
+@db_writer.serialized
+def migrate_db_dates() -> 'database':
+    """Converts dates stored as 'DD.MM.YYYY' / 'DD/MM/YYYY' strings in the legacy tables of the existing database
+    into sortable ISO format and creates indexes on the date columns. Already converted rows are skipped."""
+    date_pattern = '[0-3][0-9][./][0-1][0-9][./][0-9][0-9][0-9][0-9]*'
+    try:
+        db_engine = get_db_engine()
+        with db_engine.begin() as connection:
+            for currency_name in (USD, EUR):
+                table = currency_name.__table__
+                if not db_engine.dialect.has_table(connection, table.name):
+                    continue
+                for column_name in ('request_date', 'scraping_datetime'):
+                    connection.execute(text(
+                        f'UPDATE "{table.name}" SET {column_name} = '
+                        f"substr({column_name}, 7, 4) || '-' || substr({column_name}, 4, 2) || '-' || "
+                        f"substr({column_name}, 1, 2) || substr({column_name}, 11) "
+                        f"WHERE {column_name} GLOB '{date_pattern}'"))
+                for index in table.indexes:
+                    index.create(bind=connection, checkfirst=True)
+    except Exception as err:
+        sys.exit(f'Error! Migration of the database failed:\n{err}')
+
+
+@db_writer.serialized
+def migrate_legacy_tables() -> 'database':
+    """Copies rates from the legacy tables "USD rates" and "EUR rates" into the table "rates"
+    by one INSERT ... SELECT per table, the newest row of each date is kept."""
+    try:
+        db_engine = get_db_engine()
+        Base.metadata.create_all(db_engine, tables=[CurrencyInfo.__table__, Rate.__table__])
+        with db_engine.begin() as connection:
+            for currency_name in (USD, EUR):
+                table = currency_name.__table__
+                char_code = currency_name.__name__
+                if not db_engine.dialect.has_table(connection, table.name):
+                    continue
+                connection.execute(text('INSERT INTO currencies (char_code, cbr_id) VALUES (:code, :cbr_id) '
+                                        'ON CONFLICT (char_code) DO NOTHING'),
+                                   {'code': char_code, 'cbr_id': known_cbr_ids[char_code]})
+                connection.execute(text(
+                    'INSERT INTO rates (char_code, request_date, nominal, currency_rate, currency_dynamics, '
+                    'scraping_site, scraping_datetime) '
+                    'SELECT :code, request_date, 1, currency_rate, currency_dynamics, scraping_site, scraping_datetime '
+                    f'FROM "{table.name}" WHERE request_date IS NOT NULL ORDER BY id '
+                    'ON CONFLICT (char_code, request_date) DO UPDATE SET currency_rate = excluded.currency_rate, '
+                    'currency_dynamics = excluded.currency_dynamics, scraping_site = excluded.scraping_site, '
+                    'scraping_datetime = excluded.scraping_datetime'), {'code': char_code})
+    except Exception as err:
+        sys.exit(f'Error! Migration of the legacy tables failed:\n{err}')
+
+
+# rows of a table of the legacy database, the newest row of each requested date, with the site from "Scraping Info";
+# dates of not migrated databases are 'DD.MM.YYYY', they are grouped by the date converted to ISO format;
+# "Scraping Info" is joined as one row per time of scraping, so the join is planned by hash or automatic index
+# even if the legacy database has no index on "scraping_datetime"
+legacy_rows_sql = """
+    SELECT rates.request_date, rates.currency_rate, rates.{prefix}_scraping_datetime, info.scraping_site
+    FROM "{table_name}" AS rates
+    LEFT JOIN (SELECT scraping_datetime, min(scraping_site) AS scraping_site FROM "Scraping Info"
+               GROUP BY scraping_datetime) AS info ON info.scraping_datetime = rates.{prefix}_scraping_datetime
+    WHERE rates.id IN (SELECT max(id) FROM "{table_name}" WHERE request_date IS NOT NULL
+                       GROUP BY CASE WHEN request_date GLOB '[0-3][0-9][./][0-1][0-9][./]*'
+                                     THEN substr(request_date, 7, 4) || '-' || substr(request_date, 4, 2) || '-' ||
+                                          substr(request_date, 1, 2)
+                                     ELSE request_date END)
+    ORDER BY rates.id"""
+
+
+def legacy_to_datetime(value: str or None) -> datetime.datetime or None:
+    """Returns date and time from 'YYYY-MM-DD HH:MM:SS' or 'DD.MM.YYYY HH:MM:SS' of the legacy database,
+    the string is rearranged into ISO format instead of slow strptime()."""
+    if not value:
+        return None
+    if value[2] in './':
+        value = f'{value[6:10]}-{value[3:5]}-{value[:2]}{value[10:]}'
+    return datetime.datetime.fromisoformat(value)
+
+
+def legacy_to_date(value: str) -> datetime.date:
+    """Returns date from 'YYYY-MM-DD' or 'DD.MM.YYYY' of the legacy database."""
+    if value[2] in './':
+        return datetime.date(int(value[6:10]), int(value[3:5]), int(value[:2]))
+    return datetime.date.fromisoformat(value[:10])
+
+
+def legacy_to_site(value: str or None) -> str:
+    """Returns host of the site of the legacy database ('https://www.cbr.ru/') as stored by "Rate" ('www.cbr.ru')."""
+    from urllib.parse import urlsplit
+    if not value:
+        return 'www.cbr.ru'
+    return urlsplit(value).netloc or value.strip('/')
+
+
+def legacy_to_row(char_code: str, request_date: str, currency_rate: float, scraping_datetime: str or None,
+                  scraping_site: str or None) -> dict or None:
+    """Returns row of the table "rates" from a row of the legacy database or None if the row is malformed."""
+    try:
+        return {'char_code': char_code, 'request_date': legacy_to_date(request_date), 'nominal': 1,
+                'currency_rate': float(currency_rate), 'scraping_site': legacy_to_site(scraping_site),
+                'scraping_datetime': legacy_to_datetime(scraping_datetime)}
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+@db_writer.serialized
+def import_legacy_db(legacy_path: str = path_to_legacy_database, chunk_size: int = legacy_chunk_size) -> 'database':
+    """Copies rates of USD and EUR from the database of 'cbr_usd_eur.py' (tables "USD rates", "EUR rates"
+    joined to "Scraping Info") into the table "rates". The legacy tables are streamed by chunks of "chunk_size" rows,
+    the sqlite3 cursor steps the query on demand, so the history is never loaded at once.
+    Each chunk is added by one bulk upsert, repeated dates of the legacy tables are reduced to the newest row
+    and a stored rate is replaced only by a rate scraped later, so the import can be repeated.
+    Malformed rows (a date or a rate which can't be read) are skipped and counted.
+    Dynamics of the imported range is recomputed at the end, the whole import is one transaction."""
+    if not os.path.exists(legacy_path):
+        sys.exit(f'Error! There is no legacy database {legacy_path}')
+    from sqlalchemy import create_engine
+    from urllib.parse import quote
+    legacy_engine = create_engine(f'sqlite:///file:{quote(os.path.abspath(legacy_path))}?mode=ro&uri=true')
+    statement = sqlite_insert(Rate.__table__)
+    upsert = statement.on_conflict_do_update(
+        index_elements=['char_code', 'request_date'],
+        set_={column_name: statement.excluded[column_name]
+              for column_name in ('nominal', 'currency_rate', 'scraping_site', 'scraping_datetime')},
+        where=(Rate.__table__.c.scraping_datetime.is_(None) |
+               (statement.excluded.scraping_datetime > Rate.__table__.c.scraping_datetime)))
+    try:
+        db_engine = get_db_engine()
+        Base.metadata.create_all(db_engine, tables=[CurrencyInfo.__table__, Rate.__table__])
+        with legacy_engine.connect() as legacy_connection, db_engine.begin() as connection:
+            for char_code, table_name in (('USD', 'USD rates'), ('EUR', 'EUR rates')):
+                if not legacy_engine.dialect.has_table(legacy_connection, table_name):
+                    continue
+                connection.execute(text('INSERT INTO currencies (char_code, cbr_id) VALUES (:code, :cbr_id) '
+                                        'ON CONFLICT (char_code) DO NOTHING'),
+                                   {'code': char_code, 'cbr_id': known_cbr_ids[char_code]})
+                read_rows = 0
+                skipped_rows = 0
+                written_rows = 0
+                from_date = datetime.date.max
+                to_date = datetime.date.min
+                result = legacy_connection.execution_options(stream_results=True, yield_per=chunk_size).execute(
+                    text(legacy_rows_sql.format(prefix=char_code.lower(), table_name=table_name)))
+                for chunk in result.partitions(chunk_size):
+                    read_rows += len(chunk)
+                    rows = [row for row in (legacy_to_row(char_code, *legacy_row) for legacy_row in chunk) if row]
+                    skipped_rows += len(chunk) - len(rows)
+                    if not rows:
+                        continue
+                    written_rows += connection.execute(upsert, rows).rowcount
+                    from_date = min(from_date, min(row['request_date'] for row in rows))
+                    to_date = max(to_date, max(row['request_date'] for row in rows))
+                if from_date <= to_date:
+                    update_dynamics(connection, char_code, from_date, to_date)
+                inc('cbr_rows_written_total', written_rows, table=Rate.__tablename__)
+                print(f'{table_name}: {read_rows} rows read, {skipped_rows} malformed rows skipped, '
+                      f'{written_rows} rows added or updated')
+        rates_cache.invalidate()
+    except Exception as err:
+        sys.exit(f'Error! Import of the legacy database failed:\n{err}')
+    finally:
+        legacy_engine.dispose()
+
+
+@db_writer.serialized
+def compact_db() -> 'database':
+    """Removes duplicate rows of the same currency and date from the legacy tables (the newest row is kept),
+    then rebuilds the database file and updates statistics of the query planner."""
+    try:
+        db_engine = get_db_engine()
+        with db_engine.begin() as connection:
+            for currency_name in (USD, EUR):
+                table = currency_name.__table__
+                if db_engine.dialect.has_table(connection, table.name):
+                    removed_rows = connection.execute(text(
+                        f'DELETE FROM "{table.name}" WHERE id NOT IN '
+                        f'(SELECT max(id) FROM "{table.name}" GROUP BY request_date)')).rowcount
+                    print(f'{table.name}: {removed_rows} duplicate rows removed')
+        with db_engine.connect() as connection:
+            connection = connection.execution_options(isolation_level='AUTOCOMMIT')  # VACUUM can't run in transaction
+            connection.execute(text('VACUUM'))
+            connection.execute(text('ANALYZE'))
+    except Exception as err:
+        sys.exit(f'Error! Compaction of the database failed:\n{err}')
+
+
+class RatesCache:
+    """
+    Read-through in-memory cache of the rates for the telegram bot.
+    Rates on dates are kept in LRU order up to "max_size" entries, the latest rates are pinned.
+    The cache is cleared by the ingest functions after each commit, "max_age" (seconds) limits lifetime of entries
+    for the case of rows written by another process.
+    """
+    def __init__(self, max_size: int = 512, max_age: float = 60):
+        self.max_size = max_size
+        self.max_age = max_age
+        self.rates_on_date = OrderedDict()  # (char code, date) -> (time of caching, rate)
+        self.last_rates = dict()  # char code -> (time of caching, (rate, date, dynamics))
+        self.lock = threading.Lock()
+
+    def is_fresh(self, cached_time: float) -> bool:
+        return time.monotonic() - cached_time < self.max_age
+
+    def rate_on_date(self, char_code: str, input_date: str) -> float:
+        """Returns rate of given currency on inputted date, the database is queried on cache miss only."""
+        try:
+            key = (char_code, str_to_date(input_date))
+        except ValueError:
+            return None
+        with self.lock:
+            cached = self.rates_on_date.get(key)
+            if cached is not None and self.is_fresh(cached[0]):
+                self.rates_on_date.move_to_end(key)
+                return cached[1]
+        rate_on_date = get_rate_on_date(char_code, input_date)
+        release_session()
+        if rate_on_date is not None:
+            with self.lock:
+                self.rates_on_date[key] = (time.monotonic(), rate_on_date)
+                self.rates_on_date.move_to_end(key)
+                while len(self.rates_on_date) > self.max_size:
+                    self.rates_on_date.popitem(last=False)
+        return rate_on_date
+
+    def last_rate(self, char_code: str) -> float and str and str:
+        """Returns last rate, date of rating and dynamics of given currency, the database is queried on cache miss only."""
+        key = char_code
+        with self.lock:
+            cached = self.last_rates.get(key)
+            if cached is not None and self.is_fresh(cached[0]):
+                return cached[1]
+        last_rate_info = last_rate_for_tlg(char_code)
+        release_session()
+        if last_rate_info[0] is not None:
+            with self.lock:
+                self.last_rates[key] = (time.monotonic(), last_rate_info)
+        return last_rate_info
+
+    def invalidate(self) -> None:
+        """Clears the cache, is called after new rows are written to the database.
+        Precomputed cross rates of "cbr_analytics.py" are cleared too if the module is loaded."""
+        with self.lock:
+            self.rates_on_date.clear()
+            self.last_rates.clear()
+        analytics = sys.modules.get('cbr_analytics')
+        if analytics is not None:
+            analytics.cross_rate_cache.invalidate()
+
+
+rates_cache = RatesCache()
+
+
+def create_telegram_bot(bot_threads: int = 4) -> 'telebot.TeleBot':
+    """Returns telegram bot with registered commands. Help and display rates are realised.
+    Commands of different users are handled in parallel by "bot_threads" worker threads."""
+    import telebot
     base_dir = Path(__file__).resolve().parent.parent
     telegram_settings = os.path.join(base_dir, 'telegram_settings', 'name_token.txt')
     with open(telegram_settings) as t_bot:
         bot_name, bot_token = t_bot
     bot_token = bot_token.rstrip()
-    tlg_bot = telebot.TeleBot(bot_token)
+    tlg_bot = telebot.TeleBot(bot_token, threaded=True, num_threads=bot_threads)
 
     @tlg_bot.message_handler(commands=['start'])
+    @timed('cbr_bot_handler_seconds', command='start')
     def start_command(message):
         tlg_bot.send_message(
             message.chat.id,
             'Greetings!\nPress "/rates" to get last exchange rates from database\n'
-            ' or input "/rates_on DD/MM/YYYY" to get exchange rates on given date.\n' +
+            ' or input "/rates_on DD/MM/YYYY" to get exchange rates on given date.\n'
+            'Input "/cross EUR USD" to get cross rate of two currencies.\n' +
             'Press "/help" to get more information.'
         )
 
     @tlg_bot.message_handler(commands=['help'])
+    @timed('cbr_bot_handler_seconds', command='help')
     def help_command(message):
         """Help mode."""
         tlg_bot.send_message(message.chat.id, '1) To get last rates input /rates.\n'
                                               '2) To get rates for a specific date input /rates_on DD.MM.YYYY\n'
-                                              'for example, /rates_on 01.02.2022')
+                                              'for example, /rates_on 01.02.2022\n'
+                                              '3) To get cross rate input /cross BASE QUOTE DD.MM.YYYY (date is optional)\n'
+                                              'for example, /cross EUR USD 01.02.2022')
 
     @tlg_bot.message_handler(commands=['rates'])
+    @timed('cbr_bot_handler_seconds', command='rates')
     def rates_command(message):
         """Displays last inputted to the database information about exchange rates of USD and EUR"""
-        usd_rate, usd_date, usd_dyn = last_rate_for_tlg(USD)
-        eur_rate, eur_date, eur_dyn = last_rate_for_tlg(EUR)
+        usd_rate, usd_date, usd_dyn = rates_cache.last_rate('USD')
+        eur_rate, eur_date, eur_dyn = rates_cache.last_rate('EUR')
         if usd_rate is None or usd_date is None:
             tlg_bot.send_message(message.chat.id, f'Error! There is no data for USD rates')
         else:
-            tlg_bot.send_message(message.chat.id, f'USD on {usd_date} is {usd_rate} ({usd_dyn})')
+            tlg_bot.send_message(message.chat.id, f'USD on {usd_date:%d.%m.%Y} is {usd_rate} ({usd_dyn})')
         if eur_rate is None or eur_date is None:
             tlg_bot.send_message(message.chat.id, f'Error! There is no data for EUR rates')
         else:
-            tlg_bot.send_message(message.chat.id, f'EUR on {eur_date} is {eur_rate} ({eur_dyn})')
+            tlg_bot.send_message(message.chat.id, f'EUR on {eur_date:%d.%m.%Y} is {eur_rate} ({eur_dyn})')
 
     def get_user_date(input_date):
         """
@@ -218,11 +945,12 @@ def process_mode_telegrambot():
         return input_date.split()[-1]
 
     @tlg_bot.message_handler(commands=['rates_on'])
+    @timed('cbr_bot_handler_seconds', command='rates_on')
     def rates_on_date_command(message):
         """Displays exchange rates of USD and EUR on inputted date"""
         user_date = str(get_user_date(message.text))
-        usd_rate_on_date = get_rate_on_date(USD, user_date)
-        eur_rate_on_date = get_rate_on_date(EUR, user_date)
+        usd_rate_on_date = rates_cache.rate_on_date('USD', user_date)
+        eur_rate_on_date = rates_cache.rate_on_date('EUR', user_date)
         if usd_rate_on_date is None:
             tlg_bot.send_message(message.chat.id, f'Error! There is no USD rates on {user_date}')
         else:
@@ -232,6 +960,34 @@ def process_mode_telegrambot():
         else:
             tlg_bot.send_message(message.chat.id, f'EUR on {user_date} was {eur_rate_on_date}')
 
+    @tlg_bot.message_handler(commands=['cross'])
+    @timed('cbr_bot_handler_seconds', command='cross')
+    def cross_rate_command(message):
+        """Displays cross rate of two currencies on inputted date or the last one, e.g. '/cross EUR USD 01.02.2022'"""
+        from cbr_analytics import get_cross_rate
+        command_args = message.text.split()[1:]
+        if len(command_args) not in (2, 3):
+            tlg_bot.send_message(message.chat.id,
+                                 'Error! Input the command as /cross EUR USD or /cross EUR USD DD.MM.YYYY')
+            return
+        base, quote = command_args[0].upper(), command_args[1].upper()
+        try:
+            input_date = str_to_date(command_args[2]) if len(command_args) == 3 else None
+        except ValueError:
+            tlg_bot.send_message(message.chat.id, f'Error! Invalid date {command_args[2]}')
+            return
+        cross_rate, rate_date = get_cross_rate(base, quote, input_date)
+        if cross_rate is None:
+            tlg_bot.send_message(message.chat.id, f'Error! There is no data for {base}/{quote}')
+        else:
+            tlg_bot.send_message(message.chat.id, f'1 {base} on {rate_date:%d.%m.%Y} was {cross_rate:.4f} {quote}')
+
+    return tlg_bot
+
+
+def process_mode_telegrambot():
+    """Starts telegram bot."""
+    tlg_bot = create_telegram_bot()
     tlg_bot.polling(none_stop=True)
 
 
@@ -243,66 +999,295 @@ def main():
             database functions
             class definitions
         Secondly, main arguments are defined from the command line by using argparse module:
-            mode ('schedule', 'period', 'schedule_bot', 'telegrambot')
+            mode ('schedule', 'period', 'sync', 'schedule_bot', 'telegram', 'migrate', 'compact', 'recompute', 'export',
+                  'api', 'import')
             request period (optional)
-        For 'schedule' is executed:
-            get_rates_and_add_to_db
+        For 'schedule' are executed:
+            catch_up_missed_days
+            get_rates_and_add_to_db (by DailyScheduler)
+        For 'schedule_bot' are executed together:
+            catch_up_missed_days
+            get_rates_and_add_to_db (by DailyScheduler)
+            process_mode_telegrambot
         For 'period' is executed:
             scrapy_period
-        For 'telegrambot' is executed:
+        For 'sync' is executed:
+            sync_currency
+        For 'telegram' is executed:
             process_mode_telegrambot
+        For 'migrate' are executed:
+            migrate_db_dates
+            migrate_legacy_tables
+        For 'compact' is executed:
+            compact_db
+        For 'recompute' is executed:
+            recompute_dynamics
+        For 'export' is executed:
+            process_mode_export
+        For 'api' is executed:
+            process_mode_api
+        For 'import' is executed:
+            import_legacy_db
 
-        Extra functions are also used:
+        Extra functions and classes are also used:
+            RatesCache
+            add_daily_rates_to_db
             add_data_to_db
-            edit_currency_dynamics
-            get_previous_rate
+            add_period_to_db
+            add_synced_range
+            create_telegram_bot
+            get_cbr_id
+            fetch_daily_xml
+            fetch_period_xml
+            get_calendar
+            get_daily_xml
+            get_first_rate_date
+            get_period_xml
+            get_db_engine
+            get_missing_ranges
             get_rate_on_date
+            get_rates_on_date
+            get_rates_for_period
             get_rate_xml
+            get_rates_xml
+            get_last_stored_date
+            get_session
+            ingest_daily_rates
+            legacy_to_date
+            legacy_to_datetime
             last_rate_for_tlg
+            parse_daily_rates
+            parse_period_xml
+            period_pipeline
             process_mode_telegrambot
+            query_cbr_id
+            recompute_dynamics
+            release_session
+            report_ingest_speed
+            scheduled_job
             scrapy_period
+            split_period
+            str_to_date
+            update_currencies_reference
+            update_dynamics
+            upsert_statement
             """
     parser = argparse.ArgumentParser(prog='ScrapyCBR',
                                      usage='scrapy_cbr.py [-h] [mode, query_period(optional)]',
                                      formatter_class=argparse.RawDescriptionHelpFormatter,
                                      description='''
-            %(prog)s requests exchanged rates of USD and EUR from www.cbr.ru.
+            %(prog)s requests exchanged rates from www.cbr.ru.
             Reference information about script:
-              schedule = gets exchange rates according to the schedule, every day at 12:00, and
-                         entering the data into a table in the database
+              schedule = gets exchange rates of all currencies according to the schedule, every day at 12:00, and
+                         entering the data into a table in the database,
+                         days missed while the script wasn't running are caught up on start
               period "DD/MM/YYYY-DD/MM/YYYY" = gets exchange rates for the given period
                                                from "DD/MM/YYYY" to "DD/MM/YYYY"
                                                and enters the data into a table in the database
-              telegrambot = runs telegram bot launcher
+                                               by windows of --window-days days (default 365),
+                                               --fetch-workers windows are requested at once (default 2)
+                                               while the previous ones are parsed and written,
+                                               each one in one transaction (row by row with --no-bulk)
+                                               for currencies given by --currencies (default USD,EUR)
+              sync "DD/MM/YYYY-DD/MM/YYYY" (optional) = requests only the dates of the period missing in the database,
+                                                        by default from the first stored date to today
+              schedule_bot = runs "schedule" mode and telegram bot together
+              telegram = runs telegram bot launcher
+              migrate = converts dates in the existing database into sortable format and indexes them,
+                        copies rates from the legacy per-currency tables into the table "rates"
+              compact = removes duplicate rows from the legacy tables and rebuilds the database file
+              recompute = recomputes dynamics of all rates in order of dates
+              export = appends new rates of currencies given by --currencies to columnar memory-mapped files
+                       in the folder given by --export-dir (default "rates_db/export")
+              api = serves read-only HTTP/JSON API of the stored rates on http://--api-host:--api-port
+                    (default http://127.0.0.1:8080): /latest, /rates?date=, /rates?dates=, /rates?from=&to=
+              import = copies USD and EUR rates from the database of "cbr_usd_eur.py" given by --legacy-db
+                       (default "rates_db/usd_eur.db") into the table "rates" by chunks of --chunk-size rows
               ''')
     parser.add_argument('mode', type=str, help='Choose the mode',
-                        choices=['schedule', 'period', 'telegram'])
+                        choices=['schedule', 'period', 'sync', 'schedule_bot', 'telegram', 'migrate', 'compact',
+                                 'recompute', 'export', 'api', 'import'])
     parser.add_argument('query_period', type=str,
                         help='Input the period in format "DD/MM/YYYY-DD/MM/YYYY"', nargs='?', default=None)
+    parser.add_argument('--no-bulk', action='store_true',
+                        help='Add rates for the period row by row instead of one bulk transaction')
+    parser.add_argument('--window-days', type=int, default=period_window_days,
+                        help='Number of days requested at once by "period" and "sync" modes')
+    parser.add_argument('--fetch-workers', type=int, default=fetch_workers,
+                        help='Number of concurrent requests of "period" and "sync" modes')
+    parser.add_argument('--currencies', type=str, default=','.join(tracked_currencies),
+                        help='Char codes of currencies for "period", "sync" and "export" modes, e.g. "USD,EUR,CNY"')
+    parser.add_argument('--export-dir', type=str, default=export_dir,
+                        help='Folder for the files of "export" mode')
+    parser.add_argument('--api-host', type=str, default='127.0.0.1',
+                        help='Address the API of "api" mode listens on')
+    parser.add_argument('--api-port', type=int, default=api_port,
+                        help='Port of the API of "api" mode')
+    parser.add_argument('--legacy-db', type=str, default=path_to_legacy_database,
+                        help='Database of "cbr_usd_eur.py" copied by "import" mode')
+    parser.add_argument('--chunk-size', type=int, default=legacy_chunk_size,
+                        help='Number of rows read and inserted at once by "import" mode')
+    cbr_metrics.add_cli_arguments(parser)
     input_args = parser.parse_args()
     query_range = str(input_args.query_period)
     mode = input_args.mode
+    cbr_metrics.setup_from_args(input_args)
 
-    if mode == 'schedule':
-        process_mode_schedule()
-    elif mode == 'period':
-        process_mode_period(query_range)
-    else:  # elif mode == 'telegram':
-        process_mode_telegrambot()
+    with cbr_metrics.profile(input_args.profile):
+        if mode == 'schedule':
+            process_mode_schedule()
+        elif mode == 'schedule_bot':
+            process_mode_schedule_bot()
+        elif mode == 'period':
+            process_mode_period(query_range, bulk=not input_args.no_bulk,
+                                currencies=input_args.currencies.upper().split(','),
+                                window_days=input_args.window_days, workers=input_args.fetch_workers)
+        elif mode == 'sync':
+            process_mode_sync(input_args.query_period, currencies=input_args.currencies.upper().split(','),
+                              window_days=input_args.window_days, workers=input_args.fetch_workers)
+        elif mode == 'migrate':
+            migrate_db_dates()
+            migrate_legacy_tables()
+        elif mode == 'compact':
+            compact_db()
+        elif mode == 'recompute':
+            recompute_dynamics()
+        elif mode == 'export':
+            process_mode_export(input_args.export_dir, currencies=input_args.currencies.upper().split(','))
+        elif mode == 'api':
+            process_mode_api(input_args.api_host, input_args.api_port)
+        elif mode == 'import':
+            import_legacy_db(input_args.legacy_db, max(1, input_args.chunk_size))
+        else:  # elif mode == 'telegram':
+            process_mode_telegrambot()
 
 
 # mode function definitions:
 def process_mode_schedule():
-    schedule.every().day.at("12:00").do(get_rates_and_add_to_db)
-    while True:
-        schedule.run_pending()
-        time.sleep(1)
+    """Catches up the days missed while the script wasn't running, then runs the job every day at 12:00.
+    Responses for today are cached for "today_ttl" seconds, so retries wait at least as long."""
+    scheduler = DailyScheduler(scheduled_job, at=datetime.time(12, 0), retry_delay=2 * today_ttl)
+    catch_up_missed_days(scheduler.last_run_date(datetime.datetime.now()))
+    scheduler.run()
 
 
-def process_mode_period(query_range):
+def scheduled_job() -> bool:
+    """Adds exchange rates of all currencies on the current date to the database.
+    Returns False if the source hasn't published rates on the date yet, so the scheduler retries the job;
+    days without publication, known or expected by the publication calendar, aren't retried."""
+    today = datetime.date.today()
+    request_date = f'{today:%d/%m/%Y}'
+    publishing_day = get_calendar().expects_publication(today)
+    xml_cbr = fetch_daily_xml(request_date)
+    try:
+        from cbr_parsers import parse_daily_date
+        rating_date = parse_daily_date(xml_cbr)
+    except Exception as err:
+        sys.exit(f'Error! Parsing failed:\n{err}')
+    get_rates_and_add_to_db(request_date)  # the document is taken from the HTTP cache
+    get_calendar().learn(today, rating_date)
+    get_calendar().save()
+    return rating_date >= today or not publishing_day
+
+
+def catch_up_missed_days(to_date: datetime.date, workers: int = fetch_workers) -> 'database':
+    """Adds rates on the days after the last stored date up to "to_date", missed while the script wasn't running.
+    The currencies stored on the last date are requested by one range request of XML_dynamic each,
+    unless fewer days than currencies are missed, then each day is requested by XML_daily for all currencies,
+    so the gap takes the smaller number of requests. Nothing is done if the table is empty."""
+    last_date, char_codes = get_last_stored_date()
+    if last_date is None or last_date >= to_date:
+        return
+    first_date = last_date + datetime.timedelta(days=1)
+    missed_days = (to_date - last_date).days
+    print(f'{missed_days} missed days from {first_date:%d.%m.%Y} to {to_date:%d.%m.%Y} are caught up')
+    if missed_days < len(char_codes):
+        ingest_daily_rates([f'{first_date + datetime.timedelta(days=day):%d/%m/%Y}' for day in range(missed_days)],
+                           workers)
+    else:
+        for char_code in char_codes:
+            scrapy_period(char_code, get_cbr_id(char_code), f'{first_date:%d/%m/%Y}', f'{to_date:%d/%m/%Y}',
+                          workers=workers)
+
+
+def get_last_stored_date() -> datetime.date or None and list:
+    """Returns the last date of the table "rates" and char codes of the currencies stored on it."""
+    last_date = None
+    char_codes = list()
+    try:
+        Base.metadata.create_all(get_db_engine())
+        last_date = get_session().query(func.max(Rate.request_date)).scalar()
+        if last_date is not None:
+            char_codes = [char_code for char_code, in get_session().query(Rate.char_code).filter(
+                Rate.request_date == last_date).order_by(Rate.char_code)]
+    except Exception as err:
+        sys.exit(f'Error in getting the last stored date:\n{err}')
+    finally:
+        release_session()
+        return last_date, char_codes
+
+
+def process_mode_schedule_bot():
+    """Runs telegram bot in a background thread and the scheduler in the main thread,
+    so scraping doesn't block answers of the bot."""
+    tlg_bot = create_telegram_bot()
+    bot_thread = threading.Thread(target=tlg_bot.polling, kwargs={'none_stop': True},
+                                  name='telegram-bot', daemon=True)
+    bot_thread.start()
+    process_mode_schedule()
+
+
+def process_mode_period(query_range, bulk=True, currencies=tracked_currencies, window_days=period_window_days,
+                        workers=fetch_workers):
     start_parsing, end_parsing = query_range.split('-')
-    scrapy_period(USD, 'R01235', start_parsing, end_parsing)
-    scrapy_period(EUR, 'R01239', start_parsing, end_parsing)
+    for char_code in currencies:
+        scrapy_period(char_code, get_cbr_id(char_code), start_parsing, end_parsing, bulk, window_days, workers)
+
+
+def process_mode_sync(query_range=None, currencies=tracked_currencies, window_days=period_window_days,
+                      workers=fetch_workers):
+    for char_code in currencies:
+        if query_range:
+            start_parsing, end_parsing = (str_to_date(range_date) for range_date in query_range.split('-'))
+        else:
+            start_parsing = get_first_rate_date(char_code) or sync_start_date
+            end_parsing = datetime.date.today()
+        sync_currency(char_code, get_cbr_id(char_code), start_parsing, end_parsing, window_days, workers)
+
+
+def process_mode_export(export_folder=export_dir, currencies=tracked_currencies):
+    from cbr_export import export_rates
+    try:
+        Base.metadata.create_all(get_db_engine())
+        export_rates(get_db_engine(), export_folder, currencies)
+    except Exception as err:
+        sys.exit(f'Error! Export of rates failed:\n{err}')
+
+
+def process_mode_api(host='127.0.0.1', port=api_port):
+    from cbr_api import RatesQueries, create_api_server
+
+    def released(query_function):
+        """Returns the query function closing the session of the thread after each call,
+        connections of the API are served by short-lived threads."""
+        def wrapper(*args):
+            try:
+                return query_function(*args)
+            finally:
+                release_session()
+        return wrapper
+
+    Base.metadata.create_all(get_db_engine())
+    server = create_api_server(RatesQueries(last_rate=rates_cache.last_rate,
+                                            rates_on_date=released(get_rates_on_date),
+                                            rates_for_period=released(get_rates_for_period),
+                                            default_currencies=tracked_currencies,
+                                            is_publishing_day=get_calendar().is_publishing_day), host, port)
+    print(f'API is served on http://{host}:{server.server_port}')
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,71 @@
+"""Tests of the answers and the caching headers of the HTTP/JSON API with stand-in query functions."""
+import datetime
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from cbr_api import RatesQueries, answer, encode_response, historical_max_age, recent_max_age  # noqa: E402
+
+
+# 15.01.2022 and 16.01.2022 are the weekend without publication, EUR isn't ingested on 18.01.2022 yet
+stored_rates = {'USD': {datetime.date(2022, 1, day): 70.0 + day for day in (13, 14, 17, 18)},
+                'EUR': {datetime.date(2022, 1, day): 80.0 + day for day in (13, 14, 17)},
+                'JPY': {datetime.date(2022, 1, day): 60.0 + day for day in (13, 14)}}
+
+
+def to_date(date_str: str) -> datetime.date:
+    return datetime.datetime.strptime(date_str, '%d.%m.%Y').date()
+
+
+def rates_on_date(date_str: str) -> dict:
+    return {char_code: rates[to_date(date_str)] for char_code, rates in stored_rates.items()
+            if to_date(date_str) in rates}
+
+
+def rates_for_period(char_code: str, from_date: str, to_date_str: str) -> list:
+    return sorted((rate_date, rate) for rate_date, rate in stored_rates.get(char_code, {}).items()
+                  if to_date(from_date) <= rate_date <= to_date(to_date_str))
+
+
+queries = RatesQueries(last_rate=None, rates_on_date=rates_on_date, rates_for_period=rates_for_period,
+                       is_publishing_day=lambda checking_date: checking_date.weekday() < 5)
+
+
+def cache_control(query: dict) -> str:
+    return encode_response(*answer(queries, '/rates', query))[3]
+
+
+immutable = f'public, max-age={historical_max_age}, immutable'
+recent = f'public, max-age={recent_max_age}'
+
+
+def test_date_with_all_requested_currencies_is_immutable():
+    assert cache_control({'date': '2022-01-17', 'currencies': 'USD,EUR'}) == immutable
+
+
+def test_date_with_missing_requested_currency_is_recent():
+    assert cache_control({'date': '2022-01-18', 'currencies': 'USD,EUR'}) == recent
+    assert cache_control({'date': '2022-01-18', 'currencies': 'USD'}) == immutable
+
+
+def test_date_without_currencies_is_recent():
+    # the answer has every currency stored on the date, a later ingest can add the others
+    status, data, _ = answer(queries, '/rates', {'date': '2022-01-13'})
+    assert status == 200 and set(data['rates']) == {'USD', 'EUR', 'JPY'}
+    assert cache_control({'date': '2022-01-13'}) == recent
+
+
+def test_period_with_all_days_of_publication_is_immutable():
+    assert cache_control({'from': '2022-01-13', 'to': '2022-01-17'}) == immutable
+    assert cache_control({'dates': '2022-01-14,2022-01-15,2022-01-17'}) == immutable
+
+
+def test_period_with_missing_day_of_publication_is_recent():
+    assert cache_control({'from': '2022-01-13', 'to': '2022-01-18'}) == recent
+    assert cache_control({'from': '2022-01-13', 'to': '2022-01-17', 'currencies': 'USD,JPY'}) == recent
+
+
+def test_period_without_calendar_is_recent():
+    status, data, last_date = answer(queries._replace(is_publishing_day=None), '/rates',
+                                     {'from': '2022-01-13', 'to': '2022-01-17'})
+    assert encode_response(status, data, last_date)[3] == recent
@@ -0,0 +1,52 @@
+"""Tests of the publication calendar learned from dates of rating."""
+import datetime
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from cbr_calendar import PublicationCalendar  # noqa: E402
+
+
+def learned_calendar(tmp_path, weeks: int) -> PublicationCalendar:
+    """Calendar of "weeks" weeks from Monday 10.01.2022 with publication on Tuesday - Saturday,
+    like the rates of the source for the next day."""
+    calendar = PublicationCalendar(str(tmp_path / 'calendar.json'))
+    monday = datetime.date(2022, 1, 10)
+    for day_number in range(weeks * 7):
+        request_date = monday + datetime.timedelta(days=day_number)
+        site_date = request_date
+        while site_date.weekday() in (0, 6):
+            site_date -= datetime.timedelta(days=1)
+        calendar.learn(request_date, site_date)
+    return calendar
+
+
+def test_known_days_without_publication_are_skipped(tmp_path):
+    calendar = learned_calendar(tmp_path, weeks=1)
+    assert not calendar.is_publishing_day(datetime.date(2022, 1, 16))  # Sunday
+    assert not calendar.is_publishing_day(datetime.date(2022, 1, 10))  # Monday
+    assert calendar.is_publishing_day(datetime.date(2022, 1, 11))
+
+
+def test_unseen_days_are_always_requested(tmp_path):
+    calendar = learned_calendar(tmp_path, weeks=10)
+    unseen_monday = datetime.date(2022, 6, 6)
+    assert calendar.is_publishing_day(unseen_monday)
+    assert not calendar.expects_publication(unseen_monday)  # enough Mondays are known
+
+
+def test_few_known_days_of_weekday_expect_publication(tmp_path):
+    calendar = learned_calendar(tmp_path, weeks=2)
+    unseen_monday = datetime.date(2022, 6, 6)
+    assert calendar.is_publishing_day(unseen_monday)
+    assert calendar.expects_publication(unseen_monday)
+    assert not calendar.expects_publication(datetime.date(2022, 1, 16))  # a known Sunday
+
+
+def test_calendar_survives_restart(tmp_path):
+    calendar = learned_calendar(tmp_path, weeks=1)
+    calendar.save()
+    loaded_calendar = PublicationCalendar(calendar.path)
+    assert loaded_calendar.load()
+    assert loaded_calendar.published == calendar.published
+    assert loaded_calendar.not_published == calendar.not_published
@@ -0,0 +1,30 @@
+"""Tests of the columnar export files of "cbr_export.py"."""
+import sys
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from cbr_export import create_file, load_export, read_header, update_rows  # noqa: E402
+
+
+def columns(days: list, rates: list) -> dict:
+    return {'days': np.array(days, dtype=np.int32), 'rates': np.array(rates, dtype=np.float64),
+            'nominal': np.ones(len(days), dtype=np.int32)}
+
+
+def test_rows_read_again_are_not_counted(tmp_path):
+    path = str(tmp_path / 'USD.rates')
+    create_file(path, 'USD', 16, columns([1, 2, 3], [70.0, 71.0, np.nan]), '2022-01-03 10:00:00')
+    assert update_rows(path, 'USD', columns([2, 3], [71.0, np.nan]), '2022-01-03 10:00:00') == (0, 3)
+    assert update_rows(path, 'USD', columns([3, 4], [np.nan, 72.0]), '2022-01-04 10:00:00') == (1, 4)
+    assert read_header(path)[3] == '2022-01-04 10:00:00'
+
+
+def test_corrected_and_backfilled_rows_are_counted(tmp_path):
+    path = str(tmp_path / 'USD.rates')
+    create_file(path, 'USD', 16, columns([2, 3], [71.0, 72.0]), '2022-01-03 10:00:00')
+    assert update_rows(path, 'USD', columns([1, 2, 3], [70.0, 71.5, 72.0]), '2022-01-05 10:00:00') == (2, 3)
+    exported = load_export(path)
+    assert list(exported['days']) == [1, 2, 3]
+    assert list(exported['rates']) == [70.0, 71.5, 72.0]
@@ -0,0 +1,110 @@
+"""Tests of the HTTP client of the scrapers against a local stand-in server."""
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from cbr_http import CbrHttpClient  # noqa: E402
+
+
+@pytest.fixture
+def server():
+    """Stand-in server answering '/<text>' with the text and the number of the request, '/missing' with 404.
+    "server.requests" counts requests of each path."""
+    requests = dict()
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            requests[self.path] = requests.get(self.path, 0) + 1
+            if self.path == '/missing':
+                self.send_error(404)
+                return
+            body = f'{self.path[1:]} {requests[self.path]}'.encode()
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    http_server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    http_server.requests = requests
+    http_server.url = f'http://127.0.0.1:{http_server.server_port}'
+    threading.Thread(target=http_server.serve_forever, daemon=True).start()
+    yield http_server
+    http_server.shutdown()
+    http_server.server_close()
+
+
+def test_permanent_response_is_fetched_once(server, tmp_path):
+    client = CbrHttpClient(cache_dir=str(tmp_path))
+    assert client.fetch(f'{server.url}/rates') == b'rates 1'
+    assert client.fetch(f'{server.url}/rates') == b'rates 1'
+    assert server.requests['/rates'] == 1
+    assert CbrHttpClient(cache_dir=str(tmp_path)).fetch(f'{server.url}/rates') == b'rates 1'  # survives restart
+    assert server.requests['/rates'] == 1
+
+
+def test_expired_response_is_fetched_again(server, tmp_path):
+    client = CbrHttpClient(cache_dir=str(tmp_path))
+    assert client.fetch(f'{server.url}/today', ttl=0.2) == b'today 1'
+    assert client.fetch(f'{server.url}/today', ttl=0.2) == b'today 1'
+    time.sleep(0.3)
+    assert client.fetch(f'{server.url}/today', ttl=0.2) == b'today 2'
+    assert server.requests['/today'] == 2
+
+
+def test_response_with_ttl_always_has_expiry(server, tmp_path):
+    client = CbrHttpClient(cache_dir=str(tmp_path))
+    client.fetch(f'{server.url}/today', ttl=600)
+    bodies = [entry for entry in os.listdir(tmp_path) if '.' not in entry]
+    assert len(bodies) == 1
+    assert os.path.exists(tmp_path / f'{bodies[0]}.expires')
+    assert not [entry for entry in os.listdir(tmp_path) if entry.endswith('.tmp')]
+
+
+def test_permanent_response_replaces_expiry(server, tmp_path):
+    client = CbrHttpClient(cache_dir=str(tmp_path))
+    client.fetch(f'{server.url}/day', ttl=0.1)
+    time.sleep(0.2)
+    assert client.fetch(f'{server.url}/day') == b'day 2'
+    assert not [entry for entry in os.listdir(tmp_path) if entry.endswith('.expires')]
+    time.sleep(0.2)
+    assert client.fetch(f'{server.url}/day') == b'day 2'
+
+
+def test_overwritten_response_is_counted_once(server, tmp_path):
+    client = CbrHttpClient(cache_dir=str(tmp_path))
+    for _ in range(3):
+        client.fetch(f'{server.url}/today', ttl=0)
+        time.sleep(0.01)
+    assert server.requests['/today'] == 3
+    assert client.cache_size == len(b'today 3')
+
+
+def test_least_recently_used_responses_are_evicted(server, tmp_path):
+    client = CbrHttpClient(cache_dir=str(tmp_path), max_cache_size=len(b'first 1') * 2)
+    client.fetch(f'{server.url}/first')
+    time.sleep(0.01)
+    client.fetch(f'{server.url}/second')
+    time.sleep(0.01)
+    client.fetch(f'{server.url}/third')
+    assert client.cache_size <= client.max_cache_size
+    client.fetch(f'{server.url}/third')
+    client.fetch(f'{server.url}/first')
+    assert server.requests == {'/first': 2, '/second': 1, '/third': 1}
+
+
+def test_error_status_raises_and_is_not_cached(server, tmp_path):
+    client = CbrHttpClient(cache_dir=str(tmp_path))
+    with pytest.raises(OSError, match='HTTP 404'):
+        client.fetch(f'{server.url}/missing')
+    assert not os.listdir(tmp_path)
@@ -0,0 +1,72 @@
+"""Tests of the dynamics of the rates of "cbr_usd_eur.py" on a scratch database."""
+import datetime
+import sys
+from pathlib import Path
+
+import pytest
+from sqlalchemy import text
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from cbr_db import create_sqlite_engine  # noqa: E402
+from cbr_usd_eur import USD, Base, update_dynamics  # noqa: E402
+
+
+# (requested date, date of rating, rate), the weekend is requested too and gets the rate of Friday
+rows = [(datetime.date(2022, 1, day), datetime.date(2022, 1, site_day), rate)
+        for day, site_day, rate in ((10, 10, 70.0), (11, 11, 71.0), (12, 12, 71.0), (13, 13, 70.5),
+                                    (14, 14, 72.0), (15, 14, 72.0), (16, 14, 72.0), (17, 17, 73.0),
+                                    (18, 18, 72.5), (19, 19, 74.0))]
+
+
+@pytest.fixture
+def connection(tmp_path):
+    db_engine = create_sqlite_engine(str(tmp_path / 'usd_eur.db'))
+    Base.metadata.create_all(db_engine)
+    with db_engine.begin() as db_connection:
+        db_connection.execute(USD.__table__.insert(), [
+            {'request_date': request_date, 'date_rate_site': site_date, 'currency_rate': rate}
+            for request_date, site_date, rate in rows])
+        update_dynamics(db_connection, USD, datetime.date.min, datetime.date.max)
+        yield db_connection
+    db_engine.dispose()
+
+
+def stored(connection) -> dict:
+    """Returns {requested date: (dynamics, difference)} of the stored rows."""
+    return {datetime.date.fromisoformat(request_date): (dynamics, difference)
+            for request_date, dynamics, difference in connection.execute(text(
+                'SELECT request_date, currency_dynamics, currency_difference FROM "USD rates"'))}
+
+
+def test_recompute_sets_dynamics_relative_to_previous_date_of_rating(connection):
+    dynamics = stored(connection)
+    assert dynamics[datetime.date(2022, 1, 10)] == (None, None)
+    assert dynamics[datetime.date(2022, 1, 11)] == ('increased', 1.0)
+    assert dynamics[datetime.date(2022, 1, 12)] == ('no change', 0.0)
+    assert dynamics[datetime.date(2022, 1, 13)] == ('decreased', -0.5)
+    assert dynamics[datetime.date(2022, 1, 16)] == ('increased', 1.5)  # the weekend has the dynamics of Friday
+    assert dynamics[datetime.date(2022, 1, 17)] == ('increased', 1.0)  # Monday is compared with Friday
+
+
+def test_write_updates_only_the_date_and_the_next_one(connection):
+    connection.execute(text('UPDATE "USD rates" SET currency_dynamics = \'stale\''))
+    connection.execute(text('UPDATE "USD rates" SET currency_rate = 71.5 WHERE date_rate_site = \'2022-01-14\''))
+    updated_rows = update_dynamics(connection, USD, datetime.date(2022, 1, 14), datetime.date(2022, 1, 14))
+    dynamics = stored(connection)
+    assert updated_rows == 4  # three rows of Friday and the next date of rating
+    for day in (14, 15, 16):
+        assert dynamics[datetime.date(2022, 1, day)] == ('increased', 1.0)
+    assert dynamics[datetime.date(2022, 1, 17)] == ('increased', 1.5)
+    unchanged_days = (10, 11, 12, 13, 18, 19)
+    assert all(dynamics[datetime.date(2022, 1, day)][0] == 'stale' for day in unchanged_days)
+
+
+def test_write_of_a_new_last_date_updates_only_it(connection):
+    connection.execute(text('UPDATE "USD rates" SET currency_dynamics = \'stale\''))
+    connection.execute(USD.__table__.insert(), [{'request_date': datetime.date(2022, 1, 20),
+                                                 'date_rate_site': datetime.date(2022, 1, 20), 'currency_rate': 73.0}])
+    updated_rows = update_dynamics(connection, USD, datetime.date(2022, 1, 20), datetime.date(2022, 1, 20))
+    dynamics = stored(connection)
+    assert updated_rows == 1
+    assert dynamics[datetime.date(2022, 1, 20)] == ('decreased', -1.0)
+    assert dynamics[datetime.date(2022, 1, 19)][0] == 'stale'
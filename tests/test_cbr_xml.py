@@ -0,0 +1,55 @@
+"""Tests of the import of the legacy database of "cbr_usd_eur.py" on scratch databases."""
+import sqlite3
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import cbr_xml  # noqa: E402
+
+
+@pytest.fixture
+def databases(tmp_path, monkeypatch):
+    """Legacy database as written by "cbr_usd_eur.py" with one malformed time of scraping and a scratch database."""
+    legacy_path = tmp_path / 'usd_eur.db'
+    with sqlite3.connect(legacy_path) as legacy_connection:
+        legacy_connection.executescript('''
+            CREATE TABLE "Scraping Info" (id INTEGER PRIMARY KEY, scraping_site VARCHAR, scraping_datetime VARCHAR,
+                                          currency_1 VARCHAR, currency_2 VARCHAR);
+            CREATE TABLE "USD rates" (id INTEGER PRIMARY KEY, request_date VARCHAR, currency_rate FLOAT,
+                                      date_rate_site VARCHAR, currency_dynamics VARCHAR, currency_difference FLOAT,
+                                      usd_scraping_datetime VARCHAR);
+            INSERT INTO "Scraping Info" (scraping_site, scraping_datetime, currency_1, currency_2) VALUES
+                ('https://www.cbr.ru/', '01.03.2022 10:00:00', 'USD', 'EUR'),
+                ('https://www.cbr.ru/', '03.03.2022 user', 'USD', 'EUR'),
+                ('https://www.cbr.ru/', '04.03.2022 10:00:00', 'USD', 'EUR');
+            INSERT INTO "USD rates" (request_date, currency_rate, date_rate_site, usd_scraping_datetime) VALUES
+                ('01.03.2022', 95.0, '01.03.2022', '01.03.2022 10:00:00'),
+                ('03.03.2022', 104.0, '03.03.2022', '03.03.2022 user'),
+                ('04.03.2022', 105.0, '04.03.2022', '04.03.2022 10:00:00');
+        ''')
+    legacy_connection.close()
+    monkeypatch.setattr(cbr_xml, 'path_to_database', str(tmp_path / 'cbr_ru.db'))
+    monkeypatch.setattr(cbr_xml, '_db_engine', None)
+    monkeypatch.setattr(cbr_xml, '_session', None)
+    yield legacy_path, tmp_path / 'cbr_ru.db'
+    cbr_xml.release_session()
+    cbr_xml.get_db_engine().dispose()
+
+
+def test_malformed_rows_are_skipped_and_counted(databases, capsys):
+    legacy_path, db_path = databases
+    cbr_xml.import_legacy_db(str(legacy_path), chunk_size=2)
+    assert 'USD rates: 3 rows read, 1 malformed rows skipped, 2 rows added or updated' in capsys.readouterr().out
+    with sqlite3.connect(db_path) as connection:
+        rows = connection.execute('SELECT request_date, currency_rate, scraping_site FROM rates '
+                                  'ORDER BY request_date').fetchall()
+    connection.close()
+    assert rows == [('2022-03-01', 95.0, 'www.cbr.ru'), ('2022-03-04', 105.0, 'www.cbr.ru')]
+
+
+def test_site_is_stored_as_host():
+    assert cbr_xml.legacy_to_site('https://www.cbr.ru/') == 'www.cbr.ru'
+    assert cbr_xml.legacy_to_site('www.cbr.ru') == 'www.cbr.ru'
+    assert cbr_xml.legacy_to_site(None) == 'www.cbr.ru'